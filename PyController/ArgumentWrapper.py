@@ -109,4 +109,150 @@ def getArguments():
                            help="Attempts to print out key presses from the specified device as vendorID:productID "
                                 "which can be found using the '--list-devices' flag")
 
+    my_parser.add_argument('--print-key-stats',
+                           action='store',
+                           nargs='?',
+                           type=int,
+                           const=0,
+                           default=None,
+                           dest='print_key_stats',
+                           metavar='LIMIT',
+                           help="Prints how often each key of each device was pressed and how long it was held, most "
+                                "used first. Optionally only the LIMIT most used keys. Needs 'keyStats' in main.yaml.")
+
+    my_parser.add_argument('--dump-flight-recorder',
+                           action='store_true',
+                           default=False,
+                           dest='dump_flight_recorder',
+                           help="Writes the events kept by the flight recorder of the last run to a JSON lines file in "
+                                "the config directory. A running PyController dumps it on SIGUSR1 or the 'dump' "
+                                "control command instead.")
+
+    my_parser.add_argument('--log-queue',
+                           action='store_true',
+                           default=False,
+                           dest='log_queue',
+                           help="Writes the log from a background thread so logging does not delay the device workers. "
+                                "Overrides 'logQueue' in main.yaml.")
+
+    my_parser.add_argument('--log-json',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='log_json',
+                           metavar='FILE',
+                           help="Also writes the log to the specified file as JSON lines. Overrides 'logJson' in "
+                                "main.yaml.")
+
+    my_parser.add_argument('--control-socket',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='control_socket',
+                           help="Serves the control API on the specified UNIX socket. Overrides 'controlSocket' in "
+                                "main.yaml.")
+
+    my_parser.add_argument('--metrics-file',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='metrics_file',
+                           help="Periodically writes Prometheus style metrics to the specified file. Overrides "
+                                "'metricsFile' in main.yaml.")
+
+    my_parser.add_argument('--profile-hotpath',
+                           action='store',
+                           nargs='?',
+                           type=float,
+                           const=30.0,
+                           default=0.0,
+                           dest='profile_hotpath',
+                           metavar='SECONDS',
+                           help="Profiles the device workers for the specified amount of seconds (default 30) and "
+                                "writes a collapsed stack report to 'hotpath.folded' in the config directory.")
+
+    my_parser.add_argument('--control',
+                           action='store',
+                           nargs='+',
+                           default=None,
+                           dest='control',
+                           metavar='COMMAND',
+                           help="Sends a command to a running PyController over its control socket and prints the "
+                                "response. IE: '--control switch RTS' or '--control help'")
+
+    my_parser.add_argument('--output-helper',
+                           action='store_true',
+                           default=False,
+                           dest='output_helper',
+                           help="Runs a long lived helper that holds the output devices so PyController can restart "
+                                "without the OS seeing the virtual devices disappear. Set 'outputHelper' in main.yaml "
+                                "for PyController to use it.")
+
+    my_parser.add_argument('--forward-to',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='forward_to',
+                           metavar='ADDRESS',
+                           help="Sends the output devices' events to a PyController running with '--forward-receive' "
+                                "instead of creating them here. ADDRESS is 'udp://host:port' or a UNIX datagram "
+                                "socket path. Overrides 'forwardTo' in main.yaml.")
+
+    my_parser.add_argument('--forward-receive',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='forward_receive',
+                           metavar='ADDRESS',
+                           help="Listens at ADDRESS ('udp://host:port' or a UNIX socket path) for the events of a "
+                                "PyController started with '--forward-to' and replays them into local output devices. "
+                                "Without a host only this machine can send, 'udp://0.0.0.0:port' listens on every "
+                                "network so set '--forward-peer' or a firewall rule with it.")
+
+    my_parser.add_argument('--forward-peer',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='forward_peer',
+                           metavar='HOST',
+                           help="The only host '--forward-receive' accepts events from. Defaults to the first host "
+                                "that sends a frame.")
+
+    my_parser.add_argument('--low-footprint',
+                           action='store_true',
+                           default=False,
+                           dest='low_footprint',
+                           help="Closes the input devices that no configured device uses once they are found so "
+                                "neither PyController nor its game monitor keeps them open. Overrides 'lowFootprint' "
+                                "in main.yaml.")
+
+    my_parser.add_argument('--compile',
+                           action='store_true',
+                           default=False,
+                           dest='compile',
+                           help="Validates every device and profile config enabled in main.yaml and compiles them into "
+                                "'compiled.pyck' in the config directory which is used at startup while the configs "
+                                "are unchanged. Unknown keys are reported as errors.")
+
+    my_parser.add_argument('--simulate',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='simulate',
+                           metavar='SCENARIO',
+                           help="Runs PyController against the scripted devices and processes in the SCENARIO yaml "
+                                "file on a virtual clock and prints a report. No real devices are used.")
+
+    my_parser.add_argument('--benchmark',
+                           action='store',
+                           type=str,
+                           default='',
+                           dest='benchmark',
+                           choices=('monitor', 'memory'),
+                           help="Runs an offline benchmark and prints a report. 'monitor' polls the GameMonitor "
+                                "against synthetic process tables of up to 10000 processes and 500 profile executables "
+                                "and reports the CPU time per poll, the detection latency and the memory used. "
+                                "'memory' reports the steady state memory and open files of PyController and its game "
+                                "monitor with and without '--low-footprint'.")
+
     return my_parser.parse_args()
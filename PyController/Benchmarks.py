@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: Offline benchmarks used by the '--benchmark' flag. 'monitor' drives the GameMonitor and 'find_profile'
+#   against a synthetic psutil like process table with thousands of processes and hundreds of profile executables so
+#   scaling regressions in profile matching show up without any games installed. 'memory' sets PyController up against
+#   a synthetic /dev/input and reports what it and its game monitor keep resident once running, with and without the
+#   low footprint mode. Reports are JSON like '--simulate'.
+
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import psutil
+import queue
+import random
+import resource
+import statistics
+import tempfile
+import time
+import traceback
+import tracemalloc
+from evdev import ecodes
+from PyController.GameMonitor import GameMonitor
+from PyController.Simulation import SimulatedInputDevice, RecordingOutput, VirtualClock
+
+
+log = logging.getLogger('Benchmarks')
+
+
+# (processes, profile executables) for each run of the 'monitor' benchmark
+MONITOR_SIZES = ((500, 10), (2000, 100), (5000, 300), (10000, 500))
+# Input nodes of a desktop with a keyboard, mouse, headset, webcam, power buttons and audio jacks. One is the device.
+MEMORY_NODES = 40
+MEMORY_DEVICE = """--- !Device
+name: Pad
+vendorid: '1532'
+productid: '0111'
+type: 'EV_KEY'
+keys:
+  KEY_A: KEY_B
+"""
+MEMORY_PROFILE = """Game:
+  executable: not-a-running-game
+  default-keys:
+    KEY_A: KEY_C
+"""
+SYSTEM_DIRS = ('/usr/bin', '/usr/lib/systemd', '/usr/libexec', '/opt/google/chrome', '/usr/lib/firefox', '/snap/bin')
+
+
+class SyntheticProcess(object):
+    """
+        A psutil like process. Some are owned by root and deny reading their executable like real ones.
+    """
+
+    __slots__ = ('_exe', '_user', '_denied')
+
+    def __init__(self, exe, user='player', denied=False):
+        self._exe = exe
+        self._user = user
+        self._denied = denied
+
+    def exe(self):
+        if self._denied:
+            raise psutil.AccessDenied()
+        return self._exe
+
+    def name(self):
+        return self._exe.rsplit('/', 1)[-1][:15]
+
+    def username(self):
+        return self._user
+
+
+class SyntheticProcessTable(object):
+    """
+        A process table of 'size' system processes that games can be started in and stopped. Calling it is like
+        'psutil.process_iter'.
+    """
+
+    def __init__(self, size, seed=0):
+        super(SyntheticProcessTable, self).__init__()
+        rand = random.Random(seed)
+        self.processes = []
+        for index in range(size):
+            exe = f'{rand.choice(SYSTEM_DIRS)}/{rand.choice(("kworker", "python3", "bash", "chrome", "pipewire"))}' \
+                  f'-{index}'
+            denied = index % 7 == 0
+            self.processes.append(SyntheticProcess(exe, user='root' if denied else 'player', denied=denied))
+        self.games = []
+
+    def __call__(self):
+        yield from self.processes
+        yield from self.games
+
+    def start(self, exe):
+        self.games.append(SyntheticProcess(exe))
+
+    def stop(self):
+        self.games = []
+
+
+class SyntheticInputNode(SimulatedInputDevice):
+    """
+        An input node that holds an open file like an evdev InputDevice does. It never sends an event.
+    """
+
+    fd = -1
+
+    def __init__(self, clock, index, vendor, product):
+        super(SyntheticInputNode, self).__init__(clock, f'Synthetic Node {index}', vendor, product,
+                                                 script=[(86400.0, ecodes.EV_KEY, ecodes.KEY_A, 1)],
+                                                 path=f'/dev/input/event{index}', autosyn=False)
+        self.fd = os.open(os.devnull, os.O_RDONLY)
+
+    def close(self):
+        if self.fd > -1:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class SyntheticSettings(object):
+    """
+        Just enough of the SettingsManager for a GameMonitor: 'executables' profiles with one executable each.
+    """
+
+    seats = None
+    profilesConfig = None
+
+    def __init__(self, executables):
+        super(SyntheticSettings, self).__init__()
+        self.seats = {}
+        self.profilesConfig = {f'Game{index:04d}': {'executable': exe} for index, exe in enumerate(executables)}
+
+    @property
+    def games(self):
+        return {profile['executable'].lower() for profile in self.profilesConfig.values()}
+
+
+class SyntheticController(object):
+
+    settings = None
+    keymapper = None
+
+    def __init__(self, settings):
+        super(SyntheticController, self).__init__()
+        self.settings = settings
+
+
+def summarize(values, scale=1000.0):
+    """
+        The mean, median, 95th percentile and max of 'values' multiplied by 'scale'.
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'mean': round(statistics.mean(values) * scale, 3),
+            'p50': round(values[len(values) // 2] * scale, 3),
+            'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))] * scale, 3),
+            'max': round(values[-1] * scale, 3)}
+
+
+def benchmark_monitor(processes, executables, ticks=10, interval=5.0, seed=0, maxPolls=3):
+    """
+        Polls a GameMonitor 'ticks' times, one poll every 'interval' seconds of virtual time. Whenever no game is
+        running one is started at a random moment in the interval before the next poll and kept running until
+        'make_profile_active' arrives for it or 'maxPolls' polls went by. The detection latency is the virtual time
+        from the start of the game to the poll that detected it plus the time that poll took, so a game missed by its
+        first poll costs another interval. 'setupKiB' is the memory of the process table and GameMonitor,
+        'pollPeakKiB' what one poll allocates at most.
+    :param processes: int - How many processes are running.
+    :param executables: int - How many profile executables are configured.
+    :param ticks: int
+    :param interval: float - The seconds between polls of the GameMonitor.
+    :param maxPolls: int - The polls after which a game that was not detected counts as missed.
+    :return: dict
+    """
+    rand = random.Random(seed)
+    exes = [f'game{index:04d}.x86_64' for index in range(executables)]
+    tracemalloc.start()
+    table = SyntheticProcessTable(processes, seed=seed)
+    settings = SyntheticSettings(exes)
+    monitor = GameMonitor(SyntheticController(settings), processes=table)
+    setupSize, setupPeak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    messages = queue.SimpleQueue()
+
+    tickCpu, tickWall, latencies, polls = [], [], [], []
+    started = missed = 0
+    game = startedAt = None
+    gamePolls = 0
+    for tick in range(ticks):
+        now = tick * interval
+        if game is None:
+            game = rand.choice(exes)
+            startedAt = now - rand.uniform(0, interval)
+            gamePolls = 0
+            table.start(f'/opt/games/{game[:-7]}/bin/{game}')
+            started += 1
+        cpu, wall = time.process_time(), time.perf_counter()
+        monitor.poll(messages)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        tickCpu.append(cpu)
+        tickWall.append(wall)
+        gamePolls += 1
+        detected = False
+        while not messages.empty():
+            method, profile, seat = messages.get_nowait()
+            if method == 'make_profile_active' and settings.profilesConfig[profile]['executable'] == game:
+                detected = True
+        if detected:
+            latencies.append(now - startedAt + wall)
+            polls.append(gamePolls)
+        elif gamePolls >= maxPolls:
+            missed += 1
+        else:
+            continue
+        # The game quits, the poll that notices is not timed
+        table.stop()
+        game = None
+        monitor.poll(messages)
+        while not messages.empty():
+            messages.get_nowait()
+
+    hit = exes[-1]  # The last profile is the slowest to find
+    calls = 200
+    start = time.perf_counter()
+    for _ in range(calls):
+        monitor.find_profile(f'/opt/games/{hit}')
+    findHit = (time.perf_counter() - start) / calls
+    start = time.perf_counter()
+    for _ in range(calls):
+        monitor.find_profile('/usr/bin/not-a-game')
+    findMiss = (time.perf_counter() - start) / calls
+
+    tracemalloc.start()
+    monitor.poll(messages)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'processes': processes,
+            'executables': executables,
+            'ticks': ticks,
+            'tickCpuMs': summarize(tickCpu),
+            'tickWallMs': summarize(tickWall),
+            'detectionLatencyMs': summarize(latencies),
+            'detectionPolls': summarize(polls, scale=1),
+            'gamesStarted': started,
+            'gamesDetected': len(latencies),
+            'detectedAfterFirstPoll': sum(1 for count in polls if count > 1),
+            'gamesMissed': missed,
+            'findProfileUs': {'hit': round(findHit * 1000000, 3), 'miss': round(findMiss * 1000000, 3)},
+            'setupKiB': round(setupSize / 1024, 1),
+            'pollPeakKiB': round(peak / 1024, 1),
+            'maxRssKiB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_monitor_benchmark(sizes=MONITOR_SIZES, ticks=10, interval=5.0):
+    """
+        Runs 'benchmark_monitor' for every (processes, executables) in 'sizes'.
+    :return: dict - The report.
+    """
+    runs = []
+    for processes, executables in sizes:
+        log.info(f'Benchmarking the GameMonitor with {processes} processes and {executables} executables')
+        runs.append(benchmark_monitor(processes, executables, ticks=ticks, interval=interval))
+    return {'benchmark': 'monitor', 'interval': interval, 'runs': runs}
+
+
+def process_footprint(pid=None):
+    """
+        The resident, proportional and unique memory and the open files of a process. The proportional memory splits
+        the pages shared with other processes between them, so for PyController and its forked game monitor their sum
+        is what both take. The unique memory of a forked process is only what it wrote to since the fork.
+    :return: dict
+    """
+    process = psutil.Process(pid)
+    try:
+        memory = process.memory_full_info()
+    except psutil.Error:
+        memory = process.memory_info()
+    return {'rssKiB': memory.rss // 1024,
+            'pssKiB': getattr(memory, 'pss', 0) // 1024 or None,
+            'ussKiB': getattr(memory, 'uss', 0) // 1024 or None,
+            'fds': process.num_fds()}
+
+
+def benchmark_memory(lowFootprint, nodes=MEMORY_NODES, settle=1.0):
+    """
+        Sets a PyController with one device and one profile up against 'nodes' synthetic input nodes, runs it for
+        'settle' seconds and measures it and its game monitor process. The input devices stand in for /dev/input and
+        the outputs are RecordingOutputs so neither root nor uinput is needed.
+    :param lowFootprint: bool
+    :param nodes: int - How many input nodes there are, the first one is the device.
+    :param settle: float - Seconds PyController runs before it is measured.
+    :return: dict
+    """
+    # Imported here as PyController imports this module for the '--benchmark' flag
+    from PyController.PyController import PyController
+
+    clock = VirtualClock()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pyc = None
+    with tempfile.TemporaryDirectory() as configDir:
+        os.makedirs(os.path.join(configDir, 'devices.d'))
+        os.makedirs(os.path.join(configDir, 'profiles.d'))
+        with open(os.path.join(configDir, 'main.yaml'), 'w') as f:
+            f.write(f'main:\n  logging: False\n  lowFootprint: {lowFootprint}\n'
+                    f'devices:\n  - pad.yaml\nprofiles:\n  - game.yaml\n')
+        with open(os.path.join(configDir, 'devices.d', 'pad.yaml'), 'w') as f:
+            f.write(MEMORY_DEVICE)
+        with open(os.path.join(configDir, 'profiles.d', 'game.yaml'), 'w') as f:
+            f.write(MEMORY_PROFILE)
+        inputs = []
+
+        def open_inputs():
+            # Opened while the DeviceManager lists them like the ones under /dev/input
+            for index in range(nodes):
+                vendor, product = (0x1532, 0x0111) if index == 0 else (0x2000, 0x3000 + index)
+                inputs.append(SyntheticInputNode(clock, index, vendor, product))
+                yield inputs[-1]
+
+        arguments = argparse.Namespace(config='main.yaml', verbosity=0, profile_hotpath=0.0, control_socket='',
+                                       metrics_file='')
+        try:
+            pyc = PyController(arguments, config_dir=configDir, inputDevices=open_inputs(),
+                               uinput=lambda caps, name='benchmark_output': RecordingOutput(clock, caps, name=name))
+            # The same steps as 'main'
+            if pyc.settings.lowFootprint:
+                pyc.release_inputs()
+            pyc.start_game_monitor()
+            pyc.setup(loop, None)
+            loop.run_until_complete(asyncio.sleep(settle))
+            main, monitor = process_footprint(), process_footprint(pyc.gameMonitor.pid)
+            report = {'lowFootprint': lowFootprint,
+                      'nodes': nodes,
+                      'inputsOpen': sum(1 for node in inputs if node.fd > -1),
+                      'pyController': main,
+                      'gameMonitor': monitor,
+                      'totalPssKiB': (main['pssKiB'] or 0) + (monitor['pssKiB'] or 0),
+                      'totalFds': main['fds'] + monitor['fds']}
+        finally:
+            if pyc is not None and pyc.gameMonitor is not None:
+                pyc.gameMonitor.terminate()
+                pyc.gameMonitor.join()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            if pyc is not None:
+                pyc.shutdown()
+            loop.close()
+            asyncio.set_event_loop(None)
+    return report
+
+
+def _memory_run(results, lowFootprint, nodes, settle):
+    try:
+        results.put(benchmark_memory(lowFootprint, nodes=nodes, settle=settle))
+    except Exception as e:
+        log.error(f'Error in the memory benchmark: {e}')
+        log.debug(f'[DEBUG] for _memory_run: {traceback.format_exc()}')
+        results.put({'lowFootprint': lowFootprint, 'error': str(e)})
+
+
+def run_memory_benchmark(nodes=MEMORY_NODES, settle=1.0):
+    """
+        Runs 'benchmark_memory' without and with the low footprint mode. Each run is made in a new forked process so
+        both start from the same memory and open files.
+    :return: dict - The report.
+    """
+    context = multiprocessing.get_context('fork')
+    runs = []
+    for lowFootprint in (False, True):
+        log.info(f'Benchmarking the memory of PyController with {nodes} input nodes and lowFootprint: {lowFootprint}')
+        results = context.SimpleQueue()
+        process = context.Process(target=_memory_run, args=(results, lowFootprint, nodes, settle))
+        process.start()
+        runs.append(results.get())
+        process.join()
+    return {'benchmark': 'memory', 'baseline': process_footprint(), 'runs': runs}
+
+
+BENCHMARKS = {'monitor': run_monitor_benchmark, 'memory': run_memory_benchmark}
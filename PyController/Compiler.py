@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package validates the device and profile configs and compiles them into a single binary file used
+#   by the '--compile' flag. Every key name is resolved to its code at compile time so a typo is reported instead of
+#   being skipped with a warning at runtime. At startup the compiled file is memory mapped and its key tables are
+#   copied straight into the KeyMapper without any YAML parsing or name lookups. The file is only used while none of
+#   the configs it was compiled from have changed.
+
+
+import json
+import logging
+import mmap
+import os
+import struct
+from evdev import ecodes
+from PyController.KeyTables import TABLE_SIZE
+from PyController.RelMap import RelMapper
+
+
+log = logging.getLogger('Compiler')
+
+
+MAGIC = b'PYCK'
+VERSION = 2
+HEADER = struct.Struct('<4sII')  # magic, version, length of the JSON metadata
+DEVICE_FIELDS = ('name', 'vendorid', 'productid', 'type', 'fullname', 'phys', 'output', 'keys', 'relscale',
+                 'coalesce', 'turbo', 'repeat', 'repeatdelay', 'emulation', 'debounce', 'dropscan', 'offload')
+
+
+def source_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class ConfigCompiler(object):
+    """
+        Validates everything enabled in main.yaml and builds the compiled file. Problems that would stop a key from
+        being mapped are errors and nothing is written while there are any.
+    """
+
+    settings = None
+    errors = None
+    warnings = None
+    tables = None
+    devices = None
+    profiles = None
+    sources = None
+
+    def __init__(self, settings):
+        """
+        :param settings: SettingsManager object
+        """
+        super(ConfigCompiler, self).__init__()
+        self.settings = settings
+
+    def compile(self):
+        """
+            Loads and validates every device and profile config.
+        :return: bool - True if there were no errors.
+        """
+        self.errors = []
+        self.warnings = []
+        self.tables = []
+        self.devices = []
+        self.profiles = {}
+        self.sources = {}
+
+        for config in self.settings.devices:
+            path = self.settings.config_path(config, device=True)
+            self.sources[path] = source_stamp(path)
+            try:
+                device = self.settings.load_yaml(config, device=True)
+            except Exception as e:
+                self.errors.append(f'{config}: unable to load: {e}')
+                continue
+            self.compile_device(config, device)
+
+        deviceNames = {device['name'] for device in self.devices}
+        for config in self.settings.profiles:
+            path = self.settings.config_path(config, profile=True)
+            self.sources[path] = source_stamp(path)
+            try:
+                profiles = self.settings.load_yaml(config, profile=True)
+            except Exception as e:
+                self.errors.append(f'{config}: unable to load: {e}')
+                continue
+            if not isinstance(profiles, dict):
+                self.errors.append(f'{config}: a profile config has to be a mapping of profile names')
+                continue
+            for name, profile in profiles.items():
+                self.compile_profile(config, str(name), profile, deviceNames)
+        return not self.errors
+
+    def compile_device(self, config, device):
+        where = f'{config}'
+        fields = {field: getattr(device, field, None) for field in DEVICE_FIELDS}
+        if not fields['name'] or ' ' in str(fields['name']):
+            self.errors.append(f"{where}: 'name' is required and can not have spaces")
+            return
+        fields['name'] = str(fields['name'])
+        where = f"{config} [{fields['name']}]"
+        for field in ('vendorid', 'productid'):
+            try:
+                int(str(fields[field]), 16)
+            except (TypeError, ValueError):
+                self.errors.append(f"{where}: '{field}' has to be a hex ID such as '1532'")
+            fields[field] = str(fields[field])
+        if fields['type'] is not None and str(fields['type']).upper() not in ('EV_KEY', 'EV_BUTTON'):
+            self.warnings.append(f"{where}: unknown 'type' {fields['type']}, EV_KEY is used")
+        for field in ('keys', 'relscale', 'turbo', 'repeat', 'emulation'):
+            if fields[field] is not None and not isinstance(fields[field], dict):
+                self.errors.append(f"{where}: '{field}' has to be a mapping")
+                fields[field] = None
+        if any(device['name'] == fields['name'] for device in self.devices):
+            self.errors.append(f"{where}: another device already uses the name {fields['name']}")
+
+        keys = {inputKey: mapKey for inputKey, mapKey in (fields['keys'] or {}).items()
+                if not RelMapper.is_rel_pair(inputKey, mapKey)}
+        for inputKey, mapKey in (fields['keys'] or {}).items():
+            if RelMapper.is_rel_pair(inputKey, mapKey) and RelMapper.parse_pair(inputKey, mapKey) is None:
+                self.errors.append(f'{where}: invalid relative mapping {inputKey}: {mapKey}')
+        for relName in (fields['relscale'] or {}):
+            if not str(relName).startswith('REL_') or not hasattr(ecodes, str(relName)):
+                self.errors.append(f"{where}: unknown axis in 'relscale': {relName}")
+        self.check_rates(where, fields['turbo'], fields['repeat'])
+        self.check_emulation(where, fields['emulation'])
+        for field in ('repeatdelay', 'debounce'):
+            if fields[field] is not None:
+                try:
+                    float(fields[field])
+                except (TypeError, ValueError):
+                    self.errors.append(f"{where}: '{field}' has to be a number")
+        fields['table'] = self.add_table(where, keys)
+        fields['config'] = config
+        self.devices.append(fields)
+
+    def compile_profile(self, config, name, profile, deviceNames):
+        where = f'{config} [{name}]'
+        if not isinstance(profile, dict):
+            self.errors.append(f'{where}: a profile has to be a mapping')
+            return
+        profile = self.settings.normalize_profile(profile, warnings=self.warnings, where=where)
+        if not profile.get('executable'):
+            self.errors.append(f"{where}: 'executable' is required")
+        profile['table'] = self.add_table(where, profile.get('default-keys'))
+        self.check_rates(where, profile.get('turbo'), profile.get('repeat'))
+        for device in profile.get('devices', []):
+            deviceWhere = f"{where} [{device.get('name')}]"
+            if device.get('name') not in deviceNames:
+                self.warnings.append(f"{deviceWhere}: no enabled device is named {device.get('name')}")
+            device['table'] = self.add_table(deviceWhere, device.get('keys'))
+            self.check_rates(deviceWhere, device.get('turbo'), device.get('repeat'))
+        self.profiles[name] = profile
+
+    def add_table(self, where, keys):
+        """
+            Resolves the key pairs into a dense table and stores it.
+        :return: int - The index of the table in the compiled file.
+        """
+        table = [0] * TABLE_SIZE
+        for inputKey, mapKey in (keys or {}).items():
+            codes = [getattr(ecodes, str(key), None) for key in (inputKey, mapKey)]
+            for key, code in zip((inputKey, mapKey), codes):
+                if not isinstance(code, int):
+                    self.errors.append(f'{where}: unknown key {key}')
+                elif not 0 < code < TABLE_SIZE:
+                    self.errors.append(f'{where}: {key} can not be mapped')
+            if all(isinstance(code, int) and 0 < code < TABLE_SIZE for code in codes):
+                table[codes[0]] = codes[1]
+        self.tables.append(table)
+        return len(self.tables) - 1
+
+    def check_rates(self, where, turbo, repeat):
+        for field, rates in (('turbo', turbo), ('repeat', repeat)):
+            for key, hz in (rates or {}).items():
+                if not isinstance(getattr(ecodes, str(key), None), int):
+                    self.errors.append(f"{where}: unknown key in '{field}': {key}")
+                try:
+                    if float(hz) < 0:
+                        raise ValueError(hz)
+                except (TypeError, ValueError):
+                    self.errors.append(f"{where}: the '{field}' rate of {key} has to be a positive number")
+
+    def check_emulation(self, where, emulation):
+        for axisName, axis in ((emulation or {}).get('axes') or {}).items():
+            if not str(axisName).startswith('ABS_') or not hasattr(ecodes, str(axisName)):
+                self.errors.append(f'{where}: unknown emulation axis {axisName}')
+            if not isinstance(axis, dict):
+                self.errors.append(f'{where}: the emulation axis {axisName} has to be a mapping')
+                continue
+            for field in ('negative', 'positive', 'mouse'):
+                if field in axis and not isinstance(getattr(ecodes, str(axis[field]), None), int):
+                    self.errors.append(f'{where}: unknown {field} key {axis[field]} for emulation axis {axisName}')
+
+    def write(self, path):
+        """
+            Writes the compiled file. The JSON metadata is followed by the tables as native unsigned shorts aligned to
+            8 bytes.
+        :param path: str
+        :return: int - The size of the file in bytes.
+        """
+        metadata = json.dumps({'tableSize': TABLE_SIZE,
+                               'sources': self.sources,
+                               'devices': self.devices,
+                               'profiles': self.profiles}).encode('utf-8')
+        offset = HEADER.size + len(metadata)
+        padding = b'\0' * (-offset % 8)
+        tmpPath = f'{path}.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+            f.write(metadata)
+            f.write(padding)
+            for table in self.tables:
+                f.write(struct.pack(f'={TABLE_SIZE}H', *table))
+            size = f.tell()
+        os.replace(tmpPath, path)
+        return size
+
+
+class CompiledConfig(object):
+    """
+        A compiled file memory mapped for reading. The key tables are memoryviews straight into the map.
+    """
+
+    path = None
+    devices = None
+    profiles = None
+    sources = None
+
+    _file = None
+    _map = None
+    _tables = None
+
+    def __init__(self, path):
+        super(CompiledConfig, self).__init__()
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, length = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{path} is not a compiled config of version {VERSION}')
+            metadata = json.loads(self._map[HEADER.size:HEADER.size + length].decode('utf-8'))
+            if metadata['tableSize'] != TABLE_SIZE:
+                raise ValueError(f'{path} was compiled with a different version of evdev')
+            offset = HEADER.size + length
+            offset += -offset % 8
+            self._tables = memoryview(self._map)[offset:].cast('H')
+        except Exception:
+            self.close()
+            raise
+        self.devices = metadata['devices']
+        self.profiles = metadata['profiles']
+        self.sources = metadata['sources']
+
+    def fresh(self, settings):
+        """
+            True if the configs enabled in main.yaml are the ones compiled and none of them have changed since.
+        :param settings: SettingsManager object
+        :return: bool
+        """
+        paths = [settings.config_path(config, device=True) for config in settings.devices] + \
+                [settings.config_path(config, profile=True) for config in settings.profiles]
+        return set(paths) == set(self.sources) and all(source_stamp(path) == self.sources[path] for path in paths)
+
+    def table(self, index):
+        return self._tables[index * TABLE_SIZE:(index + 1) * TABLE_SIZE]
+
+    def device(self, name):
+        for device in self.devices:
+            if device['name'] == name:
+                return device
+        return None
+
+    def close(self):
+        if self._tables is not None:
+            self._tables.release()
+            self._tables = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: A small UNIX socket API served by the asyncio loop that allows a running PyController to be inspected
+#   and controlled. Every message is a 4 byte big endian length followed by a utf-8 JSON document. Requests look like
+#   {"command": "switch", "args": ["RTS"]} and responses look like {"ok": true, "result": ...}.
+
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import traceback
+from evdev import ecodes
+from PyController.Metrics import render_metrics
+from PyController.SettingsManager import defaultSeat
+
+
+log = logging.getLogger('ControlServer')
+
+
+LENGTH = struct.Struct('>I')
+MAX_MESSAGE = 65536
+
+
+def encode_message(message):
+    data = json.dumps(message).encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+
+def decode_length(header):
+    length = LENGTH.unpack(header)[0]
+    if length > MAX_MESSAGE:
+        raise ValueError(f'Control message is too large: {length}')
+    return length
+
+
+def code_name(code, codeType=ecodes.EV_KEY):
+    name = ecodes.bytype.get(codeType, {}).get(code, str(code))
+    return name[0] if isinstance(name, (list, tuple)) else name
+
+
+class ControlServer(object):
+    """
+        Serves the control API on a UNIX socket. Each command is handled by a 'command_<name>' method which is given
+        the list of arguments from the request and returns something that can be turned into JSON, or a coroutine
+        that does. Commands that change a threaded seat await it so a request never blocks the device workers.
+    """
+
+    pyc = None
+    path = None
+    server = None
+
+    def __init__(self, pyc, path):
+        """
+        :param pyc: PyController object
+        :param path: str - The location of the UNIX socket.
+        """
+        super(ControlServer, self).__init__()
+        self.pyc = pyc
+        self.path = path
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        log.info(f'Starting control socket at: {self.path}')
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            log.info('Closing control socket')
+            self.server.close()
+            self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(LENGTH.size)
+                except asyncio.IncompleteReadError:
+                    break
+                request = json.loads((await reader.readexactly(decode_length(header))).decode('utf-8'))
+                writer.write(encode_message(await self.dispatch(request)))
+                await writer.drain()
+        except Exception as e:
+            log.error(f'Error in the control socket client: {e}')
+            log.debug(f'[DEBUG] for the control socket client: {traceback.format_exc()}')
+        finally:
+            writer.close()
+
+    async def dispatch(self, request):
+        """
+            Runs the command found in the request and wraps the result or error in a response.
+        :param request: dict
+        :return: dict
+        """
+        command = request.get('command', '') if isinstance(request, dict) else ''
+        method = getattr(self, f'command_{command}', None)
+        if method is None:
+            return {'ok': False, 'error': f'Unknown command: {command}'}
+        try:
+            result = method(*(request.get('args') or []))
+            if asyncio.iscoroutine(result):
+                result = await result
+            return {'ok': True, 'result': result}
+        except Exception as e:
+            log.debug(f'[DEBUG] for control command {command}: {traceback.format_exc()}')
+            return {'ok': False, 'error': str(e)}
+
+    def seat(self, seatName=None):
+        seat = self.pyc.seats.get(seatName or defaultSeat)
+        if seat is None:
+            raise ValueError(f'Unknown seat: {seatName}')
+        return seat
+
+    def command_help(self):
+        return sorted(name[len('command_'):] for name in dir(self) if name.startswith('command_'))
+
+    def command_devices(self):
+        return [device for seat in self.pyc.seats.values() for device in seat.devManager.as_dict()]
+
+    def command_outputs(self):
+        return self.pyc.outputs.as_dict()
+
+    def command_seats(self):
+        return [seat.as_dict() for seat in self.pyc.seats.values()]
+
+    def command_profile(self, seatName=None):
+        keymapper = self.seat(seatName).keymapper
+        return {'active': keymapper.activeProfile,
+                'profiles': sorted(keymapper.profileKeyMap)}
+
+    def command_keymap(self, deviceName=None, seatName=None):
+        keymapper = self.seat(seatName).keymapper
+        if deviceName is not None and seatName is None:
+            keymapper = next((seat.keymapper for seat in self.pyc.seats.values()
+                              if deviceName in seat.keymapper.deviceKeyMap), keymapper)
+        devices = {}
+        for name, record in keymapper.deviceKeyMap.items():
+            if deviceName is not None and name != deviceName:
+                continue
+            devices[name] = {code_name(code): code_name(mapped) for code, mapped in enumerate(record.active) if mapped}
+        return {'profile': keymapper.activeProfile, 'generation': keymapper.tables.generation, 'devices': devices}
+
+    async def command_switch(self, profileName=None, seatName=None):
+        """
+            Makes the profile active or deactivates the active profile when no profile name is given. The profile of
+            the devices that are not in a seat is changed unless a seat is given.
+        """
+        seat = self.seat(seatName)
+        keymapper = seat.keymapper
+        if profileName is None:
+            await seat.call_async('deactivate_profile', keymapper.activeProfile)
+        elif profileName not in keymapper.profileKeyMap:
+            raise ValueError(f'Unknown profile: {profileName}')
+        else:
+            await seat.call_async('make_profile_active', profileName)
+        return keymapper.activeProfile
+
+    def command_stats(self):
+        return {'devices': {device['name']: device['stats'] for device in self.command_devices()},
+                'timers': self.pyc.keymapper.timers.stats.as_dict(),
+                'seats': {name: {'profile': seat.keymapper.activeProfile,
+                                 'timers': seat.keymapper.timers.stats.as_dict()}
+                          for name, seat in self.pyc.seats.items()}}
+
+    def command_metrics(self):
+        return render_metrics(self.pyc)
+
+    async def command_reload(self):
+        return await self.pyc.reload_keymaps()
+
+    def command_dump(self, reason='control command'):
+        if self.pyc.flightRecorder is None:
+            raise ValueError("The flight recorder is not enabled, set 'flightRecorder' in main.yaml")
+        return self.pyc.dump_flight_recorder(reason)
+
+
+def send_command(path, command, *args, timeout=2.0):
+    """
+        A small blocking client for the control socket. This is what the '--control' flag uses and it can be used by
+        launcher scripts.
+    :param path: str - The location of the UNIX socket.
+    :param command: str
+    :param args: The arguments for the command.
+    :param timeout: float
+    :return: dict - The response.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(encode_message({'command': command, 'args': list(args)}))
+        length = decode_length(_recv_exactly(sock, LENGTH.size))
+        return json.loads(_recv_exactly(sock, length).decode('utf-8'))
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('The control socket closed the connection')
+        data += chunk
+    return data
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package lets a game pad emulate a keyboard and mouse. Buttons are mapped with the normal 'keys'
+#   config, analog axes (sticks, triggers and the d-pad hat) are configured under 'emulation' in the device's yaml
+#   config. Axes that press keys are handled as soon as the event arrives. Axes that move the mouse only store their
+#   position and are integrated on a fixed rate tick so the mouse output rate does not depend on the pad's input rate.
+
+
+import asyncio
+import logging
+import os
+import traceback
+from array import array
+from evdev import InputEvent, ecodes
+from PyController.RelMap import EVENT, SYN_REPORT
+
+
+log = logging.getLogger('Emulation')
+
+
+MODE_NONE = 0
+MODE_KEYS = 1
+MODE_MOUSE = 2
+TRIGGERS = (ecodes.ABS_Z, ecodes.ABS_RZ, ecodes.ABS_GAS, ecodes.ABS_BRAKE)
+
+
+class GamepadEmulator(object):
+    """
+        Emulates a keyboard and mouse from the analog axes of a game pad. Example config:
+            emulation:
+              rate: 125          # How many times a second the mouse motion is written
+              deadzone: 0.15     # Fraction of the axis around the center that is ignored
+              axes:
+                ABS_X: {negative: KEY_A, positive: KEY_D, threshold: 0.5}
+                ABS_Y: {negative: KEY_W, positive: KEY_S}
+                ABS_RX: {mouse: REL_X, speed: 1200}   # Pixels per second at full deflection
+                ABS_RY: {mouse: REL_Y, speed: 1200}
+                ABS_Z: {positive: BTN_RIGHT}          # Triggers are pressed past the threshold
+                ABS_RZ: {positive: BTN_LEFT}
+    """
+
+    rate = 125.0
+    deadzone = 0.15
+    fd = None
+    drain = None
+    loop = None
+    keyTargets = None
+    relTargets = None
+    ticks = 0
+
+    _mode = None
+    _negative = None
+    _positive = None
+    _threshold = None
+    _mouse = None
+    _speed = None
+    _minimum = None
+    _span = None
+    _centered = None
+    _values = None
+    _states = None
+    _remainder = None
+    _mouseAxes = None
+    _handle = None
+    _next = None
+
+    def __init__(self, config, absinfo=None):
+        """
+        :param config: dict - The 'emulation' section of a device's yaml config.
+        :param absinfo: callable - Returns the evdev AbsInfo of an axis code, used to normalize the axis.
+        """
+        super(GamepadEmulator, self).__init__()
+        self.load(config, absinfo)
+
+    def load(self, config, absinfo=None):
+        """
+            (Re)builds the axes from the config. This happens in place so a running worker picks up the change.
+        :return: None
+        """
+        config = config if isinstance(config, dict) else {}
+        self.rate = float(config.get('rate', 125) or 125)
+        self.deadzone = min(0.95, max(0.0, float(config.get('deadzone', 0.15) or 0.0)))
+        self.keyTargets = set()
+        self.relTargets = set()
+        self._mode = bytearray(ecodes.ABS_CNT)
+        self._negative = array('H', bytes(ecodes.ABS_CNT * 2))
+        self._positive = array('H', bytes(ecodes.ABS_CNT * 2))
+        self._threshold = array('d', [0.5] * ecodes.ABS_CNT)
+        self._mouse = array('H', bytes(ecodes.ABS_CNT * 2))
+        self._speed = array('d', bytes(ecodes.ABS_CNT * 8))
+        self._minimum = array('d', [-1.0] * ecodes.ABS_CNT)
+        self._span = array('d', [2.0] * ecodes.ABS_CNT)
+        self._centered = bytearray([1] * ecodes.ABS_CNT)
+        self._values = array('d', bytes(ecodes.ABS_CNT * 8))
+        self._states = array('b', bytes(ecodes.ABS_CNT))
+        self._remainder = array('d', bytes(ecodes.REL_CNT * 8))
+        self._mouseAxes = []
+
+        for axisName, axis in (config.get('axes') or {}).items():
+            code = getattr(ecodes, str(axisName), None)
+            if not isinstance(code, int) or not str(axisName).startswith('ABS_') or not isinstance(axis, dict):
+                log.warning(f'The emulation config for axis: {axisName} failed validation.')
+                continue
+            info = GamepadEmulator._absinfo(absinfo, code)
+            if info is not None and info.max > info.min:
+                self._minimum[code] = info.min
+                self._span[code] = info.max - info.min
+            self._centered[code] = 1 if axis.get('centered', info is None or info.min < 0 or code not in TRIGGERS) \
+                else 0
+            if 'mouse' in axis:
+                rel = getattr(ecodes, str(axis['mouse']), None)
+                if not isinstance(rel, int) or not str(axis['mouse']).startswith('REL_'):
+                    log.warning(f'The mouse axis: {axis["mouse"]} for axis: {axisName} failed validation.')
+                    continue
+                self._mode[code] = MODE_MOUSE
+                self._mouse[code] = rel
+                self._speed[code] = float(axis.get('speed', 1000))
+                self._mouseAxes.append(code)
+                self.relTargets.add(rel)
+                continue
+            for direction, table in (('negative', self._negative), ('positive', self._positive)):
+                if direction not in axis:
+                    continue
+                key = getattr(ecodes, str(axis[direction]), None)
+                if not isinstance(key, int) or key >= ecodes.KEY_CNT:
+                    log.warning(f'The {direction} key: {axis[direction]} for axis: {axisName} failed validation.')
+                    continue
+                table[code] = key
+                self.keyTargets.add(key)
+                self._mode[code] = MODE_KEYS
+            self._threshold[code] = float(axis.get('threshold', 0.5))
+
+    @property
+    def configured(self):
+        return any(self._mode)
+
+    def start(self, fd, loop=None, drain=None):
+        """
+            Sets where the mouse motion is written to. The tick only runs while a mouse axis is outside the deadzone.
+        :param fd: int - The file descriptor of the UInput device.
+        :param loop: asyncio loop
+        :param drain: callable - Called after each frame written to 'fd' by outputs that read 'fd' back on the loop,
+            so the frame is sent before any event written after it.
+        :return: None
+        """
+        self.fd = fd
+        self.loop = loop
+        self.drain = drain
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def handles(self, event):
+        return event.type == ecodes.EV_ABS and event.code < ecodes.ABS_CNT and self._mode[event.code] != MODE_NONE
+
+    def map_event(self, event):
+        """
+            Stores the position of the axis and returns any key presses or releases caused by it crossing its
+            threshold.
+        :param event: InputEvent object
+        :return: tuple of InputEvent objects
+        """
+        code = event.code
+        value = (event.value - self._minimum[code]) / self._span[code]
+        if self._centered[code]:
+            value = (value * 2.0) - 1.0
+        self._values[code] = value
+
+        if self._mode[code] == MODE_MOUSE:
+            if self._handle is None and abs(value) > self.deadzone:
+                self._start_tick()
+            return ()
+
+        threshold = self._threshold[code]
+        state = self._states[code]
+        if value >= threshold:
+            newState = 1
+        elif value <= -threshold:
+            newState = -1
+        elif abs(value) < threshold * 0.8:  # A little hysteresis so a key does not chatter at the threshold
+            newState = 0
+        else:
+            newState = state
+        if newState == state:
+            return ()
+        self._states[code] = newState
+        events = []
+        oldKey = self._positive[code] if state > 0 else self._negative[code] if state < 0 else 0
+        newKey = self._positive[code] if newState > 0 else self._negative[code] if newState < 0 else 0
+        if oldKey:
+            events.append(InputEvent(event.sec, event.usec, ecodes.EV_KEY, oldKey, 0))
+        if newKey:
+            events.append(InputEvent(event.sec, event.usec, ecodes.EV_KEY, newKey, 1))
+        return events
+
+    def tick(self, dt):
+        """
+            Integrates the position of every mouse axis over 'dt' seconds and writes all the motion in one frame.
+        :param dt: float
+        :return: bool - True if any mouse axis is still outside the deadzone.
+        """
+        deadzone = self.deadzone
+        moving = False
+        motion = {}
+        for code in self._mouseAxes:
+            value = self._values[code]
+            if abs(value) <= deadzone:
+                continue
+            moving = True
+            scaled = (abs(value) - deadzone) / (1.0 - deadzone)
+            rel = self._mouse[code]
+            delta = (scaled if value > 0 else -scaled) * self._speed[code] * dt + self._remainder[rel]
+            whole = int(delta)
+            self._remainder[rel] = delta - whole
+            if whole:
+                motion[rel] = motion.get(rel, 0) + whole
+        if motion:
+            os.write(self.fd, b''.join([EVENT.pack(0, 0, ecodes.EV_REL, rel, value)
+                                        for rel, value in motion.items()] + [SYN_REPORT]))
+            if self.drain is not None:
+                self.drain()
+        self.ticks += 1
+        return moving
+
+    def _start_tick(self):
+        if self.fd is None:
+            return
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self._next = self.loop.time() + (1.0 / self.rate)
+        self._handle = self.loop.call_at(self._next, self._tick)
+
+    def _tick(self):
+        period = 1.0 / self.rate
+        try:
+            moving = self.tick(period)
+        except Exception as e:
+            log.error(f'Error in the emulation tick: {e}')
+            log.debug(f'[DEBUG] for the emulation tick: {traceback.format_exc()}')
+            moving = False
+        if not moving:
+            self._handle = None
+            for rel in range(ecodes.REL_CNT):
+                self._remainder[rel] = 0.0
+            return
+        # Scheduled against the ideal time so the rate does not drift with the time spent in the tick.
+        self._next = max(self._next + period, self.loop.time())
+        self._handle = self.loop.call_at(self._next, self._tick)
+
+    @staticmethod
+    def _absinfo(absinfo, code):
+        if absinfo is None:
+            return None
+        try:
+            return absinfo(code)
+        except Exception:
+            return None
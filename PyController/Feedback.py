@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package forwards what a game writes to an output device back to the physical devices behind it.
+#   Force feedback (rumble) effects uploaded to the output are uploaded to the input devices that support them and LED
+#   writes (IE: caps lock) are passed on so a remapped controller behaves like the real one.
+
+
+import asyncio
+import ctypes
+import fcntl
+import logging
+import os
+import traceback
+from evdev import ecodes, ff
+from PyController.RelMap import EVENT
+
+
+log = logging.getLogger('Feedback')
+
+
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('U') << 8) | number
+
+
+UI_BEGIN_FF_UPLOAD = _ioc(3, 200, ctypes.sizeof(ff.UInputUpload))
+UI_END_FF_UPLOAD = _ioc(1, 201, ctypes.sizeof(ff.UInputUpload))
+UI_BEGIN_FF_ERASE = _ioc(3, 202, ctypes.sizeof(ff.UInputErase))
+UI_END_FF_ERASE = _ioc(1, 203, ctypes.sizeof(ff.UInputErase))
+READ_SIZE = EVENT.size * 64
+
+
+class FeedbackStats(object):
+
+    __slots__ = ('uploads', 'cached', 'erased', 'played', 'leds', 'errors')
+
+    def __init__(self):
+        self.uploads = 0
+        self.cached = 0
+        self.erased = 0
+        self.played = 0
+        self.leds = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class FeedbackForwarder(object):
+    """
+        Reads an output device on the asyncio loop and forwards EV_FF and EV_LED to its targets, the input devices of
+        the Devices writing to the output. The ids of uploaded effects are cached: the output's effect id maps to the
+        id on each target along with the effect's parameters. A game uploading the same effect again, which many do
+        before every rumble, is answered without touching the physical device and a changed effect updates the effect
+        in place instead of using up another slot.
+    """
+
+    output = None
+    fd = None
+    targets = None
+    effects = None
+    stats = None
+    loop = None
+
+    def __init__(self, output):
+        """
+        :param output: UInput or RemoteOutput object
+        """
+        super(FeedbackForwarder, self).__init__()
+        self.output = output
+        self.fd = output.fd
+        self.targets = []
+        self.effects = {}
+        self.stats = FeedbackStats()
+
+    def add_target(self, evdevice):
+        if evdevice not in self.targets:
+            self.targets.append(evdevice)
+
+    def remove_target(self, evdevice):
+        """
+            Stops forwarding to an input device and erases the effects that were uploaded to it so the slots on the
+            device are freed and no effect is played on it after it is closed.
+        """
+        if evdevice in self.targets:
+            self.targets.remove(evdevice)
+        for effectId, (parameters, targets, ids) in list(self.effects.items()):
+            if evdevice not in targets:
+                continue
+            index = targets.index(evdevice)
+            self.erase_target_effect(evdevice, ids[index])
+            self.effects[effectId] = (parameters, targets[:index] + targets[index + 1:], ids[:index] + ids[index + 1:])
+
+    @property
+    def ffTargets(self):
+        return [target for target in self.targets if target.capabilities(absinfo=False).get(ecodes.EV_FF)]
+
+    def start(self, loop=None):
+        """
+            Starts reading the output on the loop. Calling it again is harmless.
+        :param loop: asyncio loop
+        :return: None
+        """
+        if self.loop is not None or self.fd is None:
+            return
+        self.loop = loop or asyncio.get_event_loop()
+        self.loop.add_reader(self.fd, self.read)
+        log.info(f'Forwarding force feedback and LEDs from: {self.output}')
+
+    def stop(self):
+        """
+            Stops reading and erases the effects uploaded to the targets.
+        :return: None
+        """
+        if self.loop is not None:
+            if not self.loop.is_closed():
+                self.loop.remove_reader(self.fd)
+            self.loop = None
+        for effectId in list(self.effects):
+            self.erase_effect(effectId)
+
+    def read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.error(f'Unable to read feedback from: {self.output}: {e}')
+            self.stats.errors += 1
+            if self.loop is not None:
+                self.loop.remove_reader(self.fd)
+                self.loop = None
+            return
+        for offset in range(0, len(data) - EVENT.size + 1, EVENT.size):
+            sec, usec, evType, code, value = EVENT.unpack_from(data, offset)
+            try:
+                self.handle(evType, code, value)
+            except Exception as e:
+                self.stats.errors += 1
+                log.error(f'Error forwarding feedback from: {self.output}: {e}')
+                log.debug(f'[DEBUG] for FeedbackForwarder: {traceback.format_exc()}')
+
+    def handle(self, evType, code, value):
+        """
+            Handles one event read from the output.
+        """
+        if evType == ecodes.EV_LED:
+            self.stats.leds += 1
+            for target in self.targets:
+                if code in target.capabilities(absinfo=False).get(ecodes.EV_LED, ()):
+                    target.write(ecodes.EV_LED, code, value)
+        elif evType == ecodes.EV_FF:
+            if code in (ecodes.FF_GAIN, ecodes.FF_AUTOCENTER):
+                for target in self.ffTargets:
+                    target.write(ecodes.EV_FF, code, value)
+                return
+            effect = self.effects.get(code)
+            if effect is None:
+                return
+            self.stats.played += 1
+            for target, effectId in zip(effect[1], effect[2]):
+                target.write(ecodes.EV_FF, effectId, value)
+        elif evType == ecodes.EV_UINPUT:
+            if code == ecodes.UI_FF_UPLOAD:
+                self.upload(value)
+            elif code == ecodes.UI_FF_ERASE:
+                self.erase(value)
+
+    def upload(self, requestId):
+        """
+            Answers an effect upload made by a game. The effect is uploaded to the targets unless it is unchanged.
+        :param requestId: int
+        :return: None
+        """
+        upload = ff.UInputUpload()
+        upload.request_id = requestId
+        fcntl.ioctl(self.fd, UI_BEGIN_FF_UPLOAD, upload)
+        try:
+            effect = upload.effect
+            raw = bytes(effect)
+            parameters = raw[:2] + raw[4:]  # Everything but the id
+            cached = self.effects.get(effect.id)
+            if cached is not None and cached[0] == parameters:
+                self.stats.cached += 1
+            else:
+                targets = cached[1] if cached is not None else self.ffTargets
+                ids = []
+                try:
+                    for index, target in enumerate(targets):
+                        copy = ff.Effect.from_buffer_copy(raw)
+                        copy.id = cached[2][index] if cached is not None else -1
+                        ids.append(target.upload_effect(copy))
+                except OSError:
+                    if cached is None:
+                        # A new effect is erased from the targets it already reached
+                        for target, targetId in zip(targets, ids):
+                            self.erase_target_effect(target, targetId)
+                    else:
+                        # An updated effect keeps its ids but is uploaded again next time
+                        self.effects[effect.id] = (None, cached[1], cached[2])
+                    raise
+                self.effects[effect.id] = (parameters, targets, ids)
+                self.stats.uploads += 1
+            upload.retval = 0
+        except OSError as e:
+            log.error(f'Unable to upload a force feedback effect from: {self.output}: {e}')
+            self.stats.errors += 1
+            upload.retval = -(e.errno or 1)
+        finally:
+            fcntl.ioctl(self.fd, UI_END_FF_UPLOAD, upload)
+
+    def erase(self, requestId):
+        erase = ff.UInputErase()
+        erase.request_id = requestId
+        fcntl.ioctl(self.fd, UI_BEGIN_FF_ERASE, erase)
+        try:
+            self.erase_effect(erase.effect_id)
+            erase.retval = 0
+        finally:
+            fcntl.ioctl(self.fd, UI_END_FF_ERASE, erase)
+
+    def erase_effect(self, effectId):
+        cached = self.effects.pop(effectId, None)
+        if cached is None:
+            return
+        self.stats.erased += 1
+        for target, targetId in zip(cached[1], cached[2]):
+            self.erase_target_effect(target, targetId)
+
+    def erase_target_effect(self, target, targetId):
+        try:
+            target.erase_effect(targetId)
+        except OSError as e:
+            log.warning(f'Unable to erase a force feedback effect from: {target}: {e}')
+
+    def as_dict(self):
+        return dict(self.stats.as_dict(), targets=[getattr(target, 'path', str(target)) for target in self.targets],
+                    effects=len(self.effects))
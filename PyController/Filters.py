@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package holds the optional filter stage that runs before an event is mapped. It debounces keys on
+#   cheap switches that chatter (IE: the Belkin n50/n52) and drops the EV_MSC scan code events that games never use.
+
+
+import logging
+from array import array
+from evdev import ecodes
+
+
+log = logging.getLogger('Filters')
+
+
+class EventFilter(object):
+    """
+        Filters the events of a single Device. It is configured by the device's yaml config:
+            debounce: 5       # Milliseconds after a key changes in which a change back is treated as chatter
+            dropscan: True    # Drops EV_MSC MSC_SCAN events
+        The debounce acts on the leading edge. The first press or release is passed on at once and only the bounces
+        that follow it inside the window are dropped, so no delay is added. The window needs to stay shorter than the
+        quickest real tap of a key.
+    """
+
+    window = 0.0
+    dropscan = False
+
+    _edges = None
+    _states = None
+
+    def __init__(self, debounce=0, dropscan=False):
+        """
+        :param debounce: float - The debounce window in milliseconds. 0 turns it off.
+        :param dropscan: bool
+        """
+        super(EventFilter, self).__init__()
+        self.load(debounce, dropscan)
+
+    def load(self, debounce=0, dropscan=False):
+        """
+            (Re)sets the filter. This happens in place so a running worker picks up the change.
+        :return: None
+        """
+        try:
+            self.window = max(0.0, float(debounce or 0)) / 1000.0
+        except (TypeError, ValueError):
+            log.warning(f'The debounce of: {debounce} failed validation.')
+            self.window = 0.0
+        self.dropscan = bool(dropscan)
+        self._edges = array('d', bytes(ecodes.KEY_CNT * 8))
+        self._states = bytearray(ecodes.KEY_CNT)
+
+    @property
+    def configured(self):
+        return bool(self.window or self.dropscan)
+
+    def accept(self, event):
+        """
+            Returns False if the event should be dropped. The time of the event comes from the kernel's timestamp so
+            nothing is read from the clock.
+        :param event: InputEvent object
+        :return: bool
+        """
+        if event.type == ecodes.EV_KEY:
+            if not self.window:
+                return True
+            code = event.code
+            value = event.value
+            if value == 2:
+                return self._states[code] == 1
+            if value == self._states[code]:
+                return False
+            timestamp = event.sec + (event.usec * 0.000001)
+            if timestamp - self._edges[code] < self.window:
+                return False
+            self._edges[code] = timestamp
+            self._states[code] = value
+            return True
+        if event.type == ecodes.EV_MSC:
+            return not (self.dropscan and event.code == ecodes.MSC_SCAN)
+        return True
+
+    def sync(self, code, value):
+        """
+            Sets the state of a key that was read from the device instead of from an event.
+        """
+        self._states[code] = value
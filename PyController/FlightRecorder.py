@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package holds the flight recorder. It keeps the last events every device read along with what was
+#   written for them and the active profile in a fixed size ring in a memory mapped file. When a player reports a
+#   missed or stuck key the ring is dumped as JSON lines: on SIGUSR1, the 'dump' control command, a crash or, as the
+#   ring is a file, with '--dump-flight-recorder' even after PyController was killed.
+
+
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from evdev import ecodes
+
+
+log = logging.getLogger('FlightRecorder')
+
+
+flightRecorderFile = 'flightrecorder.bin'
+MAGIC = b'PYFR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')  # magic, version, record size, capacity, length of the names JSON
+NAMES_SIZE = 16384
+# sequence, sec, usec, device, profile, in type, in code, out type, out code, in value, out value
+RECORD = struct.Struct('<QIIHHHHHHii4x')
+DROPPED = 0xFFFF  # The out type of an event that was read but not written, IE: filtered or swallowed by turbo.
+TIMER = 0xFFFE  # The in type of an event the TimerWheel wrote for turbo or repeat, nothing was read for it.
+DEFAULT_CAPACITY = 65536
+DEFAULT_RATE = 1000  # Events a second the ring is sized for when 'flightRecorder' is given in seconds, IE: '30s'
+_dumps = itertools.count(1)  # Numbers the dumps so several in the same millisecond do not overwrite each other
+
+
+def capacity_for(size, rate=DEFAULT_RATE):
+    """
+        Turns the 'flightRecorder' setting into how many events the ring holds. The ring always holds a number of
+        events, a time window such as '30s' is sized for 'rate' events a second.
+    :param size: bool, int or str - True, an amount of events or seconds ending in 's'.
+    :param rate: int - The expected events a second of all the devices together.
+    :return: int - 0 when the recorder is off.
+    """
+    if size is True:
+        return DEFAULT_CAPACITY
+    if isinstance(size, str) and size.strip().lower().endswith('s'):
+        return max(0, int(float(size.strip()[:-1]) * max(1, int(rate))))
+    return max(0, int(size or 0))
+
+
+def dump_path(directory):
+    """
+        The path of a new dump: the time to the millisecond and a number that only goes up while PyController runs.
+    :param directory: str
+    :return: str
+    """
+    now = time.time()
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+    return os.path.join(directory, f'flightrecorder-{stamp}.{int(now * 1000) % 1000:03d}-{next(_dumps)}.jsonl')
+
+
+class FlightRecorder(object):
+    """
+        The ring of event records. Writing a record is one 'pack_into' straight into the map at a slot taken from an
+        itertools.count, which is atomic so threaded seats can share the recorder. No bytes or tuples are built for a
+        record. Device and profile names are stored once in a small table at the start of the file and records only
+        hold their index.
+    """
+
+    path = None
+    capacity = DEFAULT_CAPACITY
+    devices = None
+    profiles = None
+    offset = None
+
+    _file = None
+    _map = None
+    _counter = None
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        """
+        :param path: str - The file the ring is mapped from. It is cleared when the recorder starts.
+        :param capacity: int - How many records the ring holds.
+        """
+        super(FlightRecorder, self).__init__()
+        self.path = path
+        self.capacity = max(1, int(capacity))
+        self.offset = HEADER.size + NAMES_SIZE
+        self.devices = {}
+        self.profiles = {None: 0}
+        self._counter = itertools.count(1)
+        self._file = open(path, 'w+b')
+        self._file.truncate(self.offset + self.capacity * RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.write_names()
+        log.info(f'Recording the last {self.capacity} events to: {path}')
+
+    def device_id(self, name):
+        deviceId = self.devices.get(name)
+        if deviceId is None:
+            deviceId = self.devices[name] = len(self.devices)
+            self.write_names()
+        return deviceId
+
+    def profile_id(self, name):
+        profileId = self.profiles.get(name)
+        if profileId is None:
+            profileId = self.profiles[name] = len(self.profiles)
+            self.write_names()
+        return profileId
+
+    def write_names(self):
+        names = json.dumps({'devices': list(self.devices), 'profiles': list(self.profiles)}).encode('utf-8')
+        if len(names) > NAMES_SIZE:
+            log.warning('Too many device and profile names for the flight recorder, new ones are not stored')
+            return
+        self._map[HEADER.size:HEADER.size + len(names)] = names
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, self.capacity, len(names))
+
+    def record(self, deviceId, profile, sec, usec, inType, inCode, inValue, outType, outCode, outValue):
+        """
+            Stores an event read from a device with the event written for it. 'outType' is DROPPED when nothing was.
+        :param profile: str or None - The active profile.
+        """
+        profileId = self.profiles.get(profile)
+        if profileId is None:
+            profileId = self.profile_id(profile)
+        seq = next(self._counter)
+        RECORD.pack_into(self._map, self.offset + (seq % self.capacity) * RECORD.size, seq, sec, usec, deviceId,
+                         profileId, inType, inCode, outType, outCode, inValue, outValue)
+
+    def dump(self, reason='', directory=None):
+        """
+            Writes the ring, oldest first, as JSON lines next to the ring file.
+        :param reason: str - Stored in the first line of the dump.
+        :param directory: str
+        :return: str - The path of the dump or None if it could not be written.
+        """
+        path = dump_path(directory or os.path.dirname(self.path))
+        try:
+            count = write_dump(path, *read_ring(self._map), reason=reason)
+        except (OSError, ValueError) as e:
+            log.error(f'Unable to dump the flight recorder to: {path}: {e}')
+            return None
+        log.warning(f'Dumped {count} flight recorder events to: {path} ({reason})')
+        return path
+
+    def close(self):
+        """
+            Unmaps the ring. The file is left for '--dump-flight-recorder'.
+        """
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_ring(data):
+    """
+        Reads the names and the records of a ring.
+    :param data: bytes like - The ring file or its map.
+    :return: tuple - (names dict, records sorted oldest first)
+    """
+    magic, version, recordSize, capacity, length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or recordSize != RECORD.size:
+        raise ValueError(f'not a flight recorder ring of version {VERSION}')
+    names = json.loads(bytes(data[HEADER.size:HEADER.size + length]).decode('utf-8'))
+    offset = HEADER.size + NAMES_SIZE
+    records = [record for record in RECORD.iter_unpack(data[offset:offset + capacity * RECORD.size]) if record[0]]
+    records.sort()
+    return names, records
+
+
+def event_name(evType, code):
+    typeName = ecodes.EV.get(evType, evType)
+    codeName = ecodes.bytype.get(evType, {}).get(code, code)
+    if isinstance(codeName, list):
+        codeName = codeName[0]
+    return typeName, codeName
+
+
+def write_dump(path, names, records, reason=''):
+    """
+        Writes records as JSON lines with the names of the devices, profiles and event codes.
+    :return: int - How many records were written.
+    """
+    devices, profiles = names['devices'], names['profiles']
+    with open(path, 'w') as f:
+        f.write(json.dumps({'reason': reason, 'dumped': time.time(), 'events': len(records)}) + '\n')
+        for seq, sec, usec, deviceId, profileId, inType, inCode, outType, outCode, inValue, outValue in records:
+            entry = {'seq': seq,
+                     'time': sec + usec / 1000000,
+                     'device': devices[deviceId] if deviceId < len(devices) else deviceId,
+                     'profile': profiles[profileId] if profileId < len(profiles) else profileId,
+                     'in': None if inType == TIMER else [*event_name(inType, inCode), inValue],
+                     'out': None if outType == DROPPED else [*event_name(outType, outCode), outValue]}
+            f.write(json.dumps(entry) + '\n')
+    return len(records)
+
+
+def dump_ring_file(ringPath, reason='post-mortem'):
+    """
+        Dumps the ring file left by a PyController that is no longer running. Handles '--dump-flight-recorder'.
+    :return: str - The path of the dump.
+    """
+    with open(ringPath, 'rb') as f:
+        data = f.read()
+    path = dump_path(os.path.dirname(ringPath))
+    write_dump(path, *read_ring(data), reason=reason)
+    return path
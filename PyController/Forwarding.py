@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package forwards the mapped events of the output devices to another PyController over a UDP or
+#   UNIX datagram socket, IE: the pads are plugged into the host and the game runs in a VM or a sandboxed runtime. The
+#   sender stands in for the UInput of an output and sends one datagram per SYN_REPORT frame. The receiver, started
+#   with '--forward-receive', replays the frames into local UInput devices. Frames are numbered, when one is lost or
+#   the sender goes quiet the receiver releases the keys it holds down so nothing is left stuck.
+
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import time
+import traceback
+from evdev import UInput, ecodes
+from PyController.RelMap import EVENT
+from PyController.Outputs import encode_capabilities, decode_capabilities
+
+
+log = logging.getLogger('Forwarding')
+
+
+MAGIC = b'PF'
+VERSION = 1
+# magic, version, flags, stream, sequence, send time, amount of events
+FRAME = struct.Struct('<2sBBHIdH')
+WIRE_EVENT = struct.Struct('<HHi')  # type, code, value
+MAX_DATAGRAM = 1400  # Event datagrams stay under the usual MTU so a frame is never fragmented
+MAX_EVENTS = (MAX_DATAGRAM - FRAME.size) // WIRE_EVENT.size
+FLAG_CAPS = 1  # The payload is the name and capabilities of the stream as JSON instead of events.
+FLAG_MORE = 2  # More events of the same frame follow in the next datagram, no SYN_REPORT yet.
+FLAG_RESET = 4  # The sender started, the sequence starts over.
+FLAG_CLOSE = 8  # The sender stopped.
+HEARTBEAT = 0.5
+CAPS_EVERY = 10  # Heartbeats between sending the capabilities again
+MAX_STREAMS = 16  # Outputs a receiver creates at most
+
+
+def parse_address(address):
+    """
+        Parses 'udp://host:port', 'host:port', 'unix:///path' or '/path'. Without a host only the local machine is
+        listened to or sent to, another machine needs an explicit address like '0.0.0.0'.
+    :param address: str
+    :return: tuple - (socket family, address)
+    """
+    address = str(address)
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+    if address.startswith('udp://'):
+        address = address[len('udp://'):]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f'Not a forwarding address: {address}')
+    host = host.strip('[]') or '127.0.0.1'
+    return (socket.AF_INET6 if ':' in host else socket.AF_INET), (host, int(port))
+
+
+def encode_caps(name, caps):
+    return json.dumps({'name': name, 'caps': encode_capabilities(caps)}).encode('utf-8')
+
+
+def decode_caps(payload):
+    info = json.loads(bytes(payload).decode('utf-8'))
+    return info['name'], decode_capabilities(info['caps'])
+
+
+class ForwardStats(object):
+
+    __slots__ = ('frames', 'events', 'errors', 'lost', 'late', 'released', 'timeouts', 'latencyTotal', 'latencyMax')
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, 0)
+
+    def as_dict(self):
+        stats = {attr: getattr(self, attr) for attr in self.__slots__}
+        stats['latencyMean'] = self.latencyTotal / self.frames if self.frames else 0.0
+        return stats
+
+
+class ForwardOutput(object):
+    """
+        Stands in for the UInput of an output and sends what is written to it to a ForwardReceiver. Events are packed
+        into a preallocated buffer and sent as one datagram when the frame ends with 'syn'. Writes to 'fd', which the
+        relative motion coalescing and the game pad emulation use, are read back from a pipe on the event loop. While
+        nothing is written a heartbeat is sent so the receiver can tell a quiet pad from a lost sender.
+    """
+
+    name = None
+    caps = None
+    address = None
+    stream = 0
+    fd = None
+    stats = None
+
+    def __init__(self, address, caps, name='forwarded_output', stream=0):
+        """
+        :param address: str - Where the ForwardReceiver listens, see 'parse_address'.
+        :param caps: dict - The capabilities the receiver creates its output with.
+        :param name: str
+        :param stream: int - Tells the outputs sent to one receiver apart.
+        """
+        super(ForwardOutput, self).__init__()
+        self.name = name
+        self.caps = caps
+        self.stream = stream
+        family, self.address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.stats = ForwardStats()
+        self._sequence = itertools.count()
+        self._buffer = bytearray(MAX_DATAGRAM)
+        self._count = 0
+        self._sent = False
+        self._beats = 0
+        self.reader, self.fd = os.pipe()
+        os.set_blocking(self.reader, False)
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(self.reader, self.drain)
+        self.send_caps(FLAG_RESET)
+        self._heartbeat = self.loop.call_later(HEARTBEAT, self.heartbeat)
+
+    def __str__(self):
+        return f'{self.name} - forwarded to {self.address}'
+
+    def capabilities(self, verbose=False, absinfo=True):
+        return self.caps
+
+    def write(self, etype, code, value):
+        if self._count == MAX_EVENTS:
+            self.send(self._buffer, self._count, FLAG_MORE)
+            self._count = 0
+        WIRE_EVENT.pack_into(self._buffer, FRAME.size + self._count * WIRE_EVENT.size, etype, code, value)
+        self._count += 1
+
+    def write_event(self, event):
+        self.write(event.type, event.code, event.value)
+
+    def syn(self):
+        if self._count:
+            self.send(self._buffer, self._count)
+            self._count = 0
+
+    def send(self, buffer, count, flags=0):
+        """
+            Sends the 'count' events packed in 'buffer' after the frame header.
+        """
+        FRAME.pack_into(buffer, 0, MAGIC, VERSION, flags, self.stream, next(self._sequence) & 0xFFFFFFFF, time.time(),
+                        count)
+        self.sendto(memoryview(buffer)[:FRAME.size + count * WIRE_EVENT.size])
+        self.stats.frames += 1
+        self.stats.events += count
+
+    def sendto(self, data):
+        self._sent = True
+        try:
+            self.sock.sendto(data, self.address)
+        except OSError as e:
+            # Nothing listens yet or the receiver is gone, the frame is lost like any other datagram
+            self.stats.errors += 1
+            if self.stats.errors == 1:
+                log.warning(f'Unable to forward {self.name} to {self.address}: {e}')
+
+    def send_caps(self, flags=0):
+        payload = encode_caps(self.name, self.caps)
+        self.sendto(FRAME.pack(MAGIC, VERSION, FLAG_CAPS | flags, self.stream, next(self._sequence) & 0xFFFFFFFF,
+                               time.time(), len(payload)) + payload)
+
+    def heartbeat(self):
+        self._beats += 1
+        if self._beats % CAPS_EVERY == 0:
+            self.send_caps()
+        elif not self._sent:
+            self.sendto(FRAME.pack(MAGIC, VERSION, 0, self.stream, next(self._sequence) & 0xFFFFFFFF, time.time(), 0))
+        self._sent = False
+        self._heartbeat = self.loop.call_later(HEARTBEAT, self.heartbeat)
+
+    def drain(self):
+        """
+            Sends what was written to 'fd'. Those writes are always whole frames ending with a SYN_REPORT. With relative
+            motion coalescing the SYN_REPORT of a frame is only written here and never to 'syn', so the events the
+            frame passed to 'write' are still buffered and are sent in the same datagram.
+        """
+        try:
+            data = os.read(self.reader, 65536)
+        except BlockingIOError:
+            return
+        for offset in range(0, len(data) - (len(data) % EVENT.size), EVENT.size):
+            sec, usec, evType, code, value = EVENT.unpack_from(data, offset)
+            if evType == ecodes.EV_SYN and code == ecodes.SYN_REPORT:
+                self.syn()
+            else:
+                self.write(evType, code, value)
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.drain()
+        self._heartbeat.cancel()
+        if not self.loop.is_closed():
+            self.loop.remove_reader(self.reader)
+        self.sendto(FRAME.pack(MAGIC, VERSION, FLAG_CLOSE, self.stream, next(self._sequence) & 0xFFFFFFFF,
+                               time.time(), 0))
+        os.close(self.fd)
+        os.close(self.reader)
+        self.sock.close()
+        self.fd = None
+
+
+class Forwarder(object):
+    """
+        Creates a ForwardOutput for every output, it is passed to the OutputManager in place of UInput.
+    """
+
+    address = None
+    streams = None
+
+    def __init__(self, address):
+        super(Forwarder, self).__init__()
+        parse_address(address)
+        self.address = address
+        self.streams = itertools.count()
+
+    def __call__(self, caps, name='forwarded_output'):
+        log.info(f'Forwarding output device: {name} to {self.address}')
+        return ForwardOutput(self.address, caps, name=name, stream=next(self.streams))
+
+
+class ReceivedStream(object):
+    """
+        The state of one sender's output on the receiver.
+    """
+
+    __slots__ = ('name', 'output', 'expected', 'held', 'lastFrame', 'stats')
+
+    def __init__(self):
+        self.name = None
+        self.output = None
+        self.expected = None
+        self.held = set()
+        self.lastFrame = 0.0
+        self.stats = ForwardStats()
+
+
+class ForwardReceiver(object):
+    """
+        Listens for the frames of ForwardOutputs and writes them to local output devices, one per stream. A frame
+        with a sequence number older than expected arrived late and is dropped. When frames were lost, the sender
+        restarted or stopped, or no frame (not even a heartbeat) arrived for 'timeout' seconds the keys held down
+        on that output are released. Frames are only accepted from one host, 'peer' or else the first that sent a valid
+        frame, and a UNIX socket is only writable by its owner.
+    """
+
+    address = None
+    peer = None
+    ignored = 0
+    sock = None
+    loop = None
+    streams = None
+    timeout = HEARTBEAT * 4
+    uinput = None
+
+    def __init__(self, address, uinput=None, timeout=None, peer=None):
+        """
+        :param address: str - Where to listen, see 'parse_address'.
+        :param uinput: callable - Creates a local output from (caps, name=name). Defaults to evdev's UInput.
+        :param timeout: float
+        :param peer: str - The host or IP address of the sender. Defaults to the first host a frame arrives from.
+        """
+        super(ForwardReceiver, self).__init__()
+        family, self.address = parse_address(address)
+        if peer and family != socket.AF_UNIX:
+            self.peer = socket.getaddrinfo(peer, None, family, socket.SOCK_DGRAM)[0][4][0]
+        self.uinput = uinput or UInput
+        if timeout is not None:
+            self.timeout = timeout
+        self.streams = {}
+        self._buffer = bytearray(65536)
+
+    def start(self, loop=None):
+        family = socket.AF_UNIX if isinstance(self.address, str) else \
+            (socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET)
+        if family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        if family == socket.AF_UNIX:
+            os.chmod(self.address, 0o600)
+        self.sock.setblocking(False)
+        self.loop = loop or asyncio.get_event_loop()
+        self.loop.add_reader(self.sock.fileno(), self.read)
+        self._watchdog = self.loop.call_later(self.timeout, self.watchdog)
+        log.info(f'Receiving forwarded events at: {self.address}')
+        return self
+
+    def read(self):
+        while True:
+            try:
+                size, sender = self.sock.recvfrom_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self.handle(memoryview(self._buffer)[:size], sender)
+            except Exception as e:
+                log.error(f'Error replaying a forwarded frame from {sender}: {e}')
+                log.debug(f'[DEBUG] for ForwardReceiver: {traceback.format_exc()}')
+
+    def handle(self, data, sender=None):
+        """
+            Replays one datagram.
+        """
+        if len(data) < FRAME.size:
+            return
+        magic, version, flags, streamId, sequence, sent, count = FRAME.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION or not self.accept(sender):
+            return
+        stream = self.streams.get((sender or None, streamId))
+        if stream is None:
+            if len(self.streams) >= MAX_STREAMS:
+                self.ignore(sender, f'more than {MAX_STREAMS} streams')
+                return
+            stream = self.streams[(sender or None, streamId)] = ReceivedStream()
+        stats = stream.stats
+        stream.lastFrame = self.loop.time()
+
+        if flags & (FLAG_RESET | FLAG_CLOSE) or stream.expected is None:
+            self.release(stream)
+        elif sequence != stream.expected:
+            behind = (stream.expected - sequence) & 0xFFFFFFFF
+            if behind < 0x80000000:
+                stats.late += 1
+                return
+            stats.lost += (sequence - stream.expected) & 0xFFFFFFFF
+            self.release(stream)
+        stream.expected = (sequence + 1) & 0xFFFFFFFF
+
+        if flags & FLAG_CAPS:
+            self.open(stream, data[FRAME.size:FRAME.size + count])
+            return
+        if not count or stream.output is None:
+            return
+        output = stream.output
+        held = stream.held
+        for offset in range(FRAME.size, FRAME.size + count * WIRE_EVENT.size, WIRE_EVENT.size):
+            evType, code, value = WIRE_EVENT.unpack_from(data, offset)
+            output.write(evType, code, value)
+            if evType == ecodes.EV_KEY:
+                if value:
+                    held.add(code)
+                else:
+                    held.discard(code)
+        if not flags & FLAG_MORE:
+            output.syn()
+        latency = time.time() - sent
+        stats.frames += 1
+        stats.events += count
+        stats.latencyTotal += latency
+        if latency > stats.latencyMax:
+            stats.latencyMax = latency
+
+    def accept(self, sender):
+        """
+            Whether frames from 'sender' are replayed. The senders to a UNIX socket are not bound to an address, the
+            permissions of the socket keep other users out.
+        """
+        if not isinstance(sender, tuple):
+            return True
+        if self.peer is None:
+            self.peer = sender[0]
+            log.info(f'Accepting forwarded events only from: {self.peer}')
+        if sender[0] == self.peer:
+            return True
+        self.ignore(sender, f'only {self.peer} is accepted')
+        return False
+
+    def ignore(self, sender, reason):
+        self.ignored += 1
+        if self.ignored == 1:
+            log.warning(f'Ignoring forwarded frames from {sender}, {reason}')
+
+    def open(self, stream, payload):
+        name, caps = decode_caps(payload)
+        if stream.output is not None:
+            return
+        stream.name = name
+        log.info(f'Creating output device: {name} for a forwarded stream')
+        stream.output = self.uinput(caps, name=name)
+
+    def release(self, stream):
+        """
+            Releases the keys held down on a stream's output.
+        """
+        if not stream.held or stream.output is None:
+            stream.held.clear()
+            return
+        for code in stream.held:
+            stream.output.write(ecodes.EV_KEY, code, 0)
+        stream.output.syn()
+        stream.stats.released += len(stream.held)
+        log.warning(f'Released {len(stream.held)} keys held on forwarded output: {stream.name}')
+        stream.held.clear()
+
+    def watchdog(self):
+        now = self.loop.time()
+        for stream in self.streams.values():
+            if stream.held and now - stream.lastFrame > self.timeout:
+                stream.stats.timeouts += 1
+                self.release(stream)
+        self._watchdog = self.loop.call_later(self.timeout / 2, self.watchdog)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self._watchdog.cancel()
+        if not self.loop.is_closed():
+            self.loop.remove_reader(self.sock.fileno())
+        for stream in self.streams.values():
+            self.release(stream)
+            if stream.output is not None:
+                stream.output.close()
+        self.sock.close()
+        self.sock = None
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def run(self):
+        """
+            Replays frames until interrupted. Handles '--forward-receive'.
+        :return: dict - The stats of every stream.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.start(loop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stats = self.as_dict()
+            if self.ignored:
+                log.warning(f'Ignored {self.ignored} forwarded frames from other senders')
+            self.close()
+            loop.close()
+        return stats
+
+    def as_dict(self):
+        return {f'{stream.name or streamId}': dict(stream.stats.as_dict(), sender=str(sender) if sender else None)
+                for (sender, streamId), stream in self.streams.items()}
@@ -4,6 +4,7 @@
 # Author: Ryan Henrichson
 # Description: Monitors processes on the local machine for games noted in configs found under profiles.d/*.yaml.
 #   Once a game is detected it loads the keymap profile and will unload the keymap once the game is no longer running.
+#   When seats are configured the profile is only changed for the seat of the user that started the game.
 
 
 import logging
@@ -27,56 +28,102 @@ class GameMonitor(object):
     activeGames = None
     keymap = None
     pyc = None
+    processes = None
+    seatUsers = None
+    sharedSeats = None
 
-    def __init__(self, pyc):
+    def __init__(self, pyc, processes=None):
+        """
+        :param pyc: PyController object
+        :param processes: callable - Returns the running processes like 'psutil.process_iter'. Used by simulations.
+        """
         super(GameMonitor, self).__init__()
         self.settings = pyc.settings
+        self.processes = processes or psutil.process_iter
         self.games = pyc.settings.games
         self.activeGames = set()
+        # Games of users that are not listed by any seat change the profile of every seat that lists no users
+        self.seatUsers = {user: seat for seat, config in pyc.settings.seats.items()
+                          for user in (config.get('users') or [])}
+        self.sharedSeats = (None,) + tuple(seat for seat, config in pyc.settings.seats.items()
+                                           if not config.get('users'))
+        # The key tables for the profiles are built by the KeyMapper in shared memory. Only profile names are sent
+        # back over the queue.
         self.keymap = pyc.keymapper
-        for key, value in self.settings.profilesConfig.items():
-            self.keymap.add_profile_keymap(value.get('default-keys'), key)
-            for dev in value.get('devices', []):
-                self.keymap.add_profile_keymap(dev.get('keys'), key, deviceName=dev.get('name', ''))
-
-    def run(self, kill_now, globalQueue):
-        def __psHelper(process):
-            try:
-                return process.exe().lower()
-            except psutil.NoSuchProcess:
-                return ''
-            except psutil.AccessDenied:
-                try:
-                    process.name().lower()
-                except Exception:
-                    return ''
-            except Exception:
-                return ''
 
+    def run(self, kill_now, globalQueue, interval=5):
         try:
             while bool(kill_now.value):
-                procs = list(filter(None, [__psHelper(proc) for proc in psutil.process_iter()]))
-                for proc in procs:
-                    if proc not in self.activeGames and [g for g in self.games if g in proc or proc in g]:
-                        profile = self.find_profile(proc)
-                        if profile is None:
-                            continue
-                        self.activeGames.add(proc)
-                        globalQueue.put_nowait(('makeProfileActive', profile))
-                for activeGame in [games for games in self.activeGames]:
-                    if activeGame not in procs:
-                        profile = self.find_profile(activeGame)
-                        if profile is None:
-                            continue
-                        self.activeGames.remove(activeGame)
-                        globalQueue.put_nowait(('deactivateProfile', profile))
-                time.sleep(5)
+                self.poll(globalQueue)
+                time.sleep(interval)
         except (KeyboardInterrupt, SystemExit):
             log.info("Game Monitor received a KeyboardInterrupt or SystemExit")
         except Exception as e:
             log.error(f'Error in the GameMonitor: {e}')
             log.debug(f'[DEBUG] for the GameMonitor: {traceback.format_exc()}')
 
+    def poll(self, globalQueue):
+        """
+            Scans the processes once and sends the name of the KeyMapper method, the profile and the seat over the
+            queue for every game that started or stopped. The seat is None for the devices that are not in a seat.
+        :param globalQueue: multiprocessing Queue
+        :return: None
+        """
+        procs = set()
+        for process in self.processes():
+            proc = GameMonitor.process_name(process)
+            if not proc:
+                continue
+            if [g for g in self.games if g in proc or proc in g]:
+                for seat in self.process_seats(process):
+                    procs.add((proc, seat))
+        for proc, seat in procs:
+            if (proc, seat) not in self.activeGames:
+                profile = self.find_profile(proc)
+                if profile is None:
+                    continue
+                self.activeGames.add((proc, seat))
+                globalQueue.put_nowait(('make_profile_active', profile, seat))
+        for activeGame in [games for games in self.activeGames]:
+            if activeGame not in procs:
+                profile = self.find_profile(activeGame[0])
+                if profile is None:
+                    continue
+                self.activeGames.remove(activeGame)
+                globalQueue.put_nowait(('deactivate_profile', profile, activeGame[1]))
+
+    def process_seats(self, process):
+        """
+            The seats whose profile a process changes. Without seats this is only the devices of no seat and the owner
+            of the process is never looked up.
+        :return: tuple
+        """
+        if not self.seatUsers:
+            return self.sharedSeats
+        seat = self.seatUsers.get(GameMonitor.process_user(process))
+        return self.sharedSeats if seat is None else (seat,)
+
+    @staticmethod
+    def process_user(process):
+        try:
+            return process.username()
+        except Exception:
+            return ''
+
+    @staticmethod
+    def process_name(process):
+        try:
+            return process.exe().lower()
+        except psutil.NoSuchProcess:
+            return ''
+        except psutil.AccessDenied:
+            try:
+                return process.name().lower()
+            except Exception:
+                return ''
+        except Exception:
+            return ''
+
     def find_profile(self, game):
         for profile, values in self.settings.profilesConfig.items():
             if isinstance(values['executable'], list):
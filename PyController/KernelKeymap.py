@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package programs the scan code to key code table the kernel keeps for an input device with the
+#   EVIOCGKEYCODE_V2 and EVIOCSKEYCODE_V2 ioctls. A device whose mapping never changes can be remapped by the kernel
+#   itself and left ungrabbed so its events never pass through PyController at all.
+
+
+import errno
+import fcntl
+import logging
+import struct
+
+
+log = logging.getLogger('KernelKeymap')
+
+
+# struct input_keymap_entry from linux/input.h: flags, len, index, keycode, scancode[32]
+ENTRY = struct.Struct('=BBHI32s')
+INPUT_KEYMAP_BY_INDEX = 1
+MAX_ENTRIES = 65536
+
+
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('E') << 8) | number
+
+
+EVIOCGKEYCODE_V2 = _ioc(2, 0x04, ENTRY.size)
+EVIOCSKEYCODE_V2 = _ioc(1, 0x04, ENTRY.size)
+
+
+def read_keymap(fd):
+    """
+        Reads every entry of the kernel keymap of an input device by index.
+    :param fd: int - The file descriptor of the input device.
+    :return: list - (scancode bytes, keycode) tuples.
+    """
+    entries = []
+    for index in range(MAX_ENTRIES):
+        buf = bytearray(ENTRY.pack(INPUT_KEYMAP_BY_INDEX, 0, index, 0, b''))
+        try:
+            fcntl.ioctl(fd, EVIOCGKEYCODE_V2, buf)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                break
+            raise
+        flags, length, index, keycode, scancode = ENTRY.unpack(buf)
+        entries.append((bytes(scancode[:length]), keycode))
+    return entries
+
+
+def write_keycode(fd, scancode, keycode):
+    """
+        Sets the key code the kernel reports for a scan code.
+    :param fd: int
+    :param scancode: bytes
+    :param keycode: int
+    :return: None
+    """
+    fcntl.ioctl(fd, EVIOCSKEYCODE_V2, ENTRY.pack(0, len(scancode), 0, keycode, scancode))
+
+
+class KernelKeymap(object):
+    """
+        The kernel keymap of one input device. The original table is read once and every change is made relative to
+        it so swapped keys (KEY_A: KEY_B and KEY_B: KEY_A) work and 'restore' always puts the original back.
+    """
+
+    fd = None
+    original = None
+    current = None
+
+    def __init__(self, fd):
+        """
+        :param fd: int - The file descriptor of the input device.
+        """
+        super(KernelKeymap, self).__init__()
+        self.fd = fd
+        self.original = read_keymap(fd)
+        if not self.original:
+            raise ValueError('the device has no kernel keymap')
+        self.current = dict(self.original)
+
+    def apply(self, table):
+        """
+            Programs the kernel keymap with a key table. Every remapped key needs a scan code in the keymap, otherwise
+            nothing is changed.
+        :param table: memoryview - A key table as built by the KeyMapper.
+        :return: int - The amount of scan codes that were changed.
+        """
+        keycodes = {keycode for scancode, keycode in self.original}
+        missing = [code for code, mapped in enumerate(table) if mapped and code not in keycodes]
+        if missing:
+            raise ValueError(f'the kernel keymap has no scan code for the key codes: {missing}')
+        changed = 0
+        for scancode, keycode in self.original:
+            wanted = (table[keycode] or keycode) if keycode < len(table) else keycode
+            if self.current[scancode] != wanted:
+                write_keycode(self.fd, scancode, wanted)
+                self.current[scancode] = wanted
+                changed += 1
+        return changed
+
+    def restore(self):
+        """
+            Puts back the key codes the device had before 'apply'.
+        :return: int - The amount of scan codes that were changed.
+        """
+        changed = 0
+        for scancode, keycode in self.original:
+            if self.current[scancode] != keycode:
+                write_keycode(self.fd, scancode, keycode)
+                self.current[scancode] = keycode
+                changed += 1
+        return changed
@@ -6,11 +6,15 @@
 
 
 import logging
-import time
+import traceback
 from evdev import InputEvent, ecodes
+from PyController.KeyTables import SharedKeyTables, DeviceRecord, clear_table, merge_tables, merge_rates, TABLE_SIZE
+from PyController.Timers import TimerWheel
+from PyController.LogPipeline import sampled_logger
 
 
 log = logging.getLogger('KeyMapper')
+trace = sampled_logger('KeyMapper')
 
 
 class KeyMapper(object):
@@ -22,6 +26,12 @@ class KeyMapper(object):
     profileKeyMap = None
     activeProfile = None
     settings = None
+    tables = None
+    profileRates = None
+    timers = None
+    devices = None
+    profileSwitches = 0
+    translatedKeys = 0
 
     def __init__(self, settings):
         """
@@ -32,57 +42,147 @@ class KeyMapper(object):
         self.settings = settings
         self.deviceKeyMap = {}
         self.profileKeyMap = {}
+        self.profileRates = {}
+        self.devices = {}
+        self.tables = SharedKeyTables(capacity=KeyMapper.table_capacity(settings))
+        self.timers = TimerWheel()  # Drives turbo and custom key repeat for every device
 
     def add_device_keymap(self, device, keys):
         """
-            This creates a dictionary of key mappings for a particular device.
+            This fills a key table with the key mappings for a particular device and creates the DeviceRecord that is
+            used to map events for it.
 
-        :param device: str
+        :param device: Device object
         :param keys: dictionary
-        :return: dictionary
+        :return: DeviceRecord
         """
 
         log.info(f"Building keymap for [{device}] with keys: {keys}")
 
-        if device not in self.deviceKeyMap:
-            self.deviceKeyMap[device] = {}
-
-        for inputKey, mapKey in keys.items():
-            if not KeyMapper.validate_key_pair(inputKey, mapKey):
-                log.warning(f'The key map of input: {inputKey} mapped to {mapKey} failed validation.')
-                continue
-
-            self.deviceKeyMap[device][getattr(ecodes, inputKey)] = InputEvent(time.time(),
-                                                                              0,
-                                                                              ecodes.EV_KEY,
-                                                                              getattr(ecodes, mapKey),
-                                                                              1)
-
-        return self.deviceKeyMap[device]
+        compiled = getattr(self.settings, 'compiled', None)
+        config = compiled.device(device.name) if compiled is not None else None
+        table = self.fill_table(self.tables.table(f'device:{device.name}'),
+                                KeyMapper.compiled_keys(compiled, config or {}, keys))
+        record = self.deviceKeyMap.get(device.name)
+        if record is None:
+            record = self.deviceKeyMap[device.name] = DeviceRecord(device.name, table)
+        self.devices[device.name] = device
+        self.tables.bump_generation()
+        self.build_active_table(record)
+        return record
 
     def add_profile_keymap(self, profileKeys, profileName, deviceName=None):
         """
-            This updates the 'profileKeyMap' variable with more key mappings.
+            This updates the 'profileKeyMap' variable with more key mappings. The key tables of a profile are stored
+            under the device name they belong to or None for the keys that apply to all devices.
         :param profileKeys: dictionary
         :param profileName: str
+        :param deviceName: str
         :return: None
         """
 
         if profileName not in self.profileKeyMap:
             self.profileKeyMap[profileName] = {}
 
-        if deviceName is not None and deviceName not in self.profileKeyMap[profileName]:
-            self.profileKeyMap[profileName][deviceName] = {}
+        tableName = KeyMapper.profile_table_name(profileName, deviceName)
+        self.profileKeyMap[profileName][deviceName] = self.fill_table(self.tables.table(tableName), profileKeys)
+        self.tables.bump_generation()
+
+    def add_device_rates(self, device, turbo=None, repeat=None, repeatDelay=None):
+        """
+            Sets the keys of a device that have turbo or a custom repeat rate.
+        :param device: Device object
+        :param turbo: dictionary - Example: {'KEY_SPACE': 15} presses and releases KEY_SPACE 15 times a second while
+            held
+        :param repeat: dictionary - Example: {'KEY_W': 30} repeats KEY_W 30 times a second while held
+        :param repeatDelay: float - Seconds before a custom repeat starts.
+        :return: None
+        """
+        record = self.deviceKeyMap[device.name]
+        record.rates = KeyMapper.parse_rates(turbo, repeat)
+        if repeatDelay is not None:
+            record.repeatDelay = float(repeatDelay)
+        self.build_active_table(record)
+
+    def add_profile_rates(self, profileName, turbo=None, repeat=None, deviceName=None):
+        """
+            Sets the keys that have turbo or a custom repeat rate while a profile is active.
+        :param profileName: str
+        :param turbo: dictionary
+        :param repeat: dictionary
+        :param deviceName: str
+        :return: None
+        """
+        if turbo or repeat:
+            self.profileRates.setdefault(profileName, {})[deviceName] = KeyMapper.parse_rates(turbo, repeat)
+
+    def load_profiles(self):
+        """
+            Builds the key tables for every profile configured in profiles.d. This happens once in the main process
+            before the GameMonitor is forked so that both processes share the same tables.
+        :return: None
+        """
+        compiled = getattr(self.settings, 'compiled', None)
+        for key, value in self.settings.profilesConfig.items():
+            self.add_profile_keymap(KeyMapper.compiled_keys(compiled, value, value.get('default-keys')), key)
+            self.add_profile_rates(key, value.get('turbo'), value.get('repeat'))
+            for dev in value.get('devices', []):
+                self.add_profile_keymap(KeyMapper.compiled_keys(compiled, dev, dev.get('keys')), key,
+                                        deviceName=dev.get('name', ''))
+                self.add_profile_rates(key, dev.get('turbo'), dev.get('repeat'), deviceName=dev.get('name', ''))
 
-        for inputKey, mapKey in profileKeys.items():
+    def reload(self):
+        """
+            Rebuilds the profile key tables from the profiles the SettingsManager has loaded. The slots of the old
+            tables are released first so profiles that were removed do not use up the key table block. The device
+            tables are reloaded by the DeviceManager.
+        :return: int - The new generation of the key tables.
+        """
+        log.info('Reloading profile keymaps')
+        for profileName, tables in self.profileKeyMap.items():
+            for deviceName in tables:
+                self.tables.release(KeyMapper.profile_table_name(profileName, deviceName))
+        self.profileKeyMap = {}
+        self.profileRates = {}
+        self.load_profiles()
+        if self.activeProfile not in self.profileKeyMap:
+            self.activeProfile = None
+        self.build_active_tables()
+        return self.tables.generation
+
+    def profile_applies(self, deviceName):
+        """
+            True if any profile remaps keys or sets turbo or repeat rates for the device.
+        :param deviceName: str
+        :return: bool
+        """
+        for tables in self.profileKeyMap.values():
+            for name, table in tables.items():
+                if name in (None, deviceName) and any(table):
+                    return True
+        for rates in self.profileRates.values():
+            if rates.get(None) or rates.get(deviceName):
+                return True
+        return False
+
+    def fill_table(self, table, keys):
+        """
+            Writes the validated key pairs into a key table. Anything already in the table is cleared first. A table
+            from the compiled config is copied as it is.
+        :param table: memoryview
+        :param keys: dictionary or memoryview
+        :return: memoryview
+        """
+        if isinstance(keys, memoryview):
+            table[:] = keys
+            return table
+        clear_table(table)
+        for inputKey, mapKey in (keys or {}).items():
             if not KeyMapper.validate_key_pair(inputKey, mapKey):
                 log.warning(f'The key map of input: {inputKey} mapped to {mapKey} failed validation.')
                 continue
-            self.profileKeyMap[profileName][getattr(ecodes, inputKey)] = InputEvent(time.time(),
-                                                                                    0,
-                                                                                    ecodes.EV_KEY,
-                                                                                    getattr(ecodes, mapKey),
-                                                                                    1)
+            table[getattr(ecodes, inputKey)] = getattr(ecodes, mapKey)
+        return table
 
     def make_profile_active(self, profileName):
         """
@@ -93,39 +193,210 @@ class KeyMapper(object):
         """
         if profileName in self.profileKeyMap:
             log.info(f'Setting new active profile: {profileName}')
-            log.debug(f'The new profile settings to be used: {self.profileKeyMap.get(profileName)}')
+            log.debug(f'The new profile is using key tables of generation: {self.tables.generation}')
             self.activeProfile = profileName
+            self.profileSwitches += 1
+            self.build_active_tables()
 
     def deactivate_profile(self, profileName):
-        if profileName == self.activeProfile:
+        if self.activeProfile is not None and profileName == self.activeProfile:
             log.info(f'Deactivating profile: {profileName}')
             self.activeProfile = None
+            self.profileSwitches += 1
+            self.build_active_tables()
+
+    def build_active_table(self, record):
+        """
+            Merges the active profile on top of the device's own table. Keys configured for the device inside the
+            profile override the keys configured for all devices in the profile which override the device's keys. The
+            turbo and repeat rates are merged the same way.
+        :param record: DeviceRecord
+        :return: None
+        """
+        profile = self.profile
+        latched = record.latched
+        held = [code for code in range(TABLE_SIZE) if latched[code]] if any(latched) else []
+        heldRates = [(record.turbo[code], record.repeat[code]) for code in held]
+        merge_tables(record.active, record.table, profile.get(None), profile.get(record.name))
+        rates = self.profileRates.get(self.activeProfile) or {}
+        merge_rates(record, record.rates, rates.get(None), rates.get(record.name))
+        record.generation = self.tables.generation
+        if held:
+            self.translate_held_keys(record)
+            for code, before in zip(held, heldRates):
+                if before != (record.turbo[code], record.repeat[code]):
+                    self.stop_held_timer(record, code)
+
+    def translate_held_keys(self, record):
+        """
+            Called when the active table of a device changes while keys are held down. Every held key whose output
+            changed is released as the output it was pressed as and pressed again as its new output so nothing is left
+            stuck down. Turbo and repeat of those keys stop until they are pressed again.
+        :param record: DeviceRecord
+        :return: int - The amount of keys that were translated.
+        """
+        device = self.devices.get(record.name)
+        outDevice = getattr(device, 'outDevice', None)
+        active = record.active
+        latched = record.latched
+        translated = 0
+        for code in range(TABLE_SIZE):
+            old = latched[code]
+            if not old:
+                continue
+            new = active[code] or code
+            if new == old:
+                continue
+            latched[code] = new
+            translated += 1
+            self.timers.cancel((record.name, code))
+            if outDevice is None:
+                continue
+            try:
+                outDevice.write_event(InputEvent(0, 0, ecodes.EV_KEY, old, 0))
+                outDevice.write_event(InputEvent(0, 0, ecodes.EV_KEY, new, 1))
+            except OSError as e:
+                log.error(f'Unable to translate a held key on Device: {record.name}: {e}')
+                log.debug(f'[DEBUG] for translate_held_keys: {traceback.format_exc()}')
+        if translated and outDevice is not None:
+            log.info(f'Translated {translated} held keys on Device: {record.name}')
+            try:
+                outDevice.syn()
+            except OSError as e:
+                log.error(f'Unable to translate a held key on Device: {record.name}: {e}')
+        self.translatedKeys += translated
+        return translated
+
+    def stop_held_timer(self, record, code):
+        """
+            Stops the turbo or repeat of a held key whose rates changed. The worker only hands a release to the
+            TimerWheel while the key has a rate, so the timer has to be stopped here or it would outlive the key. A
+            turbo key that was between presses is pressed again so it stays down until it is released.
+        :param record: DeviceRecord
+        :param code: int - The input code of the key.
+        :return: None
+        """
+        entry = self.timers.cancel((record.name, code))
+        if entry is None or not entry.turbo or entry.value:
+            return
+        outDevice = getattr(self.devices.get(record.name), 'outDevice', None)
+        if outDevice is None:
+            return
+        try:
+            outDevice.write_event(InputEvent(0, 0, ecodes.EV_KEY, entry.code, 1))
+            outDevice.syn()
+        except OSError as e:
+            log.error(f'Unable to stop the turbo of a held key on Device: {record.name}: {e}')
+
+    def build_active_tables(self):
+        for record in self.deviceKeyMap.values():
+            self.build_active_table(record)
+
+    def refresh(self):
+        """
+            Rebuilds the active tables of any device whose tables have changed since they were last built. This is
+            cheap to call often as it only compares the generation counter.
+        :return: None
+        """
+        generation = self.tables.generation
+        for record in self.deviceKeyMap.values():
+            if record.generation != generation:
+                self.build_active_table(record)
 
     def map_event(self, event, device):
         """
-            This takes an event and a deviceKeyMap. The method first checks the profileKeyMap and will ignore the
-            deviceKeyMap as anything in a profile should override the device settings.
+            This takes an event and looks up its code in the device's active table which already has the active
+            profile merged into it. The event is changed in place. The output code of a press is latched until the key
+            is released so the release and any autorepeat always match the press even if the tables changed between.
         :param event: InputEvent object
         :param device: Device object
         :return: InputEvent
         """
-        if event.type != ecodes.EV_KEY:
-            return event
+        if event.type == ecodes.EV_KEY:
+            record = device.keyRecord
+            inCode = event.code
+            if event.value == 1:
+                code = record.active[inCode] or inCode
+                record.latched[inCode] = code
+            else:
+                code = record.latched[inCode] or record.active[inCode] or inCode
+                if event.value == 0:
+                    record.latched[inCode] = 0
+            if code != inCode:
+                event.code = code
+                device.stats.remapped += 1
+                if trace.enabled:
+                    trace.debug('Mapped %s to %s value %s on Device: %s', inCode, code, event.value, device.name)
+            else:
+                device.stats.passthrough += 1
+        return event
 
-        rEvent = self.get_active_profile_for_device(device, event.code) or \
-                 self.deviceKeyMap[device].get(event.code, None)
+    def close(self):
+        """
+            Releases the key tables. This should only happen once all the device workers have stopped.
+        :return: None
+        """
+        self.timers.close()
+        self.devices.clear()
+        self.deviceKeyMap.clear()
+        self.profileKeyMap.clear()
+        self.tables.close()
+        self.tables.unlink()
 
-        if rEvent is None:
-            return event
+    @staticmethod
+    def parse_rates(turbo=None, repeat=None):
+        """
+            Turns {'KEY_A': hz} dictionaries into {code: (turboPeriod, repeatPeriod)} with periods in seconds. A rate
+            of 0 turns turbo or repeat off for that key which is useful inside a profile.
+        :param turbo: dictionary
+        :param repeat: dictionary
+        :return: dictionary
+        """
+        rates = {}
+        for index, config in enumerate((turbo, repeat)):
+            for keyName, hz in (config or {}).items():
+                code = getattr(ecodes, str(keyName), None)
+                try:
+                    hz = float(hz)
+                except (TypeError, ValueError):
+                    hz = -1
+                if not isinstance(code, int) or not 0 < code < TABLE_SIZE or hz < 0:
+                    log.warning(f'The rate of {hz} for key: {keyName} failed validation.')
+                    continue
+                periods = list(rates.get(code, (0.0, 0.0)))
+                periods[index] = 1.0 / hz if hz else 0.0
+                rates[code] = tuple(periods)
+        return rates
 
-        rEvent.sec = event.sec
-        rEvent.usec = event.usec + 25
-        rEvent.value = event.value
-        return rEvent
+    @staticmethod
+    def profile_table_name(profileName, deviceName=None):
+        return f'profile:{profileName}' if deviceName is None else f'profile:{profileName}:{deviceName}'
 
-    def get_active_profile_for_device(self, device, code):
-        return self.profile.get(device.name, {}).get(code, None) or self.profile.get(code, None)
+    @staticmethod
+    def compiled_keys(compiled, config, keys):
+        """
+            Returns the compiled table of a device or profile config if it has one, otherwise 'keys'.
+        :param compiled: CompiledConfig or None
+        :param config: dictionary - A config from the compiled config.
+        :param keys: dictionary
+        :return: dictionary or memoryview
+        """
+        if compiled is not None and 'table' in config:
+            return compiled.table(config['table'])
+        return keys
 
+    @staticmethod
+    def table_capacity(settings):
+        """
+            Works out how many key tables are needed for the configured devices and profiles. Room is left for the
+            configuration to grow at runtime.
+        :param settings: SettingsManager object
+        :return: int
+        """
+        count = len(settings.devices)
+        for value in (settings.profilesConfig or {}).values():
+            count += 1 + len(value.get('devices', []) or [])
+        return max(16, count * 2)
 
     @staticmethod
     def validate_key_pair(inputKey, mapKey):
@@ -137,7 +408,10 @@ class KeyMapper(object):
         :param mapKey: str
         :return: bool
         """
-        return hasattr(ecodes, inputKey) and hasattr(ecodes, mapKey)
+        if not hasattr(ecodes, inputKey) or not hasattr(ecodes, mapKey):
+            return False
+        return all(isinstance(getattr(ecodes, key), int) and 0 < getattr(ecodes, key) < TABLE_SIZE
+                   for key in (inputKey, mapKey))
 
     @property
     def profile(self):
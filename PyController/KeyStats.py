@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package counts how often each key of each device is pressed and how long it is held. The counters
+#   are fixed size lists indexed by key code that the device worker updates in place. Indexing a list is cheaper than
+#   a dict update while array.array is not, as every read or write of an array boxes a new int.
+#   They are written to 'keystats.bin' in the config directory every so often and added to what earlier sessions
+#   counted. '--print-key-stats' shows which keys are used the most to help decide what to put on the best keys.
+
+
+import array
+import asyncio
+import logging
+import os
+import struct
+import threading
+import traceback
+from evdev import ecodes
+
+
+log = logging.getLogger('KeyStats')
+
+
+keyStatsFile = 'keystats.bin'
+MAGIC = b'PYKS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')  # magic, version, amount of devices, counters per device
+NAME = struct.Struct('<H')
+KEY_COUNT = ecodes.KEY_CNT
+COUNTERS = (('presses', 'Q'), ('holdTotal', 'd'), ('holdMax', 'd'))
+
+
+class KeyUsage(object):
+    """
+        The counters of one device. 'pressedAt' is when a key went down or 0 while it is up. In the file the counters
+        are stored as the array types in COUNTERS.
+    """
+
+    __slots__ = ('name', 'presses', 'holdTotal', 'holdMax', 'pressedAt')
+
+    def __init__(self, name):
+        self.name = name
+        self.presses = [0] * KEY_COUNT
+        self.holdTotal = [0.0] * KEY_COUNT
+        self.holdMax = [0.0] * KEY_COUNT
+        self.pressedAt = [0.0] * KEY_COUNT
+
+    def reset(self):
+        """
+            Zeroes the counters in place, the device worker holds references to them. Keys held down stay held.
+        """
+        self.presses[:] = [0] * KEY_COUNT
+        self.holdTotal[:] = [0.0] * KEY_COUNT
+        self.holdMax[:] = [0.0] * KEY_COUNT
+
+    def key_event(self, code, value, timestamp):
+        """
+            Counts an EV_KEY event. The device worker counts presses inline and only calls 'release'.
+        """
+        if value == 1:
+            self.presses[code] += 1
+            self.pressedAt[code] = timestamp
+        elif value == 0:
+            self.release(code, timestamp)
+
+    def release(self, code, timestamp):
+        pressedAt = self.pressedAt[code]
+        if pressedAt:
+            hold = timestamp - pressedAt
+            self.pressedAt[code] = 0.0
+            self.holdTotal[code] += hold
+            if hold > self.holdMax[code]:
+                self.holdMax[code] = hold
+
+    def take(self):
+        """
+            Copies the counters and resets them. This has to run on the thread of the device worker that updates them
+            or presses counted in between are lost.
+        :return: KeyUsage
+        """
+        snapshot = KeyUsage(self.name)
+        snapshot.merge(self)
+        self.reset()
+        return snapshot
+
+    def merge(self, other):
+        self.presses[:] = [a + b for a, b in zip(self.presses, other.presses)]
+        self.holdTotal[:] = [a + b for a, b in zip(self.holdTotal, other.holdTotal)]
+        self.holdMax[:] = [max(a, b) for a, b in zip(self.holdMax, other.holdMax)]
+
+    def top(self, limit=None):
+        """
+            The keys that were pressed sorted by how often.
+        :return: list - (code, presses, average hold, longest hold) tuples
+        """
+        keys = [(code, count, self.holdTotal[code] / count, self.holdMax[code])
+                for code, count in enumerate(self.presses) if count]
+        keys.sort(key=lambda key: key[1], reverse=True)
+        return keys[:limit] if limit else keys
+
+
+class KeyStats(object):
+    """
+        The KeyUsage of every device of every seat and the file they are kept in. The devices of a seat are stored
+        as 'seat:device' in the file. 'take' collects what was counted since the last time on the thread of a seat and
+        'write' adds it to the counts that were already in the file.
+    """
+
+    path = None
+    usages = None
+
+    _lock = None
+
+    def __init__(self, path):
+        super(KeyStats, self).__init__()
+        self.path = path
+        self.usages = {}
+        self._lock = threading.Lock()
+
+    def usage(self, seat, name):
+        """
+        :param seat: str - The name of the seat or None for the devices of no seat.
+        :param name: str - The name of the device.
+        :return: KeyUsage
+        """
+        usage = self.usages.get((seat, name))
+        if usage is None:
+            usage = self.usages[(seat, name)] = KeyUsage(name if seat is None else f'{seat}:{name}')
+        return usage
+
+    def take(self, seat):
+        """
+            Copies and resets the counters of the devices of a seat. Run it on the loop of the seat.
+        :param seat: str
+        :return: list - KeyUsage objects
+        """
+        return [usage.take() for (usageSeat, name), usage in self.usages.items() if usageSeat == seat]
+
+    def write(self, usages):
+        """
+            Adds counters to the file. This only does file I/O so it can run in an executor.
+        :param usages: list - KeyUsage objects
+        :return: dict - The KeyUsage of every device in the file.
+        """
+        with self._lock:
+            totals = read_key_stats(self.path) if os.path.exists(self.path) else {}
+            for usage in usages:
+                total = totals.get(usage.name)
+                if total is None:
+                    total = totals[usage.name] = KeyUsage(usage.name)
+                total.merge(usage)
+            write_key_stats(self.path, totals)
+        return totals
+
+    def flush(self):
+        """
+            Adds the counters of every seat to the file and resets them. Keys held down stay held. Only call this once
+            the device workers have stopped.
+        :return: dict - The KeyUsage of every device in the file.
+        """
+        return self.write([usage.take() for usage in self.usages.values()])
+
+
+def write_key_stats(path, usages):
+    tmpPath = f'{path}.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(usages), KEY_COUNT))
+        for name, usage in usages.items():
+            encoded = name.encode('utf-8')
+            f.write(NAME.pack(len(encoded)))
+            f.write(encoded)
+            for attr, typecode in COUNTERS:
+                f.write(array.array(typecode, getattr(usage, attr)).tobytes())
+    os.replace(tmpPath, path)
+
+
+def read_key_stats(path):
+    """
+        Reads a key stats file.
+    :param path: str
+    :return: dict - KeyUsage objects by device name.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, count, keyCount = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a key stats file of version {VERSION}')
+    offset = HEADER.size
+    usages = {}
+    for _ in range(count):
+        length, = NAME.unpack_from(data, offset)
+        offset += NAME.size
+        name = data[offset:offset + length].decode('utf-8')
+        offset += length
+        usage = usages[name] = KeyUsage(name)
+        for attr, typecode in COUNTERS:
+            stored = array.array(typecode, data[offset:offset + 8 * keyCount])
+            offset += 8 * keyCount
+            # Files written with a different KEY_CNT are cut or padded to this one
+            getattr(usage, attr)[:min(keyCount, KEY_COUNT)] = stored.tolist()[:KEY_COUNT]
+    return usages
+
+
+def format_key_stats(usages, limit=None):
+    lines = []
+    for name, usage in sorted(usages.items()):
+        keys = usage.top(limit)
+        lines.append(f'\n{name}: {sum(usage.presses)} presses')
+        lines.append(f"  {'KEY':<24}{'PRESSES':>10}{'SHARE':>8}{'AVG HOLD':>11}{'MAX HOLD':>11}")
+        total = sum(usage.presses) or 1
+        for code, count, average, longest in keys:
+            keyName = ecodes.KEY.get(code, ecodes.BTN.get(code, code))
+            if isinstance(keyName, list):
+                keyName = keyName[0]
+            lines.append(f'  {keyName:<24}{count:>10}{count / total:>8.1%}{average * 1000:>9.0f}ms'
+                         f'{longest * 1000:>9.0f}ms')
+    return '\n'.join(lines)
+
+
+async def key_stats_writer(keyStats, seats, interval=60):
+    """
+        Writes the key stats every 'interval' seconds until cancelled. The counters of each seat are taken on the
+        seat's own loop and the file is written in an executor so no device worker waits for the disk.
+    :param keyStats: KeyStats object
+    :param seats: list - Seat objects
+    :param interval: float
+    """
+    log.info(f'Writing key stats to {keyStats.path} every {interval} seconds')
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            usages = []
+            for seat in seats:
+                usages.extend(await seat.call_async(keyStats.take, seat.name))
+            await loop.run_in_executor(None, keyStats.write, usages)
+        except Exception as e:
+            log.error(f'Error writing key stats: {e}')
+            log.debug(f'[DEBUG] for key_stats_writer: {traceback.format_exc()}')
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package holds the storage for key mapping tables. Every table is a fixed-size code to code array
+#   of KEY_CNT unsigned shorts that lives inside a single 'multiprocessing.shared_memory' block so that every process
+#   (IE: the forked GameMonitor) reads the same tables without pickling or duplicating them.
+
+
+import logging
+import struct
+from array import array
+from evdev import ecodes
+
+
+log = logging.getLogger('KeyTables')
+
+
+PASSTHROUGH = 0     # KEY_RESERVED is never a valid output so 0 marks a code that is not remapped.
+TABLE_SIZE = ecodes.KEY_CNT
+NAME_SIZE = 64
+HEADER = struct.Struct('<QII')  # generation, table count, table size
+
+
+class SharedKeyTables(object):
+    """
+        This class manages a block of memory that holds key mapping tables. The layout of the block is:
+            header: generation counter (uint64), number of directory slots used (uint32), entries per table (uint32)
+            directory: 'capacity' utf-8 names of NAME_SIZE bytes each, an empty name is a released slot
+            tables: 'capacity' arrays of TABLE_SIZE uint16 entries each
+        The generation counter is incremented every time a table is changed so readers in other processes can tell
+        when the tables they are looking at have been updated. If shared memory is not available on the box the block
+        falls back to a private bytearray with the same layout.
+    """
+
+    capacity = None
+    shm = None
+    buf = None
+    names = None
+
+    _header = None
+    _words = None
+    _views = None
+    _slots = 0
+    _free = None
+
+    def __init__(self, capacity=16, name=None, shared=True):
+        """
+            Creates a new block of tables or attaches to an existing one when 'name' is provided.
+        :param capacity: int - The maximum amount of tables this block can hold.
+        :param name: str - The name of an existing shared memory block to attach to.
+        :param shared: bool - Default True: Set to False to keep the tables private to this process.
+        """
+        super(SharedKeyTables, self).__init__()
+        self.capacity = int(capacity)
+        self.names = {}
+        self._views = {}
+        self._free = []
+        size = SharedKeyTables.block_size(self.capacity)
+        if shared:
+            try:
+                from multiprocessing import shared_memory
+                if name is None:
+                    self.shm = shared_memory.SharedMemory(create=True, size=size)
+                else:
+                    self.shm = shared_memory.SharedMemory(name=name)
+            except (ImportError, OSError) as e:
+                log.warning(f'Unable to use shared memory for key tables falling back to private memory: {e}')
+                self.shm = None
+        self.buf = self.shm.buf if self.shm is not None else memoryview(bytearray(size))
+        self._header = self.buf[:HEADER.size]
+        self._words = self.buf[0:8].cast('Q')
+        if name is None:
+            HEADER.pack_into(self._header, 0, 0, 0, TABLE_SIZE)
+        else:
+            self._load_directory()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    @property
+    def name(self):
+        return self.shm.name if self.shm is not None else None
+
+    @property
+    def generation(self):
+        return self._words[0]
+
+    def bump_generation(self):
+        """
+            Signals to readers that one or more tables have been changed.
+        :return: int - the new generation
+        """
+        self._words[0] = self._words[0] + 1
+        return self._words[0]
+
+    def table(self, key):
+        """
+            Returns the table associated with the key. A new zeroed table is allocated if the key is not known yet.
+        :param key: str
+        :return: memoryview of unsigned shorts indexed by input code.
+        """
+        if key in self.names:
+            return self._view(self.names[key])
+        if self._free:
+            index = min(self._free)
+            self._free.remove(index)
+        elif self._slots < self.capacity:
+            index = self._slots
+            self._slots += 1
+        else:
+            raise MemoryError(f'The key table block is full, unable to allocate a table for: {key}')
+        encoded = key.encode('utf-8')[:NAME_SIZE]
+        offset = HEADER.size + (index * NAME_SIZE)
+        self.buf[offset:offset + NAME_SIZE] = encoded.ljust(NAME_SIZE, b'\0')
+        self.names[key] = index
+        HEADER.pack_into(self._header, 0, self.generation, self._slots, TABLE_SIZE)
+        return self._view(index)
+
+    def release(self, key):
+        """
+            Frees the slot of a table so it can be handed out again by 'table'. The table is cleared. Anything still
+            holding the table will see the next table that is allocated in its slot.
+        :param key: str
+        :return: bool - False if the key was not known.
+        """
+        index = self.names.pop(key, None)
+        if index is None:
+            return False
+        clear_table(self._view(index))
+        offset = HEADER.size + (index * NAME_SIZE)
+        self.buf[offset:offset + NAME_SIZE] = bytes(NAME_SIZE)
+        self._free.append(index)
+        return True
+
+    def get(self, key, default=None):
+        if key not in self.names:
+            return default
+        return self._view(self.names[key])
+
+    def close(self):
+        """
+            Releases every view handed out by this object and detaches from the shared memory block.
+        :return: None
+        """
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        self._words.release()
+        self._header.release()
+        if self.shm is not None:
+            self.shm.close()
+
+    def unlink(self):
+        """
+            Destroys the shared memory block. Only the process that created the block should call this.
+        :return: None
+        """
+        if self.shm is not None:
+            self.shm.unlink()
+
+    def _view(self, index):
+        if index not in self._views:
+            start = HEADER.size + (self.capacity * NAME_SIZE) + (index * TABLE_SIZE * 2)
+            self._views[index] = self.buf[start:start + (TABLE_SIZE * 2)].cast('H')
+        return self._views[index]
+
+    def _load_directory(self):
+        generation, count, tableSize = HEADER.unpack_from(self._header, 0)
+        if tableSize != TABLE_SIZE:
+            raise ValueError(f'Key table size mismatch: {tableSize} != {TABLE_SIZE}')
+        self._slots = count
+        for index in range(count):
+            offset = HEADER.size + (index * NAME_SIZE)
+            name = bytes(self.buf[offset:offset + NAME_SIZE]).rstrip(b'\0').decode('utf-8')
+            if name:
+                self.names[name] = index
+            else:
+                self._free.append(index)
+
+    @staticmethod
+    def block_size(capacity):
+        return HEADER.size + (capacity * NAME_SIZE) + (capacity * TABLE_SIZE * 2)
+
+
+class DeviceRecord(object):
+    """
+        A compact record of the key tables used for a single device. 'table' is the device's own table from
+        'devices.d' and 'active' is a private dense table that has the active profile merged on top of it. The
+        'active' table is what is indexed by input code for every event. 'turbo' and 'repeat' hold the periods in
+        seconds of the keys that have turbo or a custom repeat rate and 'timed' flags those keys for the worker.
+        'latched' holds the output code each held key was pressed as, 0 for keys that are not held.
+    """
+
+    __slots__ = ('name', 'table', 'active', 'generation', 'rates', 'turbo', 'repeat', 'timed', 'repeatDelay',
+                 'latched')
+
+    def __init__(self, name, table):
+        self.name = name
+        self.table = table
+        self.active = new_table()
+        self.generation = -1
+        self.rates = {}
+        self.turbo = array('d', bytes(TABLE_SIZE * 8))
+        self.repeat = array('d', bytes(TABLE_SIZE * 8))
+        self.timed = bytearray(TABLE_SIZE)
+        self.repeatDelay = 0.25
+        self.latched = new_table()
+
+    def __repr__(self):
+        return f'DeviceRecord({self.name}, mapped={count_mapped(self.active)})'
+
+
+def new_table():
+    """
+        Creates a private table with every code set to PASSTHROUGH.
+    :return: array of unsigned shorts
+    """
+    return array('H', bytes(TABLE_SIZE * 2))
+
+
+def clear_table(table):
+    """
+        Sets every code in the table back to PASSTHROUGH.
+    :param table: array or memoryview of unsigned shorts
+    :return: table
+    """
+    with memoryview(new_table()) as empty:
+        table[:] = empty
+    return table
+
+
+def merge_tables(dst, base, *overlays):
+    """
+        Copies 'base' into 'dst' and then writes every remapped code from each overlay on top of it. Later overlays
+        win. None overlays are skipped.
+    :param dst: array or memoryview of unsigned shorts
+    :param base: array or memoryview of unsigned shorts
+    :param overlays: array or memoryview of unsigned shorts
+    :return: dst
+    """
+    with memoryview(dst) as view:
+        view[:] = memoryview(base)
+    for overlay in overlays:
+        if overlay is None:
+            continue
+        for code, mapped in enumerate(overlay):
+            if mapped != PASSTHROUGH:
+                dst[code] = mapped
+    return dst
+
+
+def merge_rates(record, *overlays):
+    """
+        Rebuilds the turbo and repeat periods of a DeviceRecord from dictionaries of {code: (turbo, repeat)}. Later
+        overlays win. None overlays are skipped.
+    :param record: DeviceRecord
+    :param overlays: dict
+    :return: record
+    """
+    for code in [code for code, timed in enumerate(record.timed) if timed]:
+        record.turbo[code] = record.repeat[code] = 0.0
+        record.timed[code] = 0
+    for overlay in overlays:
+        for code, (turbo, repeat) in (overlay or {}).items():
+            record.turbo[code] = turbo
+            record.repeat[code] = repeat
+            record.timed[code] = 1 if turbo or repeat else 0
+    return record
+
+
+def count_mapped(table):
+    return sum(1 for mapped in table if mapped != PASSTHROUGH)
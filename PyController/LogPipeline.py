@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package keeps logging off the event loop. With the log queue enabled records are put on a queue by
+#   the device workers and written by a background thread so a slow terminal or disk never delays an event. The per
+#   event code paths log through a SampledLogger which only lets a few records a second through, and the log can also
+#   be written as JSON lines for tools to read.
+
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+
+LOG_FORMAT = '%(module)s %(funcName)s %(lineno)s %(message)s'
+_samplers = []
+_jsonSinks = {}
+_queueLogging = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+        Formats a record as one JSON object per line.
+    """
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'module': record.module,
+                 'function': record.funcName,
+                 'line': record.lineno,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+        A QueueHandler that leaves formatting the message to the listener thread. The queue never leaves the process
+        so the record does not have to be made picklable first. Arguments passed to a sampled logger therefore have to
+        be values that are not changed afterwards, IE: ints instead of an InputEvent.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class QueueLogging(object):
+    """
+        Moves the handlers of the root logger behind a queue and a QueueListener thread. A process forked afterwards,
+        like the GameMonitor, has no listener thread so it gets the original handlers back.
+    """
+
+    root = None
+    queue = None
+    handler = None
+    listener = None
+    handlers = None
+    registered = False
+
+    def __init__(self, root=None):
+        super(QueueLogging, self).__init__()
+        self.root = root or logging.getLogger()
+        self.queue = queue.SimpleQueue()
+        self.handler = LazyQueueHandler(self.queue)
+
+    def start(self):
+        """
+            Starts the listener thread with the root logger's handlers.
+        :return: QueueLogging - self
+        """
+        if self.listener is not None:
+            return self
+        self.handlers = list(self.root.handlers)
+        for handler in self.handlers:
+            self.root.removeHandler(handler)
+        self.root.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        if not self.registered:
+            atexit.register(self.stop)
+            self.registered = True
+        return self
+
+    def stop(self):
+        """
+            Writes what is left on the queue and puts the original handlers back.
+        :return: None
+        """
+        if self.listener is None:
+            return
+        self.restore()
+        self.listener.stop()
+        self.listener = None
+
+    def add_handler(self, handler):
+        """
+            Adds a handler behind the queue. The listener is restarted as its handlers can not be changed while it
+            runs.
+        """
+        self.listener.stop()
+        self.handlers.append(handler)
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def restore(self):
+        self.root.removeHandler(self.handler)
+        for handler in self.handlers or ():
+            self.root.addHandler(handler)
+
+    def after_fork(self):
+        if self.listener is not None:
+            self.restore()
+            self.listener = None
+
+
+class SampledLogger(object):
+    """
+        A debug logger for code that runs for every event. Callers check 'enabled' first, which is a plain attribute
+        so a disabled sampler costs nothing more than that. When enabled every 'every'th call is considered and at
+        most 'perSecond' records are written each second. How many were skipped is added to the next record written.
+    """
+
+    __slots__ = ('logger', 'every', 'perSecond', 'clock', 'enabled', 'count', 'window', 'budget', 'suppressed')
+
+    def __init__(self, name, every=1, perSecond=20, clock=time.monotonic):
+        """
+        :param name: str - The name of the logger to write to.
+        :param every: int - Only every n-th call is considered.
+        :param perSecond: int - The most records written each second.
+        :param clock: callable
+        """
+        self.logger = logging.getLogger(name)
+        self.every = max(1, int(every))
+        self.perSecond = perSecond
+        self.clock = clock
+        self.count = 0
+        self.window = 0.0
+        self.budget = 0
+        self.suppressed = 0
+        self.refresh()
+
+    def refresh(self):
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        self.count += 1
+        if self.count % self.every:
+            self.suppressed += 1
+            return
+        now = self.clock()
+        if now - self.window >= 1.0:
+            self.window = now
+            self.budget = self.perSecond
+        if self.budget <= 0:
+            self.suppressed += 1
+            return
+        self.budget -= 1
+        if self.suppressed:
+            msg += ' (%d suppressed)'
+            args += (self.suppressed,)
+            self.suppressed = 0
+        self.logger.debug(msg, *args, stacklevel=2)
+
+
+def sampled_logger(name, every=1, perSecond=20):
+    """
+        Creates a SampledLogger that is refreshed by 'refresh_samplers' when the log levels change.
+    :return: SampledLogger object
+    """
+    sampler = SampledLogger(name, every=every, perSecond=perSecond)
+    _samplers.append(sampler)
+    return sampler
+
+
+def refresh_samplers():
+    for sampler in _samplers:
+        sampler.refresh()
+
+
+def add_json_sink(path, level=logging.NOTSET):
+    """
+        Adds a handler to the root logger that writes JSON lines to 'path'. It is only added once per path.
+    :return: logging.FileHandler object
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    handler = _jsonSinks.get(path)
+    if handler is None:
+        handler = _jsonSinks[path] = logging.FileHandler(path)
+        handler.setFormatter(JsonLinesFormatter())
+        if _queueLogging is not None and _queueLogging.listener is not None:
+            _queueLogging.add_handler(handler)
+        else:
+            logging.getLogger().addHandler(handler)
+    handler.setLevel(level)
+    return handler
+
+
+def start_queue_logging():
+    """
+        Puts the handlers of the root logger behind a queue. The queue is flushed when the program exits. Calling it
+        again returns the running QueueLogging.
+    :return: QueueLogging object
+    """
+    global _queueLogging
+    if _queueLogging is None:
+        _queueLogging = QueueLogging()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_queueLogging.after_fork)
+    return _queueLogging.start()
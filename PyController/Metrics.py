@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: Renders the counters kept by the device workers and the KeyMapper in the Prometheus text exposition
+#   format. The text can be written periodically to a file (IE: for the node_exporter textfile collector) or read
+#   through the 'metrics' command of the control socket.
+
+
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+
+log = logging.getLogger('Metrics')
+
+
+DEVICE_COUNTERS = (
+    ('eventsIn', 'pycontroller_events_in_total', 'Input events read from the device.'),
+    ('eventsOut', 'pycontroller_events_out_total', 'Events written to the output device.'),
+    ('remapped', 'pycontroller_events_remapped_total', 'Key events changed by a keymap.'),
+    ('passthrough', 'pycontroller_events_passthrough_total', 'Key events passed through unchanged.'),
+    ('filtered', 'pycontroller_events_filtered_total', 'Events dropped by the debounce and scan code filter.'),
+    ('dropped', 'pycontroller_events_dropped_total', 'Events that were lost or discarded.'),
+    ('synDropped', 'pycontroller_syn_dropped_total', 'Times the kernel dropped events because the buffer overflowed.'),
+    ('resynced', 'pycontroller_keys_resynced_total', 'Keys pressed or released to resync after dropped events.'),
+    ('restarts', 'pycontroller_worker_restarts_total', 'Times the device worker has been restarted.'),
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(pyc, now=None):
+    """
+        Adds up the per worker counters and renders them. This is only done when the metrics are read so the workers
+        never pay for it.
+    :param pyc: PyController object
+    :param now: float - The current time, defaults to time.time()
+    :return: str
+    """
+    now = time.time() if now is None else now
+    seats = list(pyc.seats.values())
+    devices = [device for seat in seats for device in seat.devManager.devices if device.isValid]
+    keymappers = [seat.keymapper for seat in seats]
+    lines = []
+
+    for attr, metric, description in DEVICE_COUNTERS:
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} counter')
+        for device in devices:
+            lines.append(f'{metric}{{device="{_escape(device.name)}"}} {getattr(device.stats, attr)}')
+
+    lines.append('# HELP pycontroller_seconds_since_last_event Seconds since the device produced an event.')
+    lines.append('# TYPE pycontroller_seconds_since_last_event gauge')
+    for device in devices:
+        since = now - device.stats.lastEvent if device.stats.lastEvent else -1
+        lines.append(f'pycontroller_seconds_since_last_event{{device="{_escape(device.name)}"}} {since:.6f}')
+
+    lines.append('# HELP pycontroller_latency_seconds_max Highest latency from the kernel timestamp to the write.')
+    lines.append('# TYPE pycontroller_latency_seconds_max gauge')
+    for device in devices:
+        lines.append(f'pycontroller_latency_seconds_max{{device="{_escape(device.name)}"}} '
+                     f'{device.stats.latencyMax:.6f}')
+
+    # Every seat has its own TimerWheel and profile state, the totals are across all seats
+    timers = [keymapper.timers.stats for keymapper in keymappers]
+    lines.append('# HELP pycontroller_timer_fired_total Turbo and repeat events written by the TimerWheel.')
+    lines.append('# TYPE pycontroller_timer_fired_total counter')
+    lines.append(f'pycontroller_timer_fired_total {sum(stats.fired for stats in timers)}')
+    lines.append('# HELP pycontroller_timer_skipped_total Times the TimerWheel fell a full period behind.')
+    lines.append('# TYPE pycontroller_timer_skipped_total counter')
+    lines.append(f'pycontroller_timer_skipped_total {sum(stats.skipped for stats in timers)}')
+    lines.append('# HELP pycontroller_timer_lateness_seconds_max Highest delay of a turbo or repeat event.')
+    lines.append('# TYPE pycontroller_timer_lateness_seconds_max gauge')
+    lines.append(f'pycontroller_timer_lateness_seconds_max {max(stats.latenessMax for stats in timers):.6f}')
+    lines.append('# HELP pycontroller_timer_lateness_seconds_total Total delay of turbo and repeat events.')
+    lines.append('# TYPE pycontroller_timer_lateness_seconds_total counter')
+    lines.append(f'pycontroller_timer_lateness_seconds_total {sum(stats.latenessTotal for stats in timers):.6f}')
+
+    lines.append('# HELP pycontroller_profile_switches_total Times the active profile has changed.')
+    lines.append('# TYPE pycontroller_profile_switches_total counter')
+    lines.append(f'pycontroller_profile_switches_total {sum(keymapper.profileSwitches for keymapper in keymappers)}')
+
+    lines.append('# HELP pycontroller_translated_keys_total Held keys moved to their new output by a keymap change.')
+    lines.append('# TYPE pycontroller_translated_keys_total counter')
+    lines.append(f'pycontroller_translated_keys_total {sum(keymapper.translatedKeys for keymapper in keymappers)}')
+
+    lines.append('# HELP pycontroller_active_profile The profile that is currently active.')
+    lines.append('# TYPE pycontroller_active_profile gauge')
+    for seat in seats:
+        if seat.keymapper.activeProfile is not None:
+            lines.append(f'pycontroller_active_profile{{seat="{_escape(seat.label)}",'
+                         f'profile="{_escape(seat.keymapper.activeProfile)}"}} 1')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(pyc, path):
+    """
+        Writes the metrics to a temporary file and moves it into place so readers never see a partial file.
+    :param pyc: PyController object
+    :param path: str
+    :return: None
+    """
+    tmpPath = f'{path}.tmp'
+    with open(tmpPath, 'w') as f:
+        f.write(render_metrics(pyc))
+    os.replace(tmpPath, path)
+
+
+async def metrics_writer(pyc, path, interval=15):
+    """
+        Writes the metrics file every 'interval' seconds until cancelled.
+    :param pyc: PyController object
+    :param path: str
+    :param interval: float
+    """
+    log.info(f'Writing metrics to {path} every {interval} seconds')
+    while True:
+        try:
+            write_metrics(pyc, path)
+        except Exception as e:
+            log.error(f'Error writing metrics: {e}')
+            log.debug(f'[DEBUG] for metrics_writer: {traceback.format_exc()}')
+        await asyncio.sleep(interval)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package pools the virtual (UInput) output devices. Devices that name the same 'output' in their
+#   yaml config share one virtual device that advertises the capabilities of all of them. Outputs live for as long as
+#   PyController does so reloading the configs or restarting a device worker never makes the OS see a new keyboard.
+#   Optionally the outputs are held by a separate long lived 'pyc --output-helper' process which hands PyController
+#   the file descriptor of each output over a UNIX socket, then PyController can be restarted without the outputs
+#   being torn down.
+
+
+import array
+import json
+import logging
+import os
+import socket
+import traceback
+from evdev import UInput, AbsInfo
+from PyController.ControlServer import LENGTH, encode_message, decode_length
+from PyController.Feedback import FeedbackForwarder
+from PyController.RelMap import EVENT, SYN_REPORT
+
+
+log = logging.getLogger('Outputs')
+
+
+def send_fd(sock, data, fd):
+    """
+        Sends data with a file descriptor attached to the first byte.
+    """
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+
+
+def recv_fd(sock, size):
+    """
+        Receives up to 'size' bytes and the file descriptor attached to them if there is one.
+    :return: tuple - (bytes, int or None)
+    """
+    fds = array.array('i')
+    data, ancdata, flags, address = sock.recvmsg(size, socket.CMSG_LEN(fds.itemsize))
+    for level, kind, cmsg in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg[:len(cmsg) - (len(cmsg) % fds.itemsize)])
+    return data, (fds[0] if fds else None)
+
+
+def encode_capabilities(caps):
+    """
+        Turns a capabilities dict into something JSON can hold. EV_ABS entries are (code, AbsInfo) tuples.
+    """
+    return {str(evType): [list(code) if isinstance(code, tuple) else code for code in codes]
+            for evType, codes in caps.items()}
+
+
+def decode_capabilities(caps):
+    return {int(evType): [(code[0], AbsInfo(*code[1])) if isinstance(code, list) else code for code in codes]
+            for evType, codes in caps.items()}
+
+
+def merge_capabilities(caps, newCaps):
+    """
+        Adds 'newCaps' to 'caps' in place. The first AbsInfo seen for an axis wins.
+    :return: dict - caps
+    """
+    for evType, codes in newCaps.items():
+        merged = caps.setdefault(evType, [])
+        seen = {code[0] if isinstance(code, tuple) else code for code in merged}
+        for code in codes:
+            if (code[0] if isinstance(code, tuple) else code) not in seen:
+                merged.append(code)
+                seen.add(code[0] if isinstance(code, tuple) else code)
+    return caps
+
+
+def missing_capabilities(caps, wanted):
+    """
+        Returns the codes in 'wanted' that 'caps' does not have.
+    """
+    missing = {}
+    for evType, codes in wanted.items():
+        have = {code[0] if isinstance(code, tuple) else code for code in caps.get(evType, [])}
+        lost = [code for code in codes if (code[0] if isinstance(code, tuple) else code) not in have]
+        if lost:
+            missing[evType] = lost
+    return missing
+
+
+class RemoteOutput(object):
+    """
+        An output device held by the OutputHelper process. Only the file descriptor lives in PyController and events
+        are written to it directly so this is as fast as a local UInput.
+    """
+
+    name = None
+    fd = None
+    caps = None
+
+    def __init__(self, name, fd, caps):
+        super(RemoteOutput, self).__init__()
+        self.name = name
+        self.fd = fd
+        self.caps = caps
+
+    def __str__(self):
+        return f'{self.name} - fd {self.fd} (output helper)'
+
+    def capabilities(self, verbose=False, absinfo=True):
+        return self.caps
+
+    def write(self, etype, code, value):
+        os.write(self.fd, EVENT.pack(0, 0, etype, code, value))
+
+    def write_event(self, event):
+        os.write(self.fd, EVENT.pack(event.sec, event.usec, event.type, event.code, event.value))
+
+    def syn(self):
+        os.write(self.fd, SYN_REPORT)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class OutputManager(object):
+    """
+        Hands out one output device per logical output name. Every Device first 'reserve's the capabilities it needs so
+        that the output is created once with all of them, then 'acquire's it. An output is closed when the last Device
+        using it releases it. Force feedback and LED writes to an output are forwarded to the Devices using it by one
+        FeedbackForwarder per output.
+    """
+
+    helperPath = None
+    capabilities = None
+    outputs = None
+    users = None
+    uinput = None
+    feedbacks = None
+
+    def __init__(self, helperPath=None, uinput=None):
+        """
+        :param helperPath: str - The UNIX socket of an OutputHelper. When None the outputs are created locally.
+        :param uinput: callable - Creates a local output from (caps, name=name). Defaults to evdev's UInput.
+        """
+        super(OutputManager, self).__init__()
+        self.helperPath = helperPath
+        self.uinput = uinput or UInput
+        self.capabilities = {}
+        self.outputs = {}
+        self.users = {}
+        self.feedbacks = {}
+
+    def reserve(self, name, caps):
+        merge_capabilities(self.capabilities.setdefault(name, {}), caps)
+
+    def acquire(self, name, user):
+        """
+            Returns the output device for 'name' creating it the first time.
+        :param name: str - The logical output name.
+        :param user: str - The name of the Device using it.
+        :return: UInput or RemoteOutput object
+        """
+        output = self.outputs.get(name)
+        if output is None:
+            caps = self.capabilities.get(name, {})
+            if self.helperPath:
+                output = self.open_remote(name, caps)
+            if output is None:
+                log.info(f'Creating output device: {name}')
+                output = self.uinput(caps, name=name)
+            self.outputs[name] = output
+        elif missing_capabilities(output.capabilities(), self.capabilities.get(name, {})):
+            log.warning(f'The output device: {name} is missing capabilities needed by Device: {user}. The output '
+                        f'needs to be recreated which requires a restart.')
+        self.users.setdefault(name, set()).add(user)
+        return output
+
+    def open_remote(self, name, caps):
+        try:
+            return request_output(self.helperPath, name, caps)
+        except Exception as e:
+            log.warning(f'Unable to get the output device: {name} from the output helper at {self.helperPath}, '
+                        f'creating it locally instead: {e}')
+            log.debug(f'[DEBUG] for open_remote: {traceback.format_exc()}')
+        return None
+
+    def feedback(self, name):
+        """
+            Returns the FeedbackForwarder of the output 'name' creating it the first time. Only outputs the kernel
+            sends feedback to have one.
+        :param name: str - The logical output name.
+        :return: FeedbackForwarder object or None
+        """
+        forwarder = self.feedbacks.get(name)
+        output = self.outputs.get(name)
+        if forwarder is None and isinstance(output, (UInput, RemoteOutput)):
+            forwarder = self.feedbacks[name] = FeedbackForwarder(output)
+        return forwarder
+
+    def release(self, name, user):
+        users = self.users.get(name, set())
+        users.discard(user)
+        if users or name not in self.outputs:
+            return
+        output = self.outputs.pop(name)
+        self.users.pop(name, None)
+        forwarder = self.feedbacks.pop(name, None)
+        if forwarder is not None:
+            forwarder.stop()
+        log.info(f'Closing output device: {name}')
+        try:
+            output.syn()
+        finally:
+            output.close()
+
+    def close(self):
+        for name in list(self.outputs):
+            self.users[name] = set()
+            self.release(name, None)
+
+    def as_dict(self):
+        return {name: {'users': sorted(self.users.get(name, ())),
+                       'remote': isinstance(output, RemoteOutput),
+                       'feedback': self.feedbacks[name].as_dict() if name in self.feedbacks else None}
+                for name, output in self.outputs.items()}
+
+
+class OutputHelper(object):
+    """
+        A small long lived server that creates and holds the output devices for PyController. A request is a
+        {"command": "acquire", "name": ..., "caps": ...} message framed like the control socket. The response is
+        {"ok": true, "caps": ...} with the file descriptor of the output attached. Outputs are only closed when the
+        helper exits.
+    """
+
+    path = None
+    outputs = None
+    sock = None
+
+    def __init__(self, path):
+        super(OutputHelper, self).__init__()
+        self.path = path
+        self.outputs = {}
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(4)
+        log.info(f'The output helper is listening at: {self.path}')
+        try:
+            while True:
+                conn, address = self.sock.accept()
+                with conn:
+                    self.handle_client(conn)
+        finally:
+            self.close()
+
+    def handle_client(self, conn):
+        try:
+            while True:
+                header = _recv_exactly(conn, LENGTH.size)
+                if not header:
+                    return
+                request = json.loads(_recv_exactly(conn, decode_length(header)).decode('utf-8'))
+                if request.get('command') != 'acquire':
+                    conn.sendall(encode_message({'ok': False, 'error': f"Unknown command: {request.get('command')}"}))
+                    continue
+                output = self.open(str(request['name']), decode_capabilities(request.get('caps') or {}))
+                send_fd(conn, encode_message({'ok': True, 'caps': encode_capabilities(output.capabilities())}),
+                        output.fd)
+        except Exception as e:
+            log.error(f'Error in the output helper client: {e}')
+            log.debug(f'[DEBUG] for the output helper client: {traceback.format_exc()}')
+
+    def open(self, name, caps):
+        output = self.outputs.get(name)
+        if output is not None:
+            missing = missing_capabilities(output.capabilities(), caps)
+            if not missing:
+                return output
+            # A UInput cannot gain capabilities, the output is recreated which the OS sees as a new device.
+            log.warning(f'Recreating output device: {name} to add capabilities: {missing}')
+            merge_capabilities(caps, output.capabilities())
+            output.close()
+        log.info(f'Creating output device: {name}')
+        output = UInput(caps, name=name)
+        self.outputs[name] = output
+        return output
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
+        self.outputs = {}
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def request_output(path, name, caps, timeout=2.0):
+    """
+        Asks the OutputHelper at 'path' for the output device 'name'.
+    :return: RemoteOutput object
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(encode_message({'command': 'acquire', 'name': name, 'caps': encode_capabilities(caps)}))
+        header, fd = recv_fd(sock, LENGTH.size)
+        header += _recv_exactly(sock, LENGTH.size - len(header))
+        response = json.loads(_recv_exactly(sock, decode_length(header)).decode('utf-8'))
+    if not response.get('ok') or fd is None:
+        if fd is not None:
+            os.close(fd)
+        raise ConnectionError(response.get('error', 'The output helper did not send an output device'))
+    return RemoteOutput(name, fd, decode_capabilities(response.get('caps') or {}))
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError('The output helper socket closed in the middle of a message')
+            return data
+        data += chunk
+    return data
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: A sampling profiler for the device worker loop used by the '--profile-hotpath' flag. It only runs for
+#   a limited window. While it runs a background thread samples the stack of the asyncio thread and the device worker
+#   is timed per event broken down into read, map and write/syn. Reports are written in the collapsed stack format
+#   which can be turned into a flamegraph with 'flamegraph.pl' or speedscope.
+
+
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+log = logging.getLogger('Profiler')
+
+
+class PhaseTimes(object):
+    """
+        Time in seconds spent by a single device in each phase of the worker loop. 'read' is the time from the kernel's
+        timestamp on the event until the worker picked it up.
+    """
+
+    __slots__ = ('events', 'read', 'map', 'write')
+
+    def __init__(self):
+        self.events = 0
+        self.read = 0.0
+        self.map = 0.0
+        self.write = 0.0
+
+
+class HotPathProfiler(object):
+    """
+        Profiles the device worker loop for 'duration' seconds. The worker's 'map_event', 'write_event' and 'syn'
+        callables are wrapped with timed versions by 'wrap' so a worker that is not being profiled pays nothing. Once
+        the window closes the wrappers fall straight through to the real callables.
+    """
+
+    duration = None
+    interval = None
+    path = None
+    active = False
+    devices = None
+    stacks = None
+    samples = 0
+
+    _thread = None
+    _stopEvent = None
+    _threadId = None
+    _deadline = None
+    _reported = False
+
+    def __init__(self, path, duration=30.0, interval=0.005):
+        """
+        :param path: str - Where the collapsed stack report is written. The per device report is written next to it.
+        :param duration: float - How many seconds to profile for.
+        :param interval: float - How many seconds between stack samples.
+        """
+        super(HotPathProfiler, self).__init__()
+        self.path = path
+        self.duration = float(duration)
+        self.interval = float(interval)
+        self.devices = {}
+        self.stacks = {}
+        self._stopEvent = threading.Event()
+
+    def start(self):
+        """
+            Starts the window. This must be called from the thread running the asyncio loop.
+        :return: None
+        """
+        log.info(f'Profiling the device workers for {self.duration} seconds')
+        self._threadId = threading.get_ident()
+        self._deadline = time.monotonic() + self.duration
+        self.active = True
+        self._thread = threading.Thread(target=self._sample, name='HotPathProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+            Ends the window early if it is still open and writes the reports.
+        :return: None
+        """
+        self.active = False
+        self._stopEvent.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+        self.write_report()
+
+    def wrap(self, device, mapEvent, write_event, syn):
+        """
+            Returns timed versions of the callables used by the device worker.
+        :param device: Device object
+        :param mapEvent: callable
+        :param write_event: callable
+        :param syn: callable
+        :return: tuple - (mapEvent, write_event, syn)
+        """
+        times = self.devices.setdefault(device.name, PhaseTimes())
+        perf_counter = time.perf_counter
+        now = time.time
+
+        def timed_map_event(event, dev):
+            if not self.active:
+                return mapEvent(event, dev)
+            start = perf_counter()
+            times.read += now() - event.sec - (event.usec * 0.000001)
+            result = mapEvent(event, dev)
+            times.map += perf_counter() - start
+            times.events += 1
+            return result
+
+        def timed_write_event(event):
+            if not self.active:
+                return write_event(event)
+            start = perf_counter()
+            result = write_event(event)
+            times.write += perf_counter() - start
+            return result
+
+        def timed_syn():
+            if not self.active:
+                return syn()
+            start = perf_counter()
+            result = syn()
+            times.write += perf_counter() - start
+            return result
+
+        return timed_map_event, timed_write_event, timed_syn
+
+    def _sample(self):
+        try:
+            while not self._stopEvent.wait(self.interval):
+                if time.monotonic() >= self._deadline:
+                    log.info('The hot path profiling window has closed')
+                    self.active = False
+                    self.write_report()
+                    return
+                frame = sys._current_frames().get(self._threadId)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+        except Exception as e:
+            log.error(f'Error in the hot path profiler: {e}')
+            log.debug(f'[DEBUG] for the hot path profiler: {traceback.format_exc()}')
+
+    def write_report(self):
+        """
+            Writes the sampled stacks to 'path' and the per device phase times in microseconds to 'path' with a
+            '.devices' suffix. Both use the collapsed stack format: 'frame;frame;frame count'.
+        :return: None
+        """
+        if self._reported:
+            return
+        self._reported = True
+        try:
+            with open(self.path, 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f'{stack} {count}\n')
+            with open(f'{self.path}.devices', 'w') as f:
+                for name, times in sorted(self.devices.items()):
+                    for phase in ('read', 'map', 'write'):
+                        f.write(f'pycontroller;{name};{phase} {int(getattr(times, phase) * 1000000)}\n')
+            log.info(f'Wrote {self.samples} stack samples to {self.path}')
+            for line in self.summary():
+                log.info(line)
+        except Exception as e:
+            log.error(f'Unable to write the hot path profile: {e}')
+            log.debug(f'[DEBUG] for write_report: {traceback.format_exc()}')
+
+    def summary(self):
+        lines = []
+        for name, times in sorted(self.devices.items()):
+            if not times.events:
+                continue
+            lines.append(f'{name}: {times.events} events, average read {times.read / times.events * 1000000:.1f}us '
+                         f'map {times.map / times.events * 1000000:.1f}us '
+                         f'write/syn {times.write / times.events * 1000000:.1f}us')
+        return lines
@@ -10,16 +10,31 @@
 
 import logging
 import signal
+import json
+import os
+import queue
 import asyncio
 import warnings
 import traceback
 import sys
+import time
 from multiprocessing import Process, Value, Queue
 from PyController.ArgumentWrapper import getArguments, CLASSIC_KEYBOARD, CONTROLLER_BUTTONS
-from PyController.PyDevices import DeviceManager, async_device_worker, Device
-from PyController.SettingsManager import SettingsManager as Settings
+from PyController.PyDevices import Device
+from PyController.SettingsManager import SettingsManager as Settings, defaultSeat
 from PyController.GameMonitor import GameMonitor
-from PyController.KeyMap import KeyMapper
+from PyController.ControlServer import ControlServer, send_command
+from PyController.Metrics import metrics_writer
+from PyController.Profiler import HotPathProfiler
+from PyController.Outputs import OutputManager, OutputHelper
+from PyController.Simulation import Simulation
+from PyController.Compiler import ConfigCompiler
+from PyController.Seats import Seat
+from PyController.Benchmarks import BENCHMARKS
+from PyController.Forwarding import Forwarder, ForwardReceiver
+from PyController.FlightRecorder import FlightRecorder, dump_ring_file
+from PyController.KeyStats import KeyStats, key_stats_writer, read_key_stats, format_key_stats
+from PyController.LogPipeline import LOG_FORMAT, add_json_sink, start_queue_logging, refresh_samplers
 
 
 # For development debuging purposes ONLY
@@ -96,14 +111,47 @@ class PyController(object):
     gameMonitorTask = None
     keymapper = None
     asyncLoop = None
-
-    def __init__(self, arguments, install_dir=None):
+    controlServer = None
+    profiler = None
+    outputs = None
+    queue = None
+    clock = None
+    seats = None
+    keyStats = None
+    flightRecorder = None
+    gameMonitor = None
+    reloadLock = None
+
+    def __init__(self, arguments, install_dir=None, config_dir=None, inputDevices=None, uinput=None):
+        """
+            'config_dir', 'inputDevices' and 'uinput' replace the config directory, the devices under /dev/input and
+            the evdev UInput class. They are used by simulations.
+        """
         self.arguments = arguments
         self.install_dir = install_dir
-        self.settings = Settings(self.arguments, install_dir=self.install_dir)  # Manages settings
+        self.queue = global_queue
+        self.clock = time.time
+        self.settings = Settings(self.arguments, install_dir=self.install_dir, config_dir=config_dir)
         self.configure_logging()  # This uses the Settings manager to set the logging settings
-        self.keymapper = KeyMapper(self.settings)  # This is used by the DeviceManager and is passed to each Device
-        self.devManager = DeviceManager(self.settings, self.keymapper)  # This setups all the devices found in devices.d
+        if uinput is None and self.settings.forwardTo:
+            # The outputs are replayed by a PyController started with '--forward-receive' at that address
+            uinput = Forwarder(self.settings.forwardTo)
+        self.outputs = OutputManager(self.settings.outputHelper, uinput=uinput)  # Shares the output devices
+        # The devices that are not part of a seat. Its KeyMapper and DeviceManager are the ones used without seats.
+        # Profile key tables are built once in shared memory before forking.
+        seat = Seat(None, self.settings, self.outputs, inputDevices=inputDevices)
+        self.keymapper = seat.keymapper
+        self.devManager = seat.devManager
+        self.seats = {defaultSeat: seat}
+        for name, config in self.settings.seats.items():
+            threaded = config.get('thread')
+            if threaded and isinstance(uinput, Forwarder):
+                # A ForwardOutput sends its frames and heartbeats from the main loop, a seat thread writing to it at
+                # the same time would corrupt the frames.
+                log.warning(f"Seat {name} runs on the main event loop as 'thread' cannot be used with 'forwardTo'")
+                threaded = False
+            self.seats[name] = Seat(name, self.settings, self.outputs, inputDevices=self.devManager.inputDevices,
+                                    users=config.get('users'), threaded=threaded)
         self.devWorkers = []  # This is where the AsyncDeviceWorker coroutines/tasks are stored
 
     def setup(self, loop, killer):
@@ -112,16 +160,48 @@ class PyController(object):
         """
         log.info("Setting up PyController!")
         self.killer = killer
-        self.devManager.grab_devices()
+        for seat in self.seats.values():
+            seat.devManager.grab_devices()
+
+        if self.arguments.profile_hotpath:
+            self.profiler = HotPathProfiler(os.path.join(self.settings.configDir, 'hotpath.folded'),
+                                            duration=self.arguments.profile_hotpath)
+            self.profiler.start()
+
+        if self.settings.keyStats:
+            self.keyStats = KeyStats(self.settings.keyStatsFile)
+            for seat in self.seats.values():
+                for device in seat.devManager.devices:
+                    device.keyUsage = self.keyStats.usage(seat.name, device.name)
+            loop.create_task(key_stats_writer(self.keyStats, list(self.seats.values()),
+                                              self.settings.keyStatsInterval))
+
+        if self.settings.flightRecorder:
+            self.flightRecorder = FlightRecorder(self.settings.flightRecorderFile, self.settings.flightRecorder)
+            for seat in self.seats.values():
+                for device in seat.devManager.devices:
+                    device.recorder = self.flightRecorder
+            try:
+                loop.add_signal_handler(signal.SIGUSR1, self.dump_flight_recorder, 'Received SIGUSR1')
+            except (NotImplementedError, RuntimeError, ValueError) as e:
+                log.warning(f'Unable to dump the flight recorder on SIGUSR1: {e}')
 
         log.info("Making Device Input Tasks")
-        for device in self.devManager.devices:
-            if device.isValid:
-                self.devWorkers.append(loop.create_task(async_device_worker(device)))
+        for seat in self.seats.values():
+            seat.start(loop, profiler=self.profiler, clock=self.clock)
+            if not seat.threaded:
+                self.devWorkers.extend(seat.devWorkers)
 
         if self.settings.profilesConfig:
             self.gameMonitorTask = loop.create_task(self.game_monitor())
 
+        if self.settings.metricsFile:
+            loop.create_task(metrics_writer(self, self.settings.metricsFile, self.settings.metricsInterval))
+
+        if self.settings.controlSocket:
+            self.controlServer = ControlServer(self, self.settings.controlSocket)
+            loop.run_until_complete(self.controlServer.start())
+
         return self.devWorkers
 
     def run(self, *args, **kwargs):
@@ -143,6 +223,9 @@ class PyController(object):
             loop.run_forever()
         except KeyboardInterrupt:
             logging.info("Process interrupted")
+        except Exception as e:
+            self.dump_flight_recorder(f'PyController crashed: {e}')
+            raise
         finally:
             log.info("Task is now complete closing and shutting down")
             self.shutdown()
@@ -157,36 +240,118 @@ class PyController(object):
             something goes wrong here than it is likely the program will hang and not close properly.
         """
         try:
+            if self.controlServer is not None:
+                self.controlServer.close()
+            if self.profiler is not None:
+                self.profiler.stop()
+                print(f'\nHot path profile written to: {self.profiler.path}\n' + '\n'.join(self.profiler.summary()))
             log.info("Disconnecting Devices")
-            self.devManager.ungrab_devices()
-            self.devManager.close_devices()
-            self.devManager.delete_inputs()
+            for seat in self.seats.values():
+                seat.stop()
+                seat.devManager.ungrab_devices()
+            if self.keyStats is not None:
+                self.keyStats.flush()
+            if self.flightRecorder is not None:
+                self.flightRecorder.close()
+            self.close()
             log.info("Ending PyController!")
         except Exception as e:
             log.error(f"Error in shutdown: {e}")
             log.debug(f"[DEBUG] for shutdown: {traceback.format_exc()}")
 
+    def start_game_monitor(self):
+        """
+            Forks the process that watches for the games of the profiles configured in main.yaml. It is started before
+            'setup' so it does not inherit the event loop, its tasks or the grabs of the devices.
+        :return: Process or None if no profiles are configured.
+        """
+        if self.gameMonitor is None and self.settings.profilesConfig:
+            log.info("Making a Game monitor because profiles have been configured.")
+            self.gameMonitor = Process(target=GameMonitor(self).run, args=(kill_now, global_queue,))
+            self.gameMonitor.start()
+        return self.gameMonitor
+
+    def release_inputs(self):
+        """
+            Closes the input devices under /dev/input that no Device of any seat uses so neither this process nor the
+            GameMonitor keeps them open. Every seat has its own list of the same input devices. Afterwards
+            '--print-capabilities' and the like can no longer see them.
+        :return: int - How many were closed.
+        """
+        keep = {id(device.evdevice) for seat in self.seats.values() for device in seat.devManager.devices
+                if device.evdevice is not None}
+        for seat in self.seats.values():
+            if seat.devManager is not self.devManager:
+                seat.devManager.release_inputs(keep)
+        closed = self.devManager.release_inputs(keep)
+        log.info(f'Closed {closed} input devices that no device uses')
+        return closed
+
+    def dump_flight_recorder(self, reason=''):
+        """
+            Writes the events in the flight recorder to a JSON lines file in the config directory.
+        :param reason: str
+        :return: str - The path of the dump or None.
+        """
+        if self.flightRecorder is None:
+            return None
+        return self.flightRecorder.dump(reason)
+
+    def close(self):
+        """
+            Closes the output devices, key tables and input devices of every seat. The devices have to be ungrabbed
+            first.
+        """
+        for seat in self.seats.values():
+            seat.close()
+        self.devManager.delete_inputs()
+
     async def game_monitor(self):
         """
             This runs only if there is a profile enabled in main.yaml. It listens to the 'global_queue' queue for
-            events that enable or disable different game profiles.
+            events that enable or disable different game profiles. Each event names the seat whose profile changes.
         """
-        global global_queue
         while bool(kill_now.value):
-            if not global_queue.empty():
+            for seat in self.seats.values():
+                await seat.call_async('refresh')
+            # A game sends one event for every seat it changes, they are all applied at once
+            while not self.queue.empty():
+                try:
+                    value = self.queue.get_nowait()
+                except queue.Empty:
+                    break
                 try:
-                    value = global_queue.get_nowait()
                     log.debug(f'The received value is: {value}')
-                    getattr(self.keymapper, value[0], dummy_function)(value[1])
+                    method, profileName, seatName = value
+                    seat = self.seats.get(seatName or defaultSeat)
+                    if seat is None:
+                        log.warning(f'Received a profile change for an unknown seat: {seatName}')
+                    else:
+                        await seat.call_async(getattr(seat.keymapper, method, dummy_function), profileName)
                 except Exception as e:
                     log.error(f'Error in gameMonitor PyController method: {e}')
                     log.debug(f'[DEBUG] for gameMonitor PyController method: {traceback.format_exc()}')
             await asyncio.sleep(5)
 
+    async def reload_keymaps(self):
+        """
+            Reloads the key mappings from the profiles.d and devices.d config files without restarting. The yaml is
+            parsed in an executor and each seat reloads on its own loop so the device workers are never held up.
+        :return: int - The new generation of the key tables.
+        """
+        if self.reloadLock is None:
+            self.reloadLock = asyncio.Lock()
+        async with self.reloadLock:
+            await asyncio.get_running_loop().run_in_executor(None, self.settings.load_profiles)
+            for seat in self.seats.values():
+                await seat.reload()
+        return self.keymapper.tables.generation
+
     def configure_logging(self):
         """
             Sets up the logging for the box. Gets its configuration information from SettingsManager which gets its info
-            from main.yaml. Flags can be sent that override logging configuration from the settings.
+            from main.yaml. Flags can be sent that override logging configuration from the settings. The log can also be
+            written as JSON lines and from a background thread, see LogPipeline.
         :return: None
         """
 
@@ -201,9 +366,33 @@ class PyController(object):
         logging.getLogger('Devices').setLevel(loglevel)
         logging.getLogger('ConfigLoader').setLevel(loglevel)
         logging.getLogger('KeyMapper').setLevel(loglevel)
+        logging.getLogger('KeyTables').setLevel(loglevel)
         logging.getLogger('GameMonitor').setLevel(loglevel)
-
-        logging.basicConfig(format='%(module)s %(funcName)s %(lineno)s %(message)s')
+        logging.getLogger('ControlServer').setLevel(loglevel)
+        logging.getLogger('Metrics').setLevel(loglevel)
+        logging.getLogger('Profiler').setLevel(loglevel)
+        logging.getLogger('Timers').setLevel(loglevel)
+        logging.getLogger('RelMapper').setLevel(loglevel)
+        logging.getLogger('Emulation').setLevel(loglevel)
+        logging.getLogger('Outputs').setLevel(loglevel)
+        logging.getLogger('Filters').setLevel(loglevel)
+        logging.getLogger('Simulation').setLevel(loglevel)
+        logging.getLogger('Compiler').setLevel(loglevel)
+        logging.getLogger('Seats').setLevel(loglevel)
+        logging.getLogger('KernelKeymap').setLevel(loglevel)
+        logging.getLogger('Feedback').setLevel(loglevel)
+        logging.getLogger('KeyStats').setLevel(loglevel)
+        logging.getLogger('FlightRecorder').setLevel(loglevel)
+        logging.getLogger('Benchmarks').setLevel(loglevel)
+        logging.getLogger('Forwarding').setLevel(loglevel)
+
+        logging.basicConfig(format=LOG_FORMAT)
+        if self.settings.logJson:
+            add_json_sink(self.settings.logJson)
+        if self.settings.logQueue:
+            start_queue_logging()
+        # The per event code paths only check whether their sampled loggers are enabled
+        refresh_samplers()
 
 
 def print_list(pyc):
@@ -216,8 +405,7 @@ def print_list(pyc):
           "the device. You can verify by running as root. \n[NOTE: It is not recommended to run this application as "
           "root for daily use only for troubleshooting.] \nUsually adding a group to the desired user will solve this "
           "issue.\n")
-    pyc.devManager.close_devices()
-    pyc.devManager.delete_inputs()
+    pyc.close()
 
 
 def print_classic_keys():
@@ -273,8 +461,7 @@ def print_capabilities(pyc):
     print(f"\nAttempting to print KEY capabilities of device: {device.evdevice}:\n")
     print("\n".join([item[0] if isinstance(item[0], str) else " / ".join(item[0]) for item in caps[("EV_KEY", 1)]]))
     print("\n")
-    pyc.devManager.close_devices()
-    pyc.devManager.delete_inputs()
+    pyc.close()
 
 
 def print_key_presses(pyc):
@@ -300,12 +487,122 @@ def print_key_presses(pyc):
         log.debug(f"[DEBUG] for print_key_presses: {traceback.format_exc()}")
     finally:
         print("\n")
-        pyc.devManager.close_devices()
-        pyc.devManager.delete_inputs()
+        pyc.close()
+
+
+def control(args, install_dir=None):
+    """
+        Handles the '--control' flag.
+    """
+    settings = Settings(args, install_dir=install_dir)
+    path = settings.controlSocket or settings.defaultControlSocket
+    try:
+        response = send_command(path, *args.control)
+    except OSError as e:
+        print(f'Unable to reach PyController on the control socket [{path}]: {e}')
+        return
+    if response.get('ok'):
+        result = response.get('result')
+        print(result if isinstance(result, str) else json.dumps(result, indent=2))
+    else:
+        print(f"Error: {response.get('error')}")
+
+
+def output_helper(args, install_dir=None):
+    """
+        Handles the '--output-helper' flag. Runs until it is killed.
+    """
+    settings = Settings(args, install_dir=install_dir)
+    if args.verbosity > 0:
+        logging.basicConfig(format='%(module)s %(funcName)s %(lineno)s %(message)s',
+                            level=max(10, 40 - (args.verbosity * 10)))
+    helper = OutputHelper(settings.outputHelper or settings.defaultOutputHelper)
+    try:
+        helper.serve_forever()
+    except KeyboardInterrupt:
+        print("\nInterrupt detected gracefully exiting...")
+
+
+def forward_receive(args):
+    """
+        Handles the '--forward-receive' flag. Runs until it is interrupted and prints the stats of the streams.
+    """
+    if args.verbosity > 0:
+        logging.basicConfig(format='%(module)s %(funcName)s %(lineno)s %(message)s',
+                            level=max(10, 40 - (args.verbosity * 10)))
+    print(f'\nReplaying the events forwarded to: {args.forward_receive} (Ctrl+C to stop)')
+    stats = ForwardReceiver(args.forward_receive, peer=args.forward_peer or None).run()
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+def compile_configs(args, install_dir=None):
+    """
+        Handles the '--compile' flag.
+    """
+    settings = Settings(args, install_dir=install_dir)
+    compiler = ConfigCompiler(settings)
+    ok = compiler.compile()
+    for warning in compiler.warnings:
+        print(f'Warning: {warning}')
+    for error in compiler.errors:
+        print(f'Error: {error}')
+    if not ok:
+        print(f'\n{len(compiler.errors)} errors, nothing was written.')
+        return False
+    size = compiler.write(settings.compiledConfig)
+    print(f'\nCompiled {len(compiler.devices)} devices and {len(compiler.profiles)} profiles into '
+          f'{settings.compiledConfig} ({size} bytes)')
+    return True
+
+
+def print_key_stats(args, install_dir=None):
+    """
+        Handles the '--print-key-stats' flag.
+    """
+    settings = Settings(args, install_dir=install_dir)
+    path = settings.keyStatsFile
+    if not os.path.exists(path):
+        print(f"\nNo key stats have been written to {path} yet. Set 'keyStats' to True in main.yaml to count them.")
+        return
+    print(f'\nKey usage from: {path}')
+    print(format_key_stats(read_key_stats(path), limit=args.print_key_stats or None))
+
+
+def dump_flight_recorder(args, install_dir=None):
+    """
+        Handles the '--dump-flight-recorder' flag. This reads the ring left by the last run, IE: after it was killed.
+    """
+    settings = Settings(args, install_dir=install_dir)
+    if not os.path.exists(settings.flightRecorderFile):
+        print(f"\nThere is no flight recorder at {settings.flightRecorderFile}. Set 'flightRecorder' in main.yaml to "
+              f"record the events.")
+        return None
+    path = dump_ring_file(settings.flightRecorderFile)
+    print(f'\nThe flight recorder was dumped to: {path}')
+    return path
+
+
+def benchmark(args):
+    """
+        Handles the '--benchmark' flag.
+    """
+    report = BENCHMARKS[args.benchmark]()
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def simulate(args, install_dir=None):
+    """
+        Handles the '--simulate' flag.
+    """
+    report = Simulation(args.simulate, arguments=args, install_dir=install_dir).run()
+    print(json.dumps(report, indent=2))
+    return report
 
 
 def main(install_dir=None):
-    p = None
+    pyc = None
     args = getArguments()
     try:
 
@@ -319,6 +616,22 @@ def main(install_dir=None):
         if args.showconfigpath:
             print(Settings(args, install_dir=install_dir).show_config_path())
             return
+        if args.control:
+            return control(args, install_dir=install_dir)
+        if args.output_helper:
+            return output_helper(args, install_dir=install_dir)
+        if args.forward_receive:
+            return forward_receive(args)
+        if args.simulate:
+            return simulate(args, install_dir=install_dir)
+        if args.benchmark:
+            return benchmark(args)
+        if args.compile:
+            return compile_configs(args, install_dir=install_dir)
+        if args.print_key_stats is not None:
+            return print_key_stats(args, install_dir=install_dir)
+        if args.dump_flight_recorder:
+            return dump_flight_recorder(args, install_dir=install_dir)
 
         # Create the PyController instance at this point the devices will be registered
         pyc = PyController(args, install_dir=install_dir)
@@ -329,12 +642,11 @@ def main(install_dir=None):
         if args.list_devices:
             return print_list(pyc)
 
+        if pyc.settings.lowFootprint:
+            pyc.release_inputs()
+
         # Make a new forked process that strictly handles monitoring system processes for games specified by the profile
-        if pyc.settings.profilesConfig:
-            log.info("Making a Game monitor because profiles have been configured.")
-            gm = GameMonitor(pyc)
-            p = Process(target=gm.run, args=(kill_now, global_queue,))
-            p.start()
+        pyc.start_game_monitor()
 
         pyc.run()
 
@@ -342,9 +654,10 @@ def main(install_dir=None):
         log.error(f"Error in Main: {e}")
         log.debug(f"[DEBUG] for Main: {traceback.format_exc()}")
     finally:
-        if p:
+        if pyc is not None and pyc.gameMonitor is not None:
             log.info("Closing profile monitor")
-            p.join(timeout=1)
+            kill_now.value = 0
+            pyc.gameMonitor.join(timeout=1)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@
 # Description: This package holds the Device class which keeps information about a particular device.
 
 
+import asyncio
 import logging
 import yaml
 import evdev
@@ -12,27 +13,246 @@ import traceback
 import time
 from evdev import InputDevice, UInput, InputEvent, categorize, ecodes as e
 from PyController.ArgumentWrapper import CLASSIC_KEYBOARD, CONTROLLER_BUTTONS
+from PyController.RelMap import RelMapper
+from PyController.Emulation import GamepadEmulator
+from PyController.Filters import EventFilter
+from PyController.Outputs import OutputManager
+from PyController.KernelKeymap import KernelKeymap
+from PyController.Feedback import FeedbackForwarder
+from PyController.LogPipeline import sampled_logger
+from PyController.FlightRecorder import DROPPED
 
 
 log = logging.getLogger('Devices')
+trace = sampled_logger('Devices')  # Debug logging for every event, sampled so it does not flood the log
 
 
-async def async_device_worker(device):
+async def async_device_worker(device, profiler=None, clock=time.time):
     """
         This is what listens for new inputs and routes them to a virtual device possibly changed if it has a key map.
+        When a HotPathProfiler is passed the map and write callables are swapped for timed versions. 'clock' is what
+        the latency is measured with, a simulation passes its virtual clock.
     """
     # All methods are specified ahead of time to help with optimization
     async_read_loop = device.evdevice.async_read_loop
     mapEvent = device.keymapper.map_event
     write_event = device.outDevice.write_event
     syn = device.outDevice.syn
+    if profiler is not None:
+        mapEvent, write_event, syn = profiler.wrap(device, mapEvent, write_event, syn)
+    fd = device.outDevice.fd
+    # Outputs that read back what is written to 'fd' on the loop (IE: a ForwardOutput) are drained right after a
+    # coalesced frame so the events read after it in the same batch cannot overtake it.
+    drain = getattr(device.outDevice, 'drain', None)
+    timed = device.keyRecord.timed
+    emulator = device.emulator
+    key_event = device.keymapper.timers.key_event
+    now = clock
+    stats = device.stats
+    usage = device.keyUsage
+    presses = usage.presses if usage is not None else None
+    pressedAt = usage.pressedAt if usage is not None else None
+    keymapper = device.keymapper
+    recorder = device.recorder
+    if recorder is not None:
+        record = recorder.record
+        deviceId = recorder.device_id(device.name)
+    dropping = False
+    if device.feedback is not None:
+        device.feedback.start(asyncio.get_running_loop())
     try:
         async for ev in async_read_loop():
-            write_event(mapEvent(ev, device))
-            syn()
-    except Exception as e:
-        log.error(f'An Exception occurred on Device: {device.name}\n{e}\n')
-        log.debug(f'traceback for exception: {e}\n{traceback.format_exc()}')
+            stats.eventsIn += 1
+            if trace.enabled:
+                trace.debug('Device: %s read type %s code %s value %s', device.name, ev.type, ev.code, ev.value)
+            if dropping:
+                # The events up to the SYN_REPORT after a SYN_DROPPED are incomplete, the key state is read from the
+                # device instead.
+                if ev.type == e.EV_SYN and ev.code == e.SYN_REPORT:
+                    dropping = False
+                    resync_device(device, mapEvent, write_event, syn)
+                continue
+            rel = device.relMapper
+            eventFilter = device.eventFilter
+            if eventFilter is not None and not eventFilter.accept(ev):
+                stats.filtered += 1
+                if recorder is not None:
+                    record(deviceId, keymapper.activeProfile, ev.sec, ev.usec, ev.type, ev.code, ev.value, DROPPED, 0,
+                           0)
+                continue
+            written = 1
+            try:
+                if ev.type == e.EV_SYN:
+                    # The source device's frames are forwarded as they are instead of adding a SYN after every event
+                    if ev.code == e.SYN_DROPPED:
+                        stats.synDropped += 1
+                        dropping = True
+                        if recorder is not None:
+                            record(deviceId, keymapper.activeProfile, ev.sec, ev.usec, ev.type, ev.code, ev.value,
+                                   DROPPED, 0, 0)
+                        log.warning(f'The kernel dropped events for Device: {device.name}, resyncing the keys')
+                        continue
+                    elif ev.code != e.SYN_REPORT:
+                        write_event(ev)
+                    elif rel is not None and rel.coalesce:
+                        written = rel.flush(fd)
+                        if drain is not None:
+                            drain()
+                    else:
+                        syn()
+                elif rel is not None and rel.handles(ev):
+                    value = ev.value  # Scaling motion changes the event in place
+                    outs = rel.map_event(ev)
+                    if recorder is not None:
+                        record_outputs(record, deviceId, keymapper.activeProfile, ev, value, outs)
+                    for out in outs:
+                        write_event(out)
+                    written = len(outs)
+                elif emulator is not None and emulator.handles(ev):
+                    outs = emulator.map_event(ev)
+                    if recorder is not None:
+                        record_outputs(record, deviceId, keymapper.activeProfile, ev, ev.value, outs)
+                    for out in outs:
+                        write_event(out)
+                    written = len(outs)
+                else:
+                    code = ev.code
+                    if presses is not None and ev.type == e.EV_KEY:
+                        # Key usage counts the physical keys, before they are mapped
+                        if ev.value == 1:
+                            presses[code] += 1
+                            pressedAt[code] = ev.sec + ev.usec * 0.000001
+                        elif ev.value == 0:
+                            usage.release(code, ev.sec + ev.usec * 0.000001)
+                    ev = mapEvent(ev, device)
+                    # Keys with turbo or a custom repeat rate are handed to the TimerWheel which may swallow the OS
+                    # autorepeat.
+                    if ev.type == e.EV_KEY and timed[code] and not key_event(device, code, ev):
+                        if recorder is not None:
+                            record(deviceId, keymapper.activeProfile, ev.sec, ev.usec, ev.type, code, ev.value,
+                                   DROPPED, 0, 0)
+                        continue
+                    if recorder is not None:
+                        record(deviceId, keymapper.activeProfile, ev.sec, ev.usec, ev.type, code, ev.value, ev.type,
+                               ev.code, ev.value)
+                    write_event(ev)
+            except OSError as error:
+                stats.dropped += 1
+                log.warning(f'Dropped an event on Device: {device.name} because the write failed: {error}')
+                continue
+            if not written:
+                # Coalesced motion or an axis inside its deadzone
+                continue
+            stats.eventsOut += written
+            stats.lastEvent = now()
+            latency = stats.lastEvent - ev.sec - (ev.usec * 0.000001)
+            stats.latencyTotal += latency
+            if latency > stats.latencyMax:
+                stats.latencyMax = latency
+    except Exception as error:
+        log.error(f'An Exception occurred on Device: {device.name}\n{error}\n')
+        log.debug(f'traceback for exception: {error}\n{traceback.format_exc()}')
+        if recorder is not None:
+            recorder.dump(f'An Exception occurred on Device: {device.name}: {error}')
+
+
+def record_outputs(record, deviceId, profile, ev, value, outs):
+    """
+        Records an event read from a device with each event the RelMapper or GamepadEmulator made of it. An event that
+        made none, IE: coalesced motion or an axis inside its deadzone, is recorded as DROPPED.
+    :param value: int - The value the event was read with.
+    """
+    if not outs:
+        record(deviceId, profile, ev.sec, ev.usec, ev.type, ev.code, value, DROPPED, 0, 0)
+    for out in outs:
+        record(deviceId, profile, ev.sec, ev.usec, ev.type, ev.code, value, out.type, out.code, out.value)
+
+
+def resync_device(device, mapEvent, write_event, syn):
+    """
+        Reads which keys are held down from the device (EVIOCGKEY) and sends a press or release through the mapper for
+        every key the worker has the wrong state for. This keeps keys from getting stuck after a SYN_DROPPED.
+    :param device: Device object
+    :param mapEvent: callable
+    :param write_event: callable
+    :param syn: callable
+    :return: int - The amount of keys that were corrected.
+    """
+    try:
+        events = device.resync()
+        timed = device.keyRecord.timed
+        key_event = device.keymapper.timers.key_event
+        for ev in events:
+            code = ev.code
+            ev = mapEvent(ev, device)
+            if timed[code] and not key_event(device, code, ev):
+                continue
+            write_event(ev)
+        syn()
+    except OSError as error:
+        log.error(f'Unable to resync the keys of Device: {device.name}: {error}')
+        return 0
+    device.stats.resynced += len(events)
+    return len(events)
+
+
+async def supervised_device_worker(device, retries=5, delay=1.0, profiler=None, clock=time.time):
+    """
+        Runs the 'async_device_worker' for a device and restarts it if it stops because of an error. Gives up after
+        'retries' restarts.
+    :param device: Device object
+    :param retries: int
+    :param delay: float - seconds to wait before restarting the worker.
+    :param profiler: HotPathProfiler object
+    :param clock: callable
+    """
+    while True:
+        await async_device_worker(device, profiler=profiler, clock=clock)
+        if device.stats.restarts >= retries:
+            log.error(f'The worker for Device: {device.name} has been restarted {retries} times, giving up.')
+            return
+        await asyncio.sleep(delay)
+        device.stats.restarts += 1
+        log.warning(f'Restarting the worker for Device: {device.name}')
+
+
+class DeviceStats(object):
+    """
+        Counters kept by the 'async_device_worker' of a Device. Each worker only ever touches its own counters so no
+        locking is needed, they are added up when they are read. Latency is measured in seconds from the kernel's
+        timestamp of the input event to when the mapped event was written to the output device.
+    """
+
+    __slots__ = ('eventsIn', 'eventsOut', 'remapped', 'passthrough', 'filtered', 'dropped', 'synDropped', 'resynced',
+                 'restarts', 'latencyTotal', 'latencyMax', 'lastEvent')
+
+    def __init__(self):
+        self.eventsIn = 0
+        self.eventsOut = 0
+        self.remapped = 0
+        self.passthrough = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.synDropped = 0
+        self.resynced = 0
+        self.restarts = 0
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+        self.lastEvent = 0.0
+
+    def as_dict(self):
+        return {'eventsIn': self.eventsIn,
+                'eventsOut': self.eventsOut,
+                'remapped': self.remapped,
+                'passthrough': self.passthrough,
+                'filtered': self.filtered,
+                'dropped': self.dropped,
+                'synDropped': self.synDropped,
+                'resynced': self.resynced,
+                'restarts': self.restarts,
+                'latencyAvg': self.latencyTotal / self.eventsOut if self.eventsOut else 0.0,
+                'latencyMax': self.latencyMax,
+                'lastEvent': self.lastEvent}
 
 
 class Device(yaml.YAMLObject):
@@ -48,31 +268,79 @@ class Device(yaml.YAMLObject):
     productid = None
     name = None
     fullname = None
+    phys = None
     keys = None
     type = None
     keymapper = None
     deviceKeyMap = None
+    keyRecord = None
+    relscale = None
+    coalesce = False
+    relMapper = None
+    turbo = None
+    repeat = None
+    repeatdelay = None
+    emulation = None
+    emulator = None
+    debounce = None
+    dropscan = False
+    eventFilter = None
+    output = None
+    offload = False
+    stats = None
 
     evdevice = None
     outDevice = None
-
-    def __init__(self, vendorid, productid, name, type=None, keys=None, fullname=None):
+    outputs = None
+    kernelKeymap = None
+    offloaded = False
+    feedback = None
+    keyUsage = None
+    recorder = None
+
+    def __init__(self, vendorid, productid, name, type=None, keys=None, fullname=None, relscale=None, coalesce=False,
+                 turbo=None, repeat=None, repeatdelay=None, emulation=None, output=None,
+                 debounce=None, dropscan=False, phys=None, offload=False):
         """
             This is not used by yaml when creating the Device object. Do not edit this to troubleshoot unless you
             intend to 'manually' create a Device class.
         :param vendorid: int - Find this out via lsusb or '--list-devices' flag.
         :param productid: int - Find this out via lsusb or '--list-devices' flag.
         :param name: str - The name of the Device object. This will be used to match against for profile.d configs.
-        :param type: str - Either EV_KEY or EV_BUTTON Almost certainly EV_KEY.
-        :param keys: dict - Example: {'KEY_A': 'KEY_B'}
+        :param type: str - Either EV_KEY or EV_BUTTON Almost certainly EV_KEY. EV_BUTTON is used for mice.
+        :param keys: dict - Example: {'KEY_A': 'KEY_B', 'REL_WHEEL+': 'KEY_PAGEUP', 'KEY_UP': 'REL_Y-10'}
         :param fullname: str - Used to avoid confusion when a device appears multiple times in lsusb or '--list-devices'
+        :param relscale: dict - Multiplies relative motion. Example: {'REL_X': 1.5}
+        :param coalesce: bool - Merges the relative motion of each SYN frame into a single write.
+        :param turbo: dict - Keys that are pressed and released N times a second while held. Example: {'KEY_SPACE': 15}
+        :param repeat: dict - Keys that repeat N times a second while held instead of the OS repeat.
+            Example: {'KEY_W': 30}
+        :param repeatdelay: float - Seconds a key is held before the custom repeat starts.
+        :param emulation: dict - Maps the analog axes of a game pad to keys and mouse motion. See GamepadEmulator.
+        :param output: str - The name of the output device. Devices with the same output share one virtual device.
+        :param debounce: float - Milliseconds after a key changes in which a change back is dropped as chatter.
+        :param dropscan: bool - Drops the EV_MSC scan code events.
+        :param phys: str - Only matches an input whose physical path contains this. Example: 'usb-0000:00:14.0-2'
+        :param offload: bool - Lets the kernel remap the keys when the mapping never changes. See 'can_offload'.
         """
         self.vendorid = str(vendorid)
         self.productid = str(productid)
         self.name = name
         self.fullname = fullname
+        self.phys = phys
         self.type = type
         self.evdevice = None
+        self.stats = DeviceStats()
+        self.relscale = relscale or {}
+        self.coalesce = coalesce
+        self.turbo = turbo or {}
+        self.repeat = repeat or {}
+        self.repeatdelay = repeatdelay
+        self.emulation = emulation
+        self.output = output or f'{name}_output'
+        self.debounce = debounce
+        self.dropscan = dropscan
+        self.offload = offload
         if keys is None:
             self.keys = {}
         else:
@@ -95,16 +363,63 @@ class Device(yaml.YAMLObject):
         self.find_device(inputDevices)
         if self.isValid:    # Continue if 'findDevice' found the input devices on the OS.
             self.set_key_mapper(keymapper)
-            self.generate_ouput_device()
 
     def set_key_mapper(self, keymapper):
         """
-            This sets the keymapper and gets back a dictionary of mapped keys
+            This sets the keymapper and gets back the DeviceRecord holding this device's key tables
         :param keymapper: KeyMapper class object
         :return: None
         """
         self.keymapper = keymapper
-        self.deviceKeyMap = self.keymapper.add_device_keymap(self, self.keys)
+        self.keyRecord = self.keymapper.add_device_keymap(self, {inputKey: mapKey
+                                                                 for inputKey, mapKey in self.keys.items()
+                                                                 if not RelMapper.is_rel_pair(inputKey, mapKey)})
+        self.deviceKeyMap = self.keyRecord.table
+        self.keymapper.add_device_rates(self, self.turbo, self.repeat, self.repeatdelay)
+        self.set_rel_mapper()
+        self.set_emulator()
+        self.set_event_filter()
+
+    def set_rel_mapper(self):
+        """
+            Creates the RelMapper if this device has any relative motion configured. An existing RelMapper is reloaded
+            in place so a running worker uses the new settings.
+        :return: None
+        """
+        if self.relMapper is not None:
+            self.relMapper.load(self.keys, self.relscale, self.coalesce)
+            return
+        relMapper = RelMapper(self.keys, self.relscale, self.coalesce)
+        if relMapper.configured:
+            self.relMapper = relMapper
+
+    def set_emulator(self):
+        """
+            Creates the GamepadEmulator if this device has an 'emulation' config. An existing GamepadEmulator is
+            reloaded in place.
+        :return: None
+        """
+        absinfo = getattr(self.evdevice, 'absinfo', None)
+        if self.emulator is not None:
+            self.emulator.load(self.emulation, absinfo)
+            return
+        if self.emulation:
+            emulator = GamepadEmulator(self.emulation, absinfo)
+            if emulator.configured:
+                self.emulator = emulator
+
+    def set_event_filter(self):
+        """
+            Creates the EventFilter if this device debounces its keys or drops scan codes. An existing EventFilter is
+            reloaded in place.
+        :return: None
+        """
+        if self.eventFilter is not None:
+            self.eventFilter.load(self.debounce, self.dropscan)
+            return
+        eventFilter = EventFilter(self.debounce, self.dropscan)
+        if eventFilter.configured:
+            self.eventFilter = eventFilter
 
     def check_device_variables(self):
         """
@@ -117,14 +432,28 @@ class Device(yaml.YAMLObject):
         self.productid = str(self.productid)
         self.name = str(self.name)
         if isinstance(self.type, str):
-            self.type = self.type.lower()
+            self.type = self.type.upper()
             if self.type not in ['EV_KEY', 'EV_BUTTON']:
                 self.type = 'EV_KEY'
         else:
             self.type = 'EV_KEY'
         if not isinstance(self.keys, dict):
             self.keys = {}
+        if not isinstance(self.relscale, dict):
+            self.relscale = {}
+        if not isinstance(self.turbo, dict):
+            self.turbo = {}
+        if not isinstance(self.repeat, dict):
+            self.repeat = {}
+        if not isinstance(self.emulation, dict):
+            self.emulation = None
+        self.output = str(self.output) if self.output else f'{self.name}_output'
+        self.coalesce = bool(self.coalesce)
+        self.dropscan = bool(self.dropscan)
+        self.offload = bool(self.offload)
+        self.offloaded = False
         self.evdevice = None
+        self.stats = DeviceStats()
 
     def find_device(self, deviceList):
         """
@@ -141,16 +470,40 @@ class Device(yaml.YAMLObject):
                 if self.type == self.get_device_type(dev):
                     if self.fullname is not None and self.fullname != dev.name:
                         continue
+                    if self.phys is not None and str(self.phys) not in (getattr(dev, 'phys', None) or ''):
+                        continue
                     if self.evdevice is not None:
                         log.error(f"Device {self.name} was found more then once! This can be caused by error in "
-                                  f"configuration. Suggestion is to use the 'fullname' key in the device's yaml "
-                                  f"config file. ")
+                                  f"configuration. Suggestion is to use the 'fullname' or 'phys' key in the "
+                                  f"device's yaml config file. ")
                         raise Exception("This device was found more then once!")
                     self.evdevice = dev
         if self.evdevice is None:
             log.error(f"Device {self.name} not found!")
         return self.evdevice
 
+    def resync(self):
+        """
+            Compares the keys held down on the input device with the keys the KeyMapper has seen pressed.
+        :return: list - InputEvent objects that press or release the keys that differ.
+        """
+        held = bytearray(e.KEY_CNT)
+        for code in self.evdevice.active_keys():
+            if code < e.KEY_CNT:
+                held[code] = 1
+        latched = self.keyRecord.latched
+        relKeys = self.relMapper.keyRels if self.relMapper is not None else {}
+        sec, usec = divmod(time.time(), 1)
+        events = []
+        for code in range(e.KEY_CNT):
+            if bool(latched[code]) != held[code] and code not in relKeys:
+                events.append(InputEvent(int(sec), int(usec * 1000000), e.EV_KEY, code, held[code]))
+                if self.eventFilter is not None:
+                    self.eventFilter.sync(code, held[code])
+        if events:
+            log.info(f'Resyncing {len(events)} keys on Device: {self.name}')
+        return events
+
     def map_event(self, event):
         """
             This is called upon by the DeviceInputWorker associated with this Device. The job is to check to see if the
@@ -167,7 +520,7 @@ class Device(yaml.YAMLObject):
         :return:
         """
         log.info("Grabbing input devices associated with: %s" % self.name)
-        if self.evdevice:
+        if self.evdevice and not self.offloaded:
             self.evdevice.grab()
 
     def ungrab(self):
@@ -177,26 +530,115 @@ class Device(yaml.YAMLObject):
         :return:
         """
         log.info("Releasing input devices associated with: %s" % self.name)
-        if self.evdevice:
+        if self.evdevice and not self.offloaded:
             self.evdevice.ungrab()
 
     def close(self):
         """
             The 'generateOutputDevice' method creates a UInput device object based on these devices capabilities. This
-            method deletes that device.
+            method deletes that device or gives it back to the OutputManager which closes it once no Device uses it.
         :return:
         """
+        if self.emulator is not None:
+            self.emulator.stop()
+        self.restore_keymap()
+        if self.feedback is not None:
+            self.feedback.remove_target(self.evdevice)
+            if self.outputs is None:
+                self.feedback.stop()
+            self.feedback = None
         if self.outDevice:
             log.info("Closing output devices associated with: %s" % self.name)
-            self.outDevice.syn()
-            self.outDevice.close()
-
-    def generate_ouput_device(self):
+            if self.outputs is not None:
+                self.outputs.release(self.output, self.name)
+            else:
+                self.outDevice.syn()
+                self.outDevice.close()
+            self.outDevice = None
+
+    def can_offload(self):
+        """
+            True if the device asked for 'offload' and its mapping is static: only key to key pairs, no turbo, repeat,
+            relative motion, emulation or filtering, and no profile that remaps its keys or sets rates for it.
+        :return: bool
+        """
+        if not self.offload or not self.isValid or self.keymapper is None:
+            return False
+        if self.relMapper is not None or self.emulator is not None or self.eventFilter is not None:
+            return False
+        if self.relscale or self.turbo or self.repeat:
+            return False
+        return not self.keymapper.profile_applies(self.name)
+
+    def offload_keymap(self):
+        """
+            Programs the device's key table into the kernel keymap of its input device. An offloaded device is not
+            grabbed, has no output device and no worker. The original keymap is put back by 'restore_keymap'.
+        :return: bool - False if the kernel could not do it and the device has to be mapped in userspace.
+        """
+        try:
+            if self.kernelKeymap is None:
+                self.kernelKeymap = KernelKeymap(self.evdevice.fd)
+            changed = self.kernelKeymap.apply(self.keyRecord.table)
+        except (OSError, ValueError, AttributeError) as error:
+            log.warning(f'Unable to offload the keymap of Device: {self.name} to the kernel, mapping it in userspace: '
+                        f'{error}')
+            self.restore_keymap()
+            return False
+        log.info(f'Offloaded the keymap of Device: {self.name} to the kernel, {changed} scan codes changed')
+        self.offloaded = True
+        return True
+
+    def restore_keymap(self):
+        """
+            Puts back the kernel keymap the input device had before it was offloaded.
+        :return: None
+        """
+        self.offloaded = False
+        if self.kernelKeymap is None:
+            return
+        try:
+            self.kernelKeymap.restore()
+        except OSError as error:
+            log.error(f'Unable to restore the kernel keymap of Device: {self.name}: {error}')
+
+    def generate_ouput_device(self, outputs=None):
         """
             This creates a new Output device on the OS that takes on the capabilities of the input devices associated
-            with this device.
+            with this device. When an OutputManager is passed the output is shared with the other Devices that use the
+            same 'output' name.
+        :param outputs: OutputManager object
         :return:
         """
+        if outputs is not None:
+            self.outputs = outputs
+            self.outDevice = outputs.acquire(self.output, self.name)
+        else:
+            # self.outDevice = UInput.from_device(self.evdevice, name=self.name + '_output')
+            self.outDevice = UInput(self.output_capabilities(), name=self.output)
+        if self.emulator is not None:
+            self.emulator.start(self.outDevice.fd, drain=getattr(self.outDevice, 'drain', None))
+        if self.has_feedback():
+            if outputs is not None:
+                self.feedback = outputs.feedback(self.output)
+            elif isinstance(self.outDevice, UInput):
+                self.feedback = FeedbackForwarder(self.outDevice)
+            if self.feedback is not None:
+                self.feedback.add_target(self.evdevice)
+
+    def has_feedback(self):
+        """
+            True if the input device can rumble or has LEDs, then what games write to the output is forwarded to it.
+        :return: bool
+        """
+        caps = self.evdevice.capabilities(absinfo=False)
+        return bool(caps.get(e.EV_FF) or caps.get(e.EV_LED))
+
+    def output_capabilities(self):
+        """
+            The capabilities the output device needs for this device.
+        :return: dict
+        """
         caps = self.evdevice.capabilities()
         newCaps = {e.EV_KEY: caps.get(e.EV_KEY, [])}
         # Gets the keys for a classic keyboard and combines them with existing keys of the device.
@@ -204,8 +646,23 @@ class Device(yaml.YAMLObject):
                                                          for key in CLASSIC_KEYBOARD + CONTROLLER_BUTTONS
                                                          if hasattr(e, key)])))
 
-        # self.outDevice = UInput.from_device(self.evdevice, name=self.name + '_output')
-        self.outDevice = UInput(newCaps, name=self.name+'_output')
+        # Relative motion is only advertised when the source has it or keys are mapped to it so that keyboards are not
+        # turned into mice.
+        relCaps = set(caps.get(e.EV_REL, []))
+        if self.relMapper is not None:
+            relCaps.update(self.relMapper.targets)
+            newCaps[e.EV_KEY] = list(set(newCaps[e.EV_KEY]).union(key for keys in self.relMapper.relKeys.values()
+                                                                  for key in keys.values()))
+        if self.emulator is not None:
+            relCaps.update(self.emulator.relTargets)
+            newCaps[e.EV_KEY] = list(set(newCaps[e.EV_KEY]).union(self.emulator.keyTargets))
+        if relCaps:
+            newCaps[e.EV_REL] = sorted(relCaps)
+        # Force feedback and LEDs are advertised so games can use them, the FeedbackForwarder passes them back.
+        for evType in (e.EV_FF, e.EV_LED):
+            if caps.get(evType):
+                newCaps[evType] = list(caps[evType])
+        return newCaps
 
     def inject_input(self, type='EV_KEY', key='KEY_Q'):
         self.evdevice.write_event(InputEvent(time.time(),
@@ -275,8 +732,10 @@ class DeviceManager(object):
     inputDevices = None
     keymapper = None
     devices = None
+    outputs = None
+    seat = None
 
-    def __init__(self, settingsManager, keymapper):
+    def __init__(self, settingsManager, keymapper, outputs=None, inputDevices=None, seat=None):
         """
             This requires both the SettingsManager and KeyMapper classes. It will use the SettingsManager to load all
             the different devicename.yaml config files enabled in the main.yaml. Each one should load a new Device
@@ -285,15 +744,22 @@ class DeviceManager(object):
                 device will look through that list to try to find its device. This is a large point of failure.
         :param settingsManager: SettingsManager object
         :param keymapper: KeyMapper object
+        :param outputs: OutputManager object - Shares the output devices between Devices.
+        :param inputDevices: list - InputDevice objects to use instead of the ones found under /dev/input.
+        :param seat: str - Only manages the devices of this seat in main.yaml. None for the devices of no seat.
         """
         self.settings = settingsManager
         self.keymapper = keymapper
-        self.inputDevices = [InputDevice(fn) for fn in evdev.list_devices()]
+        self.seat = seat
+        self.outputs = outputs if outputs is not None else OutputManager()
+        if inputDevices is None:
+            inputDevices = [InputDevice(fn) for fn in evdev.list_devices()]
+        self.inputDevices = list(inputDevices)
         self.get_device_configs()
 
     def __str__(self):
         return '\n'.join([f"{dev.path} - {dev.name} - {Device._to_hex(dev.info.vendor)}:"
-                          f"{Device._to_hex(dev.info.product)}"
+                          f"{Device._to_hex(dev.info.product)} - {getattr(dev, 'phys', '')}"
                           for dev in self.inputDevices])
 
     def get_device_configs(self):
@@ -304,13 +770,73 @@ class DeviceManager(object):
             devices and run a series of methods on them setting them up.
         :return:
         """
-        self.devices = []
-        for device in self.settings.devices:
-            self.devices.append(self.settings.load_yaml(device, device=True))
+        self.devices = self.settings.device_configs(self.seat)
         for device in self.devices:
             device.setup(self.keymapper, self.inputDevices)
+            if self.seat is not None:
+                # Outputs are named after the seat so two seats never share a virtual device
+                device.output = f'{self.seat}_{device.output}'
+            if device.can_offload():
+                device.offload_keymap()
+        self.generate_outputs([device for device in self.devices if device.isValid and not device.offloaded])
         return self.devices
 
+    def generate_outputs(self, devices):
+        """
+            Creates the output devices of the Devices that are mapped in userspace.
+        :param devices: list of Device objects
+        :return: None
+        """
+        # Every Device sharing an output has to reserve its capabilities before the output is created
+        for device in devices:
+            self.outputs.reserve(device.output, device.output_capabilities())
+        for device in devices:
+            device.generate_ouput_device(self.outputs)
+
+    def reload_keymaps(self):
+        """
+            Reads the devices.d yaml config files again and rebuilds the key tables of the devices that are already
+            running. Only the 'keys' are reloaded, a device that is added or changes its IDs requires a restart. An
+            offloaded device gets its kernel keymap reprogrammed or, if its mapping is no longer static, is grabbed and
+            handed back to userspace.
+        :return: list - The Devices that now need a worker.
+        """
+        fallback = []
+        for newDevice in self.settings.device_configs(self.seat):
+            for device in self.devices:
+                if device.isValid and device.name == str(newDevice.name):
+                    device.keys = newDevice.keys if isinstance(newDevice.keys, dict) else {}
+                    device.relscale = newDevice.relscale if isinstance(newDevice.relscale, dict) else {}
+                    device.coalesce = bool(newDevice.coalesce)
+                    device.turbo = newDevice.turbo if isinstance(newDevice.turbo, dict) else {}
+                    device.repeat = newDevice.repeat if isinstance(newDevice.repeat, dict) else {}
+                    device.repeatdelay = newDevice.repeatdelay
+                    device.emulation = newDevice.emulation if isinstance(newDevice.emulation, dict) else None
+                    device.debounce = newDevice.debounce
+                    device.dropscan = bool(newDevice.dropscan)
+                    device.set_key_mapper(self.keymapper)
+                    if device.offloaded and not (device.can_offload() and device.offload_keymap()):
+                        device.restore_keymap()
+                        fallback.append(device)
+        if fallback:
+            log.info(f'Moving Devices back to userspace: {[device.name for device in fallback]}')
+            self.generate_outputs(fallback)
+            for device in fallback:
+                device.grab()
+        return fallback
+
+    def as_dict(self):
+        return [{'name': device.name,
+                 'seat': self.seat,
+                 'path': getattr(device.evdevice, 'path', None),
+                 'fullname': getattr(device.evdevice, 'name', None),
+                 'id': f'{device.vendorid}:{device.productid}',
+                 'valid': device.isValid,
+                 'offloaded': device.offloaded,
+                 'output': device.output if device.outDevice is not None else None,
+                 'stats': device.stats.as_dict()}
+                for device in self.devices]
+
     def find_devices(self):
         for device in self.devices:
             device.find_device(self.inputDevices)
@@ -329,10 +855,24 @@ class DeviceManager(object):
         log.info("Closing all evdev UInput devices")
         for device in self.devices:
             device.close()
+        self.outputs.close()
         while len(self.devices) > 0:
             item = self.devices.pop()
             del item
 
+    def release_inputs(self, keep):
+        """
+            Closes the input devices that are not in 'keep' and drops them from 'inputDevices'. The Devices only look
+            at the input devices again through 'find_devices' so this is done once every seat has found its own.
+        :param keep: set - The ids of the InputDevices used by a Device of any seat.
+        :return: int - How many were closed.
+        """
+        unused = [item for item in self.inputDevices if id(item) not in keep]
+        for item in unused:
+            item.close()
+        self.inputDevices[:] = [item for item in self.inputDevices if id(item) in keep]
+        return len(unused)
+
     def delete_inputs(self):
         log.info("Deleting all Input Devices")
         for item in self.inputDevices:
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package maps relative (EV_REL) motion such as mice, scroll wheels and thumb sticks that report
+#   relative motion. It supports scaling relative motion, mapping relative motion to keys, mapping keys to relative
+#   motion and coalescing all the deltas of one SYN frame into a single write to the output device.
+
+
+import logging
+import os
+import struct
+from array import array
+from evdev import InputEvent, ecodes
+
+
+log = logging.getLogger('RelMapper')
+
+
+EVENT = struct.Struct('llHHi')  # struct input_event: timeval, type, code, value
+SYN_REPORT = EVENT.pack(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+HI_RES = {ecodes.REL_WHEEL: ecodes.REL_WHEEL_HI_RES, ecodes.REL_HWHEEL: ecodes.REL_HWHEEL_HI_RES}
+
+
+class RelMapper(object):
+    """
+        This class handles the relative motion of a single Device. It is configured by the device's yaml config:
+            keys:
+              REL_WHEEL+: KEY_PAGEUP    # Scrolling up presses and releases KEY_PAGEUP
+              REL_WHEEL-: KEY_PAGEDOWN  # Scrolling down presses and releases KEY_PAGEDOWN
+              KEY_UP: REL_Y-10          # Pressing (or holding) KEY_UP moves the pointer up by 10
+            relscale:
+              REL_X: 1.5                # Multiplies the motion on REL_X
+            coalesce: True              # Merges the deltas of each SYN frame into one write
+    """
+
+    relKeys = None
+    keyRels = None
+    scale = None
+    coalesce = False
+    targets = None
+
+    _isRelKey = None
+    _suppressed = None
+    _remainder = None
+    _pending = None
+
+    def __init__(self, keys=None, relscale=None, coalesce=False):
+        """
+        :param keys: dict - The 'keys' of a Device. Only the pairs that involve a REL_* code are used.
+        :param relscale: dict - Example: {'REL_X': 1.5}
+        :param coalesce: bool
+        """
+        super(RelMapper, self).__init__()
+        self.load(keys, relscale, coalesce)
+
+    def load(self, keys=None, relscale=None, coalesce=False):
+        """
+            (Re)builds the mappings. This happens in place so a running worker picks up the change.
+        :return: None
+        """
+        self.relKeys = {}
+        self.keyRels = {}
+        self.targets = set()
+        self.scale = array('d', [1.0] * ecodes.REL_CNT)
+        self._isRelKey = bytearray(ecodes.KEY_CNT)
+        self._suppressed = bytearray(ecodes.REL_CNT)
+        self._remainder = array('d', [0.0] * ecodes.REL_CNT)
+        self._pending = array('l', [0] * ecodes.REL_CNT)
+        self.coalesce = bool(coalesce)
+
+        for inputKey, mapKey in (keys or {}).items():
+            if not RelMapper.is_rel_pair(inputKey, mapKey):
+                continue
+            parsed = RelMapper.parse_pair(inputKey, mapKey)
+            if parsed is None:
+                log.warning(f'The relative map of input: {inputKey} mapped to {mapKey} failed validation.')
+                continue
+            if inputKey.startswith('REL_'):
+                self.relKeys.setdefault(parsed[0], {}).update(parsed[1])
+            else:
+                self.keyRels[parsed[0]] = parsed[1]
+                self._isRelKey[parsed[0]] = 1
+                self.targets.add(parsed[1][0])
+
+        # The high resolution wheel events are sent along with the ones mapped to keys, libinput would scroll on them
+        for code, hiRes in HI_RES.items():
+            if code in self.relKeys:
+                self._suppressed[hiRes] = 1
+
+        for relName, factor in (relscale or {}).items():
+            code = getattr(ecodes, str(relName), None)
+            if not isinstance(code, int) or not str(relName).startswith('REL_') or code >= ecodes.REL_CNT:
+                log.warning(f'The relative scale for: {relName} failed validation.')
+                continue
+            self.scale[code] = float(factor)
+
+    @property
+    def configured(self):
+        return bool(self.relKeys or self.keyRels or self.coalesce or any(factor != 1.0 for factor in self.scale))
+
+    def handles(self, event):
+        """
+            Returns True if the event should go through 'map_event' of this class instead of the KeyMapper.
+        """
+        return event.type == ecodes.EV_REL or (event.type == ecodes.EV_KEY and self._isRelKey[event.code])
+
+    def map_event(self, event):
+        """
+            Maps an EV_REL event or an EV_KEY event that is mapped to relative motion.
+        :param event: InputEvent object
+        :return: tuple of InputEvent objects to write now. Coalesced motion is returned by 'flush' instead.
+        """
+        if event.type == ecodes.EV_KEY:
+            if event.value == 0:
+                return ()
+            code, amount = self.keyRels[event.code]
+            return (InputEvent(event.sec, event.usec, ecodes.EV_REL, code, amount),)
+
+        code = event.code
+        if code < ecodes.REL_CNT and self._suppressed[code]:
+            return ()
+        if code in self.relKeys:
+            key = self.relKeys[code].get(event.value > 0)
+            if key is None:
+                return ()
+            return (InputEvent(event.sec, event.usec, ecodes.EV_KEY, key, 1),
+                    InputEvent(event.sec, event.usec, ecodes.EV_KEY, key, 0))
+
+        if code < ecodes.REL_CNT and self.scale[code] != 1.0:
+            value = (event.value * self.scale[code]) + self._remainder[code]
+            event.value = int(value)
+            self._remainder[code] = value - event.value
+
+        if self.coalesce and code < ecodes.REL_CNT:
+            self._pending[code] += event.value
+            return ()
+        return (event,) if event.value else ()
+
+    def flush(self, fd):
+        """
+            Writes the motion coalesced during the frame followed by a SYN_REPORT with a single write.
+        :param fd: int - The file descriptor of the UInput device.
+        :return: int - The amount of events written including the SYN_REPORT.
+        """
+        pending = self._pending
+        frame = []
+        for code in range(ecodes.REL_CNT):
+            if pending[code]:
+                frame.append(EVENT.pack(0, 0, ecodes.EV_REL, code, pending[code]))
+                pending[code] = 0
+        frame.append(SYN_REPORT)
+        os.write(fd, b''.join(frame))
+        return len(frame)
+
+    @staticmethod
+    def is_rel_pair(inputKey, mapKey):
+        return str(inputKey).startswith('REL_') or str(mapKey).startswith('REL_')
+
+    @staticmethod
+    def parse_pair(inputKey, mapKey):
+        """
+            Parses 'REL_WHEEL+: KEY_A' into (REL_WHEEL, {True: KEY_A}) and 'KEY_A: REL_Y-10' into (KEY_A, (REL_Y, -10)).
+        :return: tuple or None when the pair is not valid.
+        """
+        inputKey, mapKey = str(inputKey), str(mapKey)
+        if inputKey.startswith('REL_'):
+            direction = inputKey[-1]
+            code = getattr(ecodes, inputKey[:-1], None)
+            key = getattr(ecodes, mapKey, None)
+            if direction not in '+-' or not isinstance(code, int) or not isinstance(key, int):
+                return None
+            return code, {direction == '+': key}
+        key = getattr(ecodes, inputKey, None)
+        for index, char in enumerate(mapKey):
+            if char in '+-' and index > 0:
+                code = getattr(ecodes, mapKey[:index], None)
+                try:
+                    amount = int(mapKey[index:])
+                except ValueError:
+                    return None
+                if isinstance(key, int) and key < ecodes.KEY_CNT and isinstance(code, int):
+                    return key, (code, amount)
+                return None
+        return None
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package holds the Seat. A seat is a group of devices that belongs to one player on a box shared by
+#   several players (IE: a LAN cafe). Every seat has its own KeyMapper, its own output devices and its own active
+#   profile so a game started by one player never remaps the pad of another.
+
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+import traceback
+from PyController.KeyMap import KeyMapper
+from PyController.PyDevices import DeviceManager, supervised_device_worker
+from PyController.SettingsManager import defaultSeat
+
+
+log = logging.getLogger('Seats')
+
+
+class Seat(object):
+    """
+        The devices of a seat and everything needed to map them. The devices that are not part of a seat in main.yaml
+        make up the 'default' seat. A seat with 'thread: True' runs its device workers on its own event loop in a
+        thread so a busy seat does not delay the events of the others. Anything that changes the keymaps of such a
+        seat is handed to its loop with 'call'.
+    """
+
+    name = None
+    users = None
+    threaded = False
+    timeout = 2.0
+    keymapper = None
+    devManager = None
+    devWorkers = None
+    loop = None
+    thread = None
+    profiler = None
+    clock = None
+
+    def __init__(self, name, settings, outputs, inputDevices=None, users=None, threaded=False):
+        """
+        :param name: str - The name of the seat in main.yaml or None for the devices of no seat.
+        :param settings: SettingsManager object
+        :param outputs: OutputManager object - Shared by all seats, the output names are prefixed with the seat.
+        :param inputDevices: list - InputDevice objects, shared by all seats so /dev/input is only opened once.
+        :param users: list - The users whose games change the profile of this seat.
+        :param threaded: bool
+        """
+        super(Seat, self).__init__()
+        self.name = name
+        self.users = [str(user) for user in (users or [])]
+        self.threaded = bool(threaded)
+        self.keymapper = KeyMapper(settings)
+        self.keymapper.load_profiles()
+        self.devManager = DeviceManager(settings, self.keymapper, outputs, inputDevices=inputDevices, seat=name)
+        self.devWorkers = []
+
+    def __str__(self):
+        return f'Seat {self.label}'
+
+    @property
+    def label(self):
+        return self.name or defaultSeat
+
+    def start(self, loop, profiler=None, clock=time.time):
+        """
+            Starts a device worker for every valid device of the seat on 'loop' or, for a threaded seat, on a new
+            event loop in its own thread.
+        :param loop: The main asyncio loop.
+        :param profiler: HotPathProfiler object
+        :param clock: callable
+        :return: None
+        """
+        self.profiler = profiler
+        self.clock = clock
+        self.keymapper.timers.clock = clock
+        if not self.threaded:
+            self.loop = loop
+            self.create_workers(profiler, clock)
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready, profiler, clock), name=f'seat-{self.label}',
+                                       daemon=True)
+        self.thread.start()
+        ready.wait(self.timeout)
+
+    def create_workers(self, profiler=None, clock=time.time, devices=None):
+        """
+            Starts a worker for every Device that is mapped in userspace. Offloaded Devices need none.
+        """
+        for device in (self.devManager.devices if devices is None else devices):
+            if device.isValid and not device.offloaded:
+                self.devWorkers.append(self.loop.create_task(supervised_device_worker(device, profiler=profiler,
+                                                                                      clock=clock)))
+        return self.devWorkers
+
+    def run(self, ready, profiler=None, clock=time.time):
+        """
+            The target of the thread of a threaded seat.
+        """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.create_workers(profiler, clock)
+            self.loop.call_soon(ready.set)
+            self.loop.run_forever()
+        except Exception as e:
+            log.error(f'Error in the event loop of {self}: {e}')
+            log.debug(f'[DEBUG] for the event loop of {self}: {traceback.format_exc()}')
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            log.info(f'Stopped the event loop of {self}')
+
+    def stop(self):
+        """
+            Stops the thread of a threaded seat. The workers of other seats are cancelled along with the main loop.
+        :return: None
+        """
+        if self.thread is None:
+            return
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.timeout)
+        self.thread = None
+
+    def call(self, method, *args):
+        """
+            Calls a method of the seat's KeyMapper on the loop the seat runs on and returns its result. For a threaded
+            seat this waits for its thread so the tables are never changed while its workers are mapping an event.
+        :param method: str or callable - The name of a KeyMapper method or any callable.
+        :return: The result of the call.
+        """
+        func = getattr(self.keymapper, method) if isinstance(method, str) else method
+        if self.thread is None or threading.current_thread() is self.thread:
+            return func(*args)
+        return self.submit(func, *args).result(self.timeout)
+
+    async def call_async(self, method, *args):
+        """
+            Like 'call' but for code running on the main loop. The main loop is not blocked while a threaded seat runs
+            the call.
+        :param method: str or callable - The name of a KeyMapper method or any callable.
+        :return: The result of the call.
+        """
+        func = getattr(self.keymapper, method) if isinstance(method, str) else method
+        if self.thread is None or threading.current_thread() is self.thread:
+            return func(*args)
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(func, *args)), self.timeout)
+
+    def submit(self, func, *args):
+        """
+            Schedules 'func' on the loop of a threaded seat.
+        :return: concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future
+
+    async def reload(self):
+        """
+            Reloads the keymaps of the seat on its own loop. The profiles have to be reloaded by the SettingsManager
+            first.
+        :return: int - The new generation of the seat's key tables.
+        """
+        def reload():
+            self.keymapper.reload()
+            fallback = self.devManager.reload_keymaps()
+            if fallback and self.loop is not None:
+                self.create_workers(self.profiler, self.clock, devices=fallback)
+            return self.keymapper.tables.generation
+        return await self.call_async(reload)
+
+    def close(self):
+        """
+            Closes the seat's devices and key tables. The devices have to be ungrabbed first. The input devices are
+            shared and closed by the caller.
+        :return: None
+        """
+        self.stop()
+        self.devManager.close_devices()
+        self.keymapper.close()
+
+    def as_dict(self):
+        return {'name': self.label,
+                'users': self.users,
+                'threaded': self.threaded,
+                'profile': self.keymapper.activeProfile,
+                'devices': [device.name for device in self.devManager.devices]}
@@ -10,20 +10,45 @@ import sys
 import logging
 import yaml
 from gi.repository import GLib
+from PyController.Compiler import CompiledConfig
+from PyController.KeyStats import keyStatsFile
+from PyController.FlightRecorder import flightRecorderFile, capacity_for, DEFAULT_RATE
 
 
 defaultMainConfigFile = "main.yaml"
 deviceDir = "devices.d/"
 profileDir = "profiles.d/"
+compiledConfigFile = "compiled.pyck"
+defaultSeat = "default"
+profileAliases = {'defualts-keys': 'default-keys', 'defaults-keys': 'default-keys', 'default_keys': 'default-keys',
+                  'keys': 'default-keys'}
 mainConfigExample = """main:
   deviceDir: 'devices.d' # Currently, this cannot be changed.
   profileDir: 'profiles.d' # Currently, this cannot be changed.
   logging: False
   loglevel: "CRITICAL" # DEBUG, INFO, WARNING, ERROR, CRITICAL (DEBUG is the most verbose)
+  logQueue: False # True to write the log from a background thread so it never delays the device workers.
+  logJson: False # A path to also write the log to as JSON lines.
+  controlSocket: False # True to serve the control API at 'control.sock' in this directory or a path to a socket.
+  metricsFile: False # A path to periodically write Prometheus style metrics to.
+  metricsInterval: 15 # How often in seconds the metrics file is written.
+  outputHelper: False # True to get the output devices from 'pyc --output-helper' at 'outputs.sock' or a socket path.
+  forwardTo: False # 'udp://host:port' or a UNIX socket path of a 'pyc --forward-receive' to send the outputs to.
+  lowFootprint: False # True to close the input devices no device uses so they are not kept open by PyController.
+  keyStats: False # True to count key presses and hold times per device in 'keystats.bin', see '--print-key-stats'.
+  keyStatsInterval: 60 # How often in seconds the key stats are written.
+  flightRecorder: False # True (65536), how many of the last events to keep in 'flightrecorder.bin' or seconds: '30s'.
+  flightRecorderRate: 1000 # The ring holds events, not time. '30s' keeps 30 times this many events.
 devices:
 # - exampleDevice.yaml
 profiles:
 #  - exampleProfile.yaml
+#seats: # Optional: groups of devices that each get their own keymaps, output devices and active profile.
+#  seat1:
+#    devices:
+#      - pad1.yaml
+#    users: [player1] # Games started by these users only change the profile of this seat.
+#    thread: False # True runs the devices of this seat on their own event loop thread.
 """
 
 
@@ -38,14 +63,19 @@ class SettingsManager(object):
     mainConfigFile = None
     mainConfig = None
     profilesConfig = None
+    compiled = None
 
-    def __init__(self, arguments, install_dir=None):
+    def __init__(self, arguments, install_dir=None, config_dir=None):
         """
             This whole classes job is to pull yaml config files particular the main.yaml which has a series of
             'shortcut' protected variables to grab the useful information out of the main.yaml config file.
+            'config_dir' replaces the users config directory, this is used by simulations.
         """
         super().__init__()
-        self.configDir = os.path.join(GLib.get_user_config_dir(), 'PyController/')
+        if config_dir:
+            self.configDir = os.path.join(os.path.abspath(config_dir), '')
+        else:
+            self.configDir = os.path.join(GLib.get_user_config_dir(), 'PyController/')
         self.installDir = install_dir if install_dir else os.path.realpath(sys.path[0])
         self.mainConfigFile = os.path.join(self.configDir + defaultMainConfigFile)
         if not os.path.exists(self.configDir) or not os.path.exists(self.mainConfigFile):
@@ -89,18 +119,102 @@ class SettingsManager(object):
         assert isinstance(self.mainConfig, dict)
 
     def load_profiles(self):
+        """
+            Loads the profiles from the compiled config when it is up to date, otherwise from profiles.d. The key
+            names are made consistent by 'normalize_profile'.
+        :return: None
+        """
+        if self.compiled is not None:
+            self.compiled.close()
+        self.compiled = self.load_compiled()
+        if self.compiled is not None:
+            self.profilesConfig = self.compiled.profiles
+            return
         self.profilesConfig = {}
         for profile in self.profiles:
-            self.profilesConfig.update(self.load_yaml(profile, profile=True))
+            for name, values in (self.load_yaml(profile, profile=True) or {}).items():
+                self.profilesConfig[name] = self.normalize_profile(values, where=f'{profile} [{name}]')
 
-    def config_loader(self, filepath, device=False, profile=False):
+    def load_compiled(self):
         """
-            This method loads a file from disk and returns it. By default the load_yaml parameter is set to True so the
-            method will first try to pass the file contents through 'yaml.load' and then return that.
-        :param filepath: str: a filename
-        :param device: bool: Default False: Tells the method to pre-append the deviceDir to the filename.
-        :param profile: bool: Default False: Tells the method to pre-append the profileDir to the filename.
-        :return: dict or str
+            Memory maps the file written by the '--compile' flag if there is one and it is up to date.
+        :return: CompiledConfig or None
+        """
+        if not os.path.exists(self.compiledConfig):
+            return None
+        try:
+            compiled = CompiledConfig(self.compiledConfig)
+        except Exception as e:
+            log.warning(f'Unable to load the compiled config {self.compiledConfig}: {e}')
+            return None
+        if not compiled.fresh(self):
+            log.warning(f'The configs have changed since {self.compiledConfig} was compiled, using the yaml configs. '
+                        f"Run with '--compile' again.")
+            compiled.close()
+            return None
+        log.info(f'Using the compiled config: {self.compiledConfig}')
+        return compiled
+
+    def device_configs(self, seat=None):
+        """
+            Creates a Device for every device config of a seat, from the compiled config when it is up to date.
+        :param seat: str - The name of a seat in main.yaml. None for the devices that are not part of any seat.
+        :return: list of Device objects
+        """
+        configs = self.seat_devices(seat)
+        if self.compiled is not None:
+            from PyController.PyDevices import Device
+            return [Device(**{field: value for field, value in config.items() if field not in ('table', 'config')})
+                    for config in self.compiled.devices if config['config'] in configs]
+        return [self.load_yaml(device, device=True) for device in configs]
+
+    def seat_devices(self, seat=None):
+        """
+            The device configs of a seat or the ones listed under 'devices' when 'seat' is None.
+        :param seat: str
+        :return: list
+        """
+        if seat is None:
+            if not self.mainConfig:
+                return []
+            return self.mainConfig.get('devices', []) or []
+        return self.seats.get(seat, {}).get('devices', []) or []
+
+    @staticmethod
+    def normalize_profile(profile, warnings=None, where=''):
+        """
+            Returns a copy of a profile with the key names older configs used changed to the current ones:
+            'default-keys' for the keys of all devices and 'name' for the name of a device.
+        :param profile: dict
+        :param warnings: list - Messages are added here instead of being logged.
+        :param where: str - Which config the profile came from.
+        :return: dict
+        """
+        def warn(message):
+            if warnings is None:
+                log.warning(message)
+            else:
+                warnings.append(message)
+
+        profile = dict(profile or {})
+        for alias, key in profileAliases.items():
+            if alias in profile:
+                warn(f"{where}: '{alias}' should be written as '{key}'")
+                value = profile.pop(alias)
+                profile.setdefault(key, value)
+        devices = []
+        for device in profile.get('devices') or []:
+            device = dict(device or {})
+            if 'Name' in device:
+                warn(f"{where}: 'Name' should be written as 'name'")
+                device.setdefault('name', device.pop('Name'))
+            devices.append(device)
+        profile['devices'] = devices
+        return profile
+
+    def config_path(self, filepath, device=False, profile=False):
+        """
+            Returns the full path of a config file named in main.yaml.
         """
         if not os.path.isabs(filepath):
             if device:
@@ -109,6 +223,18 @@ class SettingsManager(object):
                 filepath = os.path.join(self.configDir, self.profileDir, filepath)
             else:
                 filepath = os.path.join(self.configDir, filepath)
+        return filepath
+
+    def config_loader(self, filepath, device=False, profile=False):
+        """
+            This method loads a file from disk and returns it. By default the load_yaml parameter is set to True so the
+            method will first try to pass the file contents through 'yaml.load' and then return that.
+        :param filepath: str: a filename
+        :param device: bool: Default False: Tells the method to pre-append the deviceDir to the filename.
+        :param profile: bool: Default False: Tells the method to pre-append the profileDir to the filename.
+        :return: dict or str
+        """
+        filepath = self.config_path(filepath, device=device, profile=profile)
         with open(filepath) as f:
             config = f.read()
         return config
@@ -118,9 +244,35 @@ class SettingsManager(object):
 
     @property
     def devices(self):
-        if not self.mainConfig:
-            return []
-        return self.mainConfig.get('devices', []) or []
+        """
+            Every device config enabled in main.yaml including the ones of the seats.
+        """
+        devices = list(self.seat_devices())
+        for seat in self.seats:
+            devices.extend(device for device in self.seat_devices(seat) if device not in devices)
+        return devices
+
+    @property
+    def seats(self):
+        """
+            The 'seats' of main.yaml. Each seat is a group of devices with its own keymaps, output devices and active
+            profile:
+                seats:
+                  seat1:
+                    devices: [pad1.yaml]
+                    users: [player1]     # Games started by these users only change the profile of this seat
+                    thread: True         # Runs the devices of this seat on their own event loop
+        :return: dict
+        """
+        if not self.mainConfig or not isinstance(self.mainConfig.get('seats'), dict):
+            return {}
+        seats = {}
+        for name, config in self.mainConfig['seats'].items():
+            if str(name) == defaultSeat:
+                log.error(f"The seat name '{defaultSeat}' is reserved for the devices that are not in a seat.")
+                continue
+            seats[str(name)] = config if isinstance(config, dict) else {}
+        return seats
 
     @property
     def profiles(self):
@@ -167,3 +319,130 @@ class SettingsManager(object):
             return self.mainConfig['main']['loglevel']
         except Exception:
             return 'ERROR'
+
+    @property
+    def logQueue(self):
+        if getattr(self.arguments, 'log_queue', False):
+            return True
+        try:
+            return bool(self.mainConfig['main']['logQueue'])
+        except Exception:
+            return False
+
+    @property
+    def logJson(self):
+        path = getattr(self.arguments, 'log_json', None)
+        if not path:
+            try:
+                path = self.mainConfig['main']['logJson']
+            except Exception:
+                return None
+        return path or None
+
+    @property
+    def compiledConfig(self):
+        return os.path.join(self.configDir, compiledConfigFile)
+
+    @property
+    def controlSocket(self):
+        path = getattr(self.arguments, 'control_socket', None)
+        if not path:
+            try:
+                path = self.mainConfig['main']['controlSocket']
+            except Exception:
+                return None
+        if path is True:
+            return self.defaultControlSocket
+        return path or None
+
+    @property
+    def defaultControlSocket(self):
+        return os.path.join(self.configDir, 'control.sock')
+
+    @property
+    def metricsFile(self):
+        path = getattr(self.arguments, 'metrics_file', None)
+        if not path:
+            try:
+                path = self.mainConfig['main']['metricsFile']
+            except Exception:
+                return None
+        return path or None
+
+    @property
+    def outputHelper(self):
+        try:
+            path = self.mainConfig['main']['outputHelper']
+        except Exception:
+            return None
+        if path is True:
+            return self.defaultOutputHelper
+        return path or None
+
+    @property
+    def forwardTo(self):
+        address = getattr(self.arguments, 'forward_to', None)
+        if not address:
+            try:
+                address = self.mainConfig['main']['forwardTo']
+            except Exception:
+                return None
+        return address or None
+
+    @property
+    def lowFootprint(self):
+        if getattr(self.arguments, 'low_footprint', False):
+            return True
+        try:
+            return bool(self.mainConfig['main']['lowFootprint'])
+        except Exception:
+            return False
+
+    @property
+    def defaultOutputHelper(self):
+        return os.path.join(self.configDir, 'outputs.sock')
+
+    @property
+    def keyStats(self):
+        try:
+            return bool(self.mainConfig['main']['keyStats'])
+        except Exception:
+            return False
+
+    @property
+    def keyStatsFile(self):
+        return os.path.join(self.configDir, keyStatsFile)
+
+    @property
+    def keyStatsInterval(self):
+        try:
+            return float(self.mainConfig['main']['keyStatsInterval'])
+        except Exception:
+            return 60.0
+
+    @property
+    def flightRecorder(self):
+        """
+            How many events the flight recorder keeps or 0 when it is off. A time window such as '30s' is sized for
+            'flightRecorderRate' events a second.
+        """
+        try:
+            size = self.mainConfig['main']['flightRecorder']
+        except Exception:
+            return 0
+        try:
+            rate = self.mainConfig['main'].get('flightRecorderRate', DEFAULT_RATE)
+            return capacity_for(size, rate)
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def flightRecorderFile(self):
+        return os.path.join(self.configDir, flightRecorderFile)
+
+    @property
+    def metricsInterval(self):
+        try:
+            return float(self.mainConfig['main']['metricsInterval'])
+        except Exception:
+            return 15.0
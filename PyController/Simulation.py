@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: A simulation backend used by the '--simulate' flag. PyController runs against scripted input devices,
+#   recording output devices and a scripted process list on an asyncio loop driven by a virtual clock. Whenever the
+#   loop would wait the clock jumps straight to the next timer, so a long session runs far faster than real time and
+#   always plays out the same way. No /dev/input or /dev/uinput access is needed.
+
+
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import selectors
+import time
+import traceback
+import yaml
+from evdev import InputEvent, AbsInfo, DeviceInfo, ecodes
+from PyController.ArgumentWrapper import CLASSIC_KEYBOARD
+from PyController.RelMap import EVENT
+from PyController.SettingsManager import defaultSeat
+
+
+log = logging.getLogger('Simulation')
+
+
+EVENT_TYPES = (('KEY_', ecodes.EV_KEY), ('BTN_', ecodes.EV_KEY), ('REL_', ecodes.EV_REL), ('ABS_', ecodes.EV_ABS),
+               ('MSC_', ecodes.EV_MSC), ('SYN_', ecodes.EV_SYN))
+
+
+def parse_event(name):
+    """
+        Turns a code name such as 'KEY_A' or 'REL_X' into its (type, code).
+    :param name: str
+    :return: tuple
+    """
+    for prefix, evType in EVENT_TYPES:
+        if str(name).startswith(prefix) and isinstance(getattr(ecodes, str(name), None), int):
+            return evType, getattr(ecodes, str(name))
+    raise ValueError(f'Unknown event code: {name}')
+
+
+class VirtualClock(object):
+    """
+        The time used by everything in a simulation. It only moves when the loop has nothing to do.
+    """
+
+    start = None
+    now = None
+
+    def __init__(self, start=0.0):
+        """
+        :param start: float - Seconds the clock starts at. It is kept small so that adding a timeout to it is exact
+            enough for asyncio to see the timer as due.
+        """
+        super(VirtualClock, self).__init__()
+        self.start = float(start or 0.0)
+        self.now = self.start
+
+    def time(self):
+        return self.now
+
+    def elapsed(self):
+        return self.now - self.start
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def timestamp(self):
+        sec, usec = divmod(self.now, 1)
+        return int(sec), int(usec * 1000000)
+
+
+class VirtualSelector(selectors.BaseSelector):
+    """
+        Polls the real selector without blocking and moves the virtual clock forward by the timeout instead of
+        waiting for it.
+    """
+
+    def __init__(self, clock):
+        super(VirtualSelector, self).__init__()
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        ready = self.selector.select(0)
+        if not ready and timeout:
+            self.clock.advance(timeout)
+        return ready
+
+    def get_map(self):
+        return self.selector.get_map()
+
+    def close(self):
+        self.selector.close()
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+        An asyncio loop whose 'time' is the VirtualClock.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        super(VirtualEventLoop, self).__init__(VirtualSelector(clock))
+
+    def time(self):
+        return self.clock.now
+
+
+class SimulatedInputDevice(object):
+    """
+        Stands in for an evdev InputDevice. It plays a list of (seconds, type, code, value) events where the seconds
+        are counted from the start of the simulation. A SYN_REPORT follows every scripted event unless the script
+        writes its own SYN events.
+    """
+
+    def __init__(self, clock, name, vendor, product, script=None, capabilities=None, path=None, autosyn=True,
+                 phys='simulated'):
+        """
+        :param clock: VirtualClock
+        :param name: str - The full name of the device as '--list-devices' would show it.
+        :param vendor: int
+        :param product: int
+        :param script: list - (seconds, type, code, value) tuples
+        :param capabilities: dict - {type: [codes]} EV_ABS codes may be (code, AbsInfo) tuples.
+        :param path: str
+        :param autosyn: bool
+        :param phys: str - The physical path of the device, IE: the USB port.
+        """
+        super(SimulatedInputDevice, self).__init__()
+        self.clock = clock
+        self.name = name
+        self.phys = phys
+        self.path = path or f'/dev/input/simulated-{name}'
+        self.info = DeviceInfo(ecodes.BUS_VIRTUAL, vendor, product, 1)
+        self.script = sorted(script or [], key=lambda item: item[0])
+        self.caps = capabilities or {ecodes.EV_KEY: [getattr(ecodes, key) for key in CLASSIC_KEYBOARD]}
+        self.autosyn = autosyn
+        self.grabbed = False
+        self.held = set()
+
+    def __str__(self):
+        return f'device {self.path}, name "{self.name}", phys "{self.phys}"'
+
+    def capabilities(self, verbose=False, absinfo=True):
+        if absinfo:
+            return dict(self.caps)
+        return {evType: [code[0] if isinstance(code, tuple) else code for code in codes]
+                for evType, codes in self.caps.items()}
+
+    def absinfo(self, code):
+        for item in self.caps.get(ecodes.EV_ABS, []):
+            if isinstance(item, tuple) and item[0] == code:
+                return item[1]
+        raise KeyError(code)
+
+    def active_keys(self, verbose=False):
+        return sorted(self.held)
+
+    def grab(self):
+        self.grabbed = True
+
+    def ungrab(self):
+        self.grabbed = False
+
+    def close(self):
+        pass
+
+    def events(self):
+        """
+            Yields the scripted events as (when, type, code, value) where 'when' is the virtual time of the event.
+        """
+        for offset, evType, code, value in self.script:
+            yield self.clock.start + offset, evType, code, value
+            if self.autosyn and evType != ecodes.EV_SYN:
+                yield self.clock.start + offset, ecodes.EV_SYN, ecodes.SYN_REPORT, 0
+
+    async def async_read_loop(self):
+        for when, evType, code, value in self.events():
+            if when > self.clock.now:
+                await asyncio.sleep(when - self.clock.now)
+            if evType == ecodes.EV_KEY:
+                if value:
+                    self.held.add(code)
+                else:
+                    self.held.discard(code)
+            sec, usec = self.clock.timestamp()
+            yield InputEvent(sec, usec, evType, code, value)
+        # A real device that goes quiet never ends its read loop
+        await asyncio.get_event_loop().create_future()
+
+    def read_loop(self):
+        for when, evType, code, value in self.events():
+            self.clock.now = max(self.clock.now, when)
+            sec, usec = self.clock.timestamp()
+            yield InputEvent(sec, usec, evType, code, value)
+
+
+class RecordingOutput(object):
+    """
+        Stands in for an evdev UInput and records everything written to it as (seconds, type, code, value) where the
+        seconds are the virtual time since the start. Writes to 'fd' are read back from a pipe.
+    """
+
+    def __init__(self, clock, caps, name='simulated_output'):
+        super(RecordingOutput, self).__init__()
+        self.clock = clock
+        self.caps = caps
+        self.name = name
+        self.events = []
+        self.reader, self.fd = os.pipe()
+        os.set_blocking(self.reader, False)
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(self.reader, self.drain)
+
+    def __str__(self):
+        return f'{self.name} (simulated)'
+
+    def capabilities(self, verbose=False, absinfo=True):
+        return self.caps
+
+    def write(self, etype, code, value):
+        self.events.append((self.clock.elapsed(), etype, code, value))
+
+    def write_event(self, event):
+        self.events.append((self.clock.elapsed(), event.type, event.code, event.value))
+
+    def syn(self):
+        self.events.append((self.clock.elapsed(), ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+
+    def drain(self):
+        try:
+            data = os.read(self.reader, 65536)
+        except BlockingIOError:
+            return
+        for offset in range(0, len(data) - (len(data) % EVENT.size), EVENT.size):
+            sec, usec, evType, code, value = EVENT.unpack_from(data, offset)
+            self.events.append((self.clock.elapsed(), evType, code, value))
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.drain()
+        if not self.loop.is_closed():
+            self.loop.remove_reader(self.reader)
+        os.close(self.fd)
+        os.close(self.reader)
+        self.fd = None
+
+    def keys(self):
+        """
+            The EV_KEY events written as (seconds, code, value).
+        """
+        return [(when, code, value) for when, evType, code, value in self.events if evType == ecodes.EV_KEY]
+
+
+class SimulatedProcess(object):
+
+    def __init__(self, exe, user='player'):
+        self._exe = exe
+        self._user = user
+
+    def exe(self):
+        return self._exe
+
+    def username(self):
+        return self._user
+
+    def name(self):
+        return os.path.basename(self._exe)
+
+
+class ScriptedProcesses(object):
+    """
+        A psutil like process list that changes over time. The timeline is a list of (seconds, [executables]) and the
+        last entry at or before the current time is the list of running processes. An executable can also be given as
+        [executable, user] for the seats.
+    """
+
+    def __init__(self, clock, timeline=None):
+        super(ScriptedProcesses, self).__init__()
+        self.clock = clock
+        self.timeline = sorted(timeline or [], key=lambda item: item[0])
+
+    def process_iter(self):
+        running = []
+        for offset, exes in self.timeline:
+            if self.clock.start + offset > self.clock.now:
+                break
+            running = exes
+        return [SimulatedProcess(*exe) if isinstance(exe, (list, tuple)) else SimulatedProcess(exe)
+                for exe in running]
+
+
+class Simulation(object):
+    """
+        Runs PyController for 'duration' seconds of virtual time against a scenario. A scenario is a dict (or a yaml
+        file) such as:
+            duration: 120             # Seconds of virtual time
+            config: /path/to/config   # Optional, the directory holding main.yaml, devices.d and profiles.d
+            monitorInterval: 5        # Seconds between GameMonitor scans
+            inputs:
+              - name: "Razer Razer Nostromo"
+                vendor: '1532'
+                product: '0111'
+                phys: usb-0000:00:14.0-2   # Optional, matched against 'phys' of the device configs
+                events:               # Seconds since the start, code, value
+                  - [1.0, KEY_A, 1]
+                  - [1.1, KEY_A, 0]
+                taps: {keys: [KEY_W, KEY_S], rate: 20}   # Generated press/release pairs for load
+            processes:                # Seconds since the start, running executables
+              - [0, []]
+              - [30, [/opt/games/CompanyOfHeroes2]]
+              - [60, [[/opt/games/CompanyOfHeroes2, player2]]]   # Started by the user 'player2'
+              - [90, []]
+    """
+
+    scenario = None
+    clock = None
+    loop = None
+    inputs = None
+    outputs = None
+    processes = None
+    pyc = None
+    profiles = None
+    seatProfiles = None
+
+    def __init__(self, scenario, arguments=None, install_dir=None):
+        """
+        :param scenario: dict or str - The scenario or the path to a yaml file with it.
+        :param arguments: An ArgParse namespace, the defaults are used when None.
+        :param install_dir: str
+        """
+        super(Simulation, self).__init__()
+        if not isinstance(scenario, dict):
+            with open(scenario) as f:
+                scenario = yaml.safe_load(f)
+        self.scenario = scenario
+        self.arguments = arguments or argparse.Namespace(config='main.yaml', verbosity=0, profile_hotpath=0.0,
+                                                         control_socket='', metrics_file='')
+        self.install_dir = install_dir
+        self.clock = VirtualClock(scenario.get('start'))
+        self.outputs = {}
+        self.profiles = []
+        self.seatProfiles = {}
+
+    @property
+    def duration(self):
+        return float(self.scenario.get('duration', 60))
+
+    def build_inputs(self):
+        self.inputs = []
+        for config in self.scenario.get('inputs') or []:
+            script = []
+            for offset, name, value in config.get('events') or []:
+                script.append((float(offset), *parse_event(name), int(value)))
+            taps = config.get('taps') or {}
+            if taps.get('keys') and taps.get('rate'):
+                period = 1.0 / float(taps['rate'])
+                codes = [parse_event(name)[1] for name in taps['keys']]
+                offset, index = float(taps.get('start', 0)), 0
+                while offset < min(self.duration, float(taps.get('stop', self.duration))):
+                    code = codes[index % len(codes)]
+                    script.append((offset, ecodes.EV_KEY, code, 1))
+                    script.append((offset + (period / 2), ecodes.EV_KEY, code, 0))
+                    offset += period
+                    index += 1
+            self.inputs.append(SimulatedInputDevice(self.clock, str(config.get('name', 'Simulated Device')),
+                                                    int(str(config.get('vendor', '0')), 16),
+                                                    int(str(config.get('product', '0')), 16),
+                                                    script=script,
+                                                    capabilities=self.build_capabilities(config),
+                                                    phys=str(config.get('phys', 'simulated'))))
+        return self.inputs
+
+    @staticmethod
+    def build_capabilities(config):
+        if not config.get('capabilities'):
+            return None
+        caps = {}
+        for name in config['capabilities']:
+            evType, code = parse_event(name)
+            caps.setdefault(evType, []).append((code, AbsInfo(0, -32768, 32767, 16, 128, 0))
+                                               if evType == ecodes.EV_ABS else code)
+        return caps
+
+    def uinput(self, caps, name='simulated_output'):
+        output = RecordingOutput(self.clock, caps, name=name)
+        self.outputs[name] = output
+        return output
+
+    async def game_monitor(self, monitor, globalQueue, interval):
+        while True:
+            monitor.poll(globalQueue)
+            await asyncio.sleep(interval)
+
+    async def watch_profile(self):
+        """
+            Records when the active profile of each seat changes. 'profiles' holds the changes of the devices that are
+            not in a seat.
+        """
+        self.seatProfiles = {name: [] for name in self.pyc.seats}
+        activeProfiles = {name: None for name in self.pyc.seats}
+        while True:
+            for name, seat in self.pyc.seats.items():
+                if seat.keymapper.activeProfile != activeProfiles[name]:
+                    activeProfiles[name] = seat.keymapper.activeProfile
+                    self.seatProfiles[name].append((round(self.clock.elapsed(), 6), activeProfiles[name]))
+            self.profiles = self.seatProfiles[defaultSeat]
+            await asyncio.sleep(0.1)
+
+    def run(self):
+        """
+            Builds PyController on the virtual loop, runs it for 'duration' seconds of virtual time and shuts it down.
+        :return: dict - The report.
+        """
+        # Imported here as PyController imports this module for the '--simulate' flag
+        from PyController.PyController import PyController, kill_now
+        from PyController.GameMonitor import GameMonitor
+
+        self.loop = VirtualEventLoop(self.clock)
+        asyncio.set_event_loop(self.loop)
+        self.build_inputs()
+        processes = ScriptedProcesses(self.clock, self.scenario.get('processes'))
+        wallStart, cpuStart = time.perf_counter(), time.process_time()
+        try:
+            self.pyc = PyController(self.arguments, install_dir=self.install_dir,
+                                    config_dir=self.scenario.get('config'), inputDevices=self.inputs,
+                                    uinput=self.uinput)
+            self.pyc.clock = self.clock.time
+            self.pyc.queue = queue.Queue()
+            for seat in self.pyc.seats.values():
+                seat.threaded = False   # Every seat has to run on the virtual loop
+            kill_now.value = 1
+            self.pyc.setup(self.loop, None)
+            if self.pyc.settings.profilesConfig:
+                monitor = GameMonitor(self.pyc, processes=processes.process_iter)
+                self.loop.create_task(self.game_monitor(monitor, self.pyc.queue,
+                                                        float(self.scenario.get('monitorInterval', 5))))
+            self.loop.create_task(self.watch_profile())
+            self.loop.call_at(self.clock.start + self.duration, self.loop.stop)
+            self.loop.run_forever()
+            return self.report(time.perf_counter() - wallStart, time.process_time() - cpuStart)
+        except Exception as e:
+            log.error(f'Error in the simulation: {e}')
+            log.debug(f'[DEBUG] for the simulation: {traceback.format_exc()}')
+            raise
+        finally:
+            self.stop()
+
+    def stop(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        if self.pyc is not None:
+            self.pyc.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def report(self, wallTime, cpuTime):
+        return {'virtualSeconds': self.clock.elapsed(),
+                'wallSeconds': wallTime,
+                'cpuSeconds': cpuTime,
+                'speedup': self.clock.elapsed() / wallTime if wallTime else 0.0,
+                'devices': {device['name']: device['stats'] for seat in self.pyc.seats.values()
+                            for device in seat.devManager.as_dict()},
+                'outputs': {name: len(output.events) for name, output in self.outputs.items()},
+                'timers': self.pyc.keymapper.timers.stats.as_dict(),
+                'profiles': self.profiles,
+                'seatProfiles': self.seatProfiles,
+                'profileSwitches': self.pyc.keymapper.profileSwitches}
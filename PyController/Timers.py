@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+# Author: Ryan Henrichson
+# Description: This package holds the TimerWheel which drives turbo (autofire) and custom key repeat for every device.
+#   All the repeating keys share a single heap and a single timer handle on the asyncio loop so the cost stays flat no
+#   matter how many keys are held down.
+
+
+import asyncio
+import heapq
+import logging
+import time
+import traceback
+from evdev import InputEvent, ecodes
+from PyController.FlightRecorder import TIMER
+
+
+log = logging.getLogger('Timers')
+
+
+class TimerEntry(object):
+    """
+        A single held key that is being repeated. 'turbo' entries toggle between press and release every 'period'
+        seconds, repeat entries write an autorepeat (value 2) event every 'period' seconds.
+    """
+
+    __slots__ = ('deadline', 'period', 'device', 'code', 'turbo', 'value', 'cancelled')
+
+    def __init__(self, deadline, period, device, code, turbo):
+        self.deadline = deadline
+        self.period = period
+        self.device = device
+        self.code = code
+        self.turbo = turbo
+        self.value = 1
+        self.cancelled = False
+
+
+class TimerStats(object):
+    """
+        How accurately the TimerWheel is firing. Lateness is the time in seconds between when an entry should have
+        fired and when it did.
+    """
+
+    __slots__ = ('fired', 'latenessTotal', 'latenessMax', 'skipped')
+
+    def __init__(self):
+        self.fired = 0
+        self.latenessTotal = 0.0
+        self.latenessMax = 0.0
+        self.skipped = 0
+
+    def as_dict(self):
+        return {'fired': self.fired,
+                'latenessAvg': self.latenessTotal / self.fired if self.fired else 0.0,
+                'latenessMax': self.latenessMax,
+                'skipped': self.skipped}
+
+
+class TimerWheel(object):
+    """
+        A heap of TimerEntry objects ordered by deadline. Only one 'call_at' handle is ever scheduled on the loop, it
+        is for the earliest deadline. Cancelled entries are left in the heap and skipped when they come up.
+    """
+
+    loop = None
+    heap = None
+    entries = None
+    stats = None
+    clock = time.time  # The time turbo and repeat events are recorded with, a simulation sets its virtual clock
+
+    _handle = None
+    _handleDeadline = None
+    _sequence = 0
+
+    def __init__(self, loop=None):
+        super(TimerWheel, self).__init__()
+        self.loop = loop
+        self.heap = []
+        self.entries = {}
+        self.stats = TimerStats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key_event(self, device, code, event):
+        """
+            Called by the device worker for keys that have turbo or a custom repeat rate. The event has already been
+            mapped so 'event.code' is the code written to the output device.
+        :param device: Device object
+        :param code: int - The input code of the key.
+        :param event: InputEvent object
+        :return: bool - False if the event should not be written. The source's own autorepeat is replaced.
+        """
+        record = device.keyRecord
+        key = (device.name, code)
+        if event.value == 2:
+            return False
+        self.cancel(key)
+        if event.value == 1:
+            if record.turbo[code]:
+                self.schedule(key, device, event.code, record.turbo[code] / 2, record.turbo[code] / 2, turbo=True)
+            elif record.repeat[code]:
+                self.schedule(key, device, event.code, record.repeatDelay, record.repeat[code])
+        return True
+
+    def schedule(self, key, device, code, delay, period, turbo=False):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        entry = TimerEntry(self.loop.time() + delay, period, device, code, turbo)
+        self.entries[key] = entry
+        self._push(entry)
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry.cancelled = True
+        return entry
+
+    def cancel_device(self, device):
+        for key in [key for key in self.entries if key[0] == device.name]:
+            self.cancel(key)
+
+    def close(self):
+        for key in list(self.entries):
+            self.cancel(key)
+        self.heap = []
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _push(self, entry):
+        self._sequence += 1
+        heapq.heappush(self.heap, (entry.deadline, self._sequence, entry))
+        if self._handle is None or entry.deadline < self._handleDeadline:
+            if self._handle is not None:
+                self._handle.cancel()
+            self._handleDeadline = entry.deadline
+            self._handle = self.loop.call_at(entry.deadline, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        now = self.loop.time()
+        heap = self.heap
+        stats = self.stats
+        while heap and heap[0][0] <= now:
+            deadline, sequence, entry = heapq.heappop(heap)
+            if entry.cancelled:
+                continue
+            lateness = now - deadline
+            stats.fired += 1
+            stats.latenessTotal += lateness
+            if lateness > stats.latenessMax:
+                stats.latenessMax = lateness
+            try:
+                if entry.turbo:
+                    entry.value = 0 if entry.value else 1
+                    value = entry.value
+                else:
+                    value = 2
+                entry.device.outDevice.write_event(InputEvent(0, 0, ecodes.EV_KEY, entry.code, value))
+                entry.device.outDevice.syn()
+                if entry.device.recorder is not None:
+                    self.record(entry, value)
+            except Exception as e:
+                log.error(f'Error repeating a key on Device: {entry.device.name}: {e}')
+                log.debug(f'[DEBUG] for TimerWheel: {traceback.format_exc()}')
+                entry.cancelled = True
+                continue
+            entry.deadline = deadline + entry.period
+            if entry.deadline <= now:
+                # Fell behind by more than a period, skip the missed repeats rather than bursting to catch up.
+                stats.skipped += 1
+                entry.deadline = now + entry.period
+            self._sequence += 1
+            heapq.heappush(heap, (entry.deadline, self._sequence, entry))
+        if heap and self._handle is None:
+            self._handleDeadline = heap[0][0]
+            self._handle = self.loop.call_at(self._handleDeadline, self._fire)
+
+    def record(self, entry, value):
+        """
+            Stores a turbo or repeat event in the flight recorder of its device. There is no event read from the
+            device for it, its in type is TIMER.
+        """
+        device = entry.device
+        recorder = device.recorder
+        sec, usec = divmod(self.clock(), 1)
+        recorder.record(recorder.device_id(device.name), device.keymapper.activeProfile, int(sec), int(usec * 1000000),
+                        TIMER, entry.code, value, ecodes.EV_KEY, entry.code, value)